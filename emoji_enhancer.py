@@ -1,11 +1,19 @@
+import datetime
 import json
 import os
 import logging
 import re
 import asyncio
+import hashlib
+import signal
 import sys
+import threading
+import time
+from collections import Counter, OrderedDict
 from telethon import TelegramClient, events
+from telethon.sessions import SQLiteSession, StringSession
 from telethon.tl.types import MessageEntityCustomEmoji
+from telethon.tl.types.updates import State
 
 
 # --- 🎨 Colors and Logging Setup ---
@@ -18,6 +26,10 @@ class Colors:
 
 
 CONFIG_FILE = 'enhance-emoji.ini'
+ENTITY_CACHE_SIZE = 512  # templated posts remembered by the result cache
+METRICS_INTERVAL = 300  # seconds between metrics log lines
+SESSION_FLUSH_INTERVAL = 60  # seconds between memory session flushes
+PROFILE_INTERVAL = 0.005  # seconds between stack samples while profiling
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -40,6 +52,7 @@ def load_config():
     cfg.setdefault("admins", {})
     cfg.setdefault("channels", [])
     cfg.setdefault("emoji_map", {})
+    cfg.setdefault("session_backend", "sqlite")
     return cfg
 
 
@@ -198,8 +211,338 @@ def setup_emojis(config):
     return config
 
 
+# --- 📊 Metrics ---
+class Metrics:
+    """Process-wide counters, logged periodically while monitoring."""
+
+    def __init__(self):
+        self.counters = {}
+        self.timings = {}
+
+    def incr(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, ms):
+        count, total, peak = self.timings.get(name, (0, 0.0, 0.0))
+        self.timings[name] = (count + 1, total + ms, max(peak, ms))
+
+    def snapshot(self):
+        snap = dict(self.counters)
+        for name, (count, total, peak) in self.timings.items():
+            snap[f"{name}_count"] = count
+            snap[f"{name}_avg"] = round(total / count, 3)
+            snap[f"{name}_max"] = round(peak, 3)
+        hits = snap.get("cache_hits", 0)
+        lookups = hits + snap.get("cache_misses", 0)
+        snap["cache_hit_rate"] = round(hits / lookups, 3) if lookups else 0.0
+        return snap
+
+
+metrics = Metrics()
+
+
+def elapsed_ms(since):
+    return (time.perf_counter() - since) * 1000
+
+
+async def report_metrics(interval=METRICS_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        logger.info(f"📊 Metrics: {metrics.snapshot()}")
+
+
+# --- 💾 Session Storage ---
+class TimedSessionMixin:
+    """Times Telethon's entity bookkeeping in the session.
+
+    Telethon batches the entities seen in updates and hands them to the
+    session when it saves its state (about once a minute, at login and at
+    shutdown), so this measures those saves, not a per-message cost.
+    """
+
+    def process_entities(self, tlo):
+        started = time.perf_counter()
+        try:
+            return super().process_entities(tlo)
+        finally:
+            metrics.observe("session_entities_ms", elapsed_ms(started))
+
+
+class TimedSQLiteSession(TimedSessionMixin, SQLiteSession):
+    pass
+
+
+class MemoryFileSession(TimedSessionMixin, StringSession):
+    """In-memory session flushed to a small JSON file.
+
+    Login, known entities and update state are kept in memory while messages
+    are handled, so there is no SQLite file to lock, and written together by
+    flush() (periodically and at shutdown) when they changed since the last
+    write. Files holding only a session string, from before entities and
+    update state were kept, are still read.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._written = None
+        saved = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                content = f.read().strip()
+            saved = json.loads(content) if content.startswith('{') else {'auth': content}
+        super().__init__(saved.get('auth') or None)
+        self._entities.update(tuple(row) for row in saved.get('entities', ()))
+        for entity_id, pts, qts, date, seq in saved.get('update_states', ()):
+            date = datetime.datetime.fromtimestamp(date, tz=datetime.timezone.utc)
+            self._update_states[entity_id] = State(pts, qts, date, seq, unread_count=0)
+
+    def _serialize(self):
+        auth = StringSession.save(self)
+        if not auth:
+            return None
+        states = sorted(
+            (entity_id, state.pts, state.qts, state.date.timestamp(), state.seq)
+            for entity_id, state in self._update_states.items()
+        )
+        entities = sorted(self._entities, key=lambda row: row[0])
+        return json.dumps({'auth': auth, 'entities': entities, 'update_states': states},
+                          ensure_ascii=False)
+
+    def flush(self):
+        started = time.perf_counter()
+        data = self._serialize()
+        if data is None or data == self._written:
+            return
+        tmp_path = f"{self.path}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+        self._written = data
+        metrics.observe("session_flush_ms", elapsed_ms(started))
+
+    def save(self):
+        self.flush()
+        return StringSession.save(self)
+
+    def close(self):
+        self.flush()
+
+
+def open_session(phone, backend="sqlite"):
+    """Build the session for an admin according to the configured backend."""
+    name = f"enhancer_{phone}"
+    if backend != "memory":
+        return TimedSQLiteSession(f"{name}.session")
+
+    session = MemoryFileSession(f"{name}.session.txt")
+    if session.auth_key is None and os.path.exists(f"{name}.session"):
+        # Reuse the login from an existing SQLite session instead of asking again
+        legacy = SQLiteSession(f"{name}.session")
+        if legacy.auth_key is not None:
+            session.set_dc(legacy.dc_id, legacy.server_address, legacy.port)
+            session.auth_key = legacy.auth_key
+            logger.info(f"Imported SQLite session for {phone} into memory backend")
+        legacy.close()
+    return session
+
+
+def lock_session(phone):
+    """Take an exclusive lock so one admin session is used by one process only.
+
+    Returns the open lock file (keep it alive), or None if another process
+    already holds it.
+    """
+    try:
+        import fcntl
+    except ImportError:  # Windows
+        fcntl = None
+        import msvcrt
+
+    lock_file = open(f"enhancer_{phone}.session.lock", 'w')
+    try:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+async def flush_session_periodically(session, interval=SESSION_FLUSH_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        session.flush()
+
+
+# --- ⏱️ Profiling ---
+class StackSampler:
+    """Sampling profiler for the event loop thread, toggled with SIGUSR1.
+
+    While running, a background thread records the loop thread's stack every
+    ``interval`` seconds; stopping writes them in the folded format read by
+    flamegraph.pl and speedscope. Nothing runs while it is off.
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self._thread = None
+        self._stop = threading.Event()
+        self._target = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def toggle(self):
+        if self.running:
+            logger.info(f"🔥 Profile written to {self.stop()}")
+        else:
+            self.start()
+            logger.info("🔥 Sampling profiler started (send SIGUSR1 again to stop)")
+
+    def start(self):
+        self.stacks.clear()
+        self._stop.clear()
+        self._target = threading.get_ident()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                filename = os.path.basename(code.co_filename)
+                names.append(f"{code.co_name} ({filename}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if names:
+                self.stacks[";".join(reversed(names))] += 1
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        # The pid tells apart the profiles of supervisor workers toggled together
+        path = time.strftime(f"telemoji-profile-%Y%m%d-%H%M%S-{os.getpid()}.folded")
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        return path
+
+
+# --- 🧮 Emoji Matching ---
+def build_emoji_entities(text, emoji_map):
+    """Return custom emoji entities for every mapped emoji found in text."""
+    started = time.perf_counter()
+    matches = []
+    for emoji, doc_id in emoji_map.items():
+        for m in re.finditer(re.escape(emoji), text):
+            matches.append((m.start(), m.end(), emoji, int(doc_id)))
+
+    matches.sort(key=lambda x: x[0])
+    metrics.observe("stage_match_ms", elapsed_ms(started))
+
+    started = time.perf_counter()
+    new_entities = []
+
+    for start, end, emoji, doc_id in matches:
+        prefix = text[:start]
+        offset = len(prefix.encode('utf-16-le')) // 2
+        length = len(emoji.encode('utf-16-le')) // 2
+        new_entities.append(
+            MessageEntityCustomEmoji(
+                offset=offset,
+                length=length,
+                document_id=doc_id,
+            )
+        )
+    metrics.observe("stage_encode_ms", elapsed_ms(started))
+    return new_entities
+
+
+class EntityCache:
+    """Bounded LRU of computed entity lists, keyed by text hash + map version."""
+
+    def __init__(self, maxsize=ENTITY_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.map_version = 0
+        self._entries = OrderedDict()
+
+    def _key(self, text):
+        digest = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+        return digest, self.map_version
+
+    def get_entities(self, text, emoji_map):
+        key = self._key(text)
+        entities = self._entries.get(key)
+        if entities is not None:
+            self._entries.move_to_end(key)
+            metrics.incr("cache_hits")
+            return entities
+
+        metrics.incr("cache_misses")
+        entities = build_emoji_entities(text, emoji_map)
+        self._entries[key] = entities
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return entities
+
+    def clear(self):
+        """Drop every entry and bump the map version (call on map reload)."""
+        self._entries.clear()
+        self.map_version += 1
+
+
+def reload_emoji_map(config, cache):
+    """Re-read the emoji map from disk and invalidate cached results."""
+    config["emoji_map"] = load_config()["emoji_map"]
+    cache.clear()
+    logger.info(
+        f"🔁 Emoji map reloaded ({len(config['emoji_map'])} entries, "
+        f"version {cache.map_version})"
+    )
+
+
+# --- 🎞️ Traffic Recording ---
+class EventRecorder:
+    """Event handler that writes incoming messages to a JSON-lines file.
+
+    The file is the input of ``enhancer_replay.py``.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'w', encoding='utf-8')
+        self._t0 = None
+        logger.info(f"🎞️ Recording incoming events to {path}")
+
+    async def __call__(self, event):
+        now = time.monotonic()
+        if self._t0 is None:
+            self._t0 = now
+        record = {
+            "t": round(now - self._t0, 4),
+            "edited": isinstance(event, events.MessageEdited.Event),
+            "chat_id": event.chat_id,
+            "chat": getattr(event.chat, "username", None),
+            "message_id": event.message.id,
+            "text": event.message.text,
+            "entities": [e.to_dict() for e in event.message.entities or []],
+        }
+        self._file.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
 # --- 🤖 Main Telethon Logic ---
-async def start_monitoring(config, auto=False):
+async def start_monitoring(config, auto=False, client=None, record_path=None):
     if not config["admins"]:
         print("⚠️ No admins configured.")
         return
@@ -224,15 +567,28 @@ async def start_monitoring(config, auto=False):
 
     creds = config["admins"][selected_admin]
     api_id, api_hash, phone = creds["api_id"], creds["api_hash"], selected_admin
-    client = TelegramClient(f"enhancer_{phone}.session", int(api_id), api_hash)
+    if client is None:
+        session_lock = lock_session(phone)
+        if session_lock is None:
+            print(f"⚠️ Session for {phone} is already in use by another process.")
+            return
+        backend = config.get("session_backend", "sqlite")
+        session = open_session(phone, backend)
+        client = TelegramClient(session, int(api_id), api_hash)
+    else:
+        # Injected client (e.g. the replay harness in enhancer_replay.py)
+        backend, session = "injected", None
 
     # --- Rate limit setup ---
     WINDOW_SECONDS = 2  # dedupe window seconds
     processing_lock = asyncio.Lock()
     last_processed = {}
+    entity_cache = EntityCache()
 
     async def handler(event):
+        waiting = time.perf_counter()
         async with processing_lock:
+            metrics.observe("stage_lock_wait_ms", elapsed_ms(waiting))
             key = (event.chat_id, event.message.id)
             now = asyncio.get_event_loop().time()
             if key in last_processed and now - last_processed[key] < WINDOW_SECONDS:
@@ -243,51 +599,69 @@ async def start_monitoring(config, auto=False):
             if not text:
                 return
 
+            metrics.incr("messages")
             parsed_text = text
             parsed_entities = event.message.entities or []
-
-            matches = []
-            for emoji, doc_id in config['emoji_map'].items():
-                for m in re.finditer(re.escape(emoji), parsed_text):
-                    matches.append((m.start(), m.end(), emoji, int(doc_id)))
-
-            matches.sort(key=lambda x: x[0])
-            new_entities = []
-
-            for start, end, emoji, doc_id in matches:
-                prefix = parsed_text[:start]
-                offset = len(prefix.encode('utf-16-le')) // 2
-                length = len(emoji.encode('utf-16-le')) // 2
-                new_entities.append(
-                    MessageEntityCustomEmoji(
-                        offset=offset,
-                        length=length,
-                        document_id=doc_id,
-                    )
-                )
+            new_entities = entity_cache.get_entities(parsed_text, config['emoji_map'])
 
             if not new_entities:
                 return
 
+            started = time.perf_counter()
             final_entities = (parsed_entities or []) + new_entities
             final_entities.sort(key=lambda e: e.offset)
+            metrics.observe("stage_merge_ms", elapsed_ms(started))
 
             try:
+                started = time.perf_counter()
                 await event.edit(parsed_text, formatting_entities=final_entities)
+                metrics.observe("stage_edit_ms", elapsed_ms(started))
+                metrics.incr("enhanced")
                 logger.info(
                     f"✅ Enhanced message {event.message.id} in {event.chat.username}"
                 )
             except Exception as e:
                 logger.error(f"❌ Failed editing message {event.message.id}: {e}")
 
+    recorder = EventRecorder(record_path) if record_path else None
     for ch in config["channels"]:
+        if recorder:
+            client.add_event_handler(recorder, events.NewMessage(chats=ch))
+            client.add_event_handler(recorder, events.MessageEdited(chats=ch))
         client.add_event_handler(handler, events.NewMessage(chats=ch))
         client.add_event_handler(handler, events.MessageEdited(chats=ch))
         logger.info(f"Monitoring channel: {ch}")
 
+    loop = asyncio.get_running_loop()
+    sampler = StackSampler()
+    if hasattr(signal, "SIGHUP"):
+        loop.add_signal_handler(
+            signal.SIGHUP, reload_emoji_map, config, entity_cache
+        )
+        loop.add_signal_handler(signal.SIGUSR1, sampler.toggle)
+
+    started = time.perf_counter()
     await client.start(phone=phone)
-    logger.info(f"Client started under admin {phone}")
-    await client.run_until_disconnected()
+    startup_ms = elapsed_ms(started)
+    metrics.observe("startup_ms", startup_ms)
+    logger.info(
+        f"Client started under admin {phone} "
+        f"({backend} session, {startup_ms:.0f} ms)"
+    )
+    background = [asyncio.create_task(report_metrics())]
+    if isinstance(session, MemoryFileSession):
+        background.append(asyncio.create_task(flush_session_periodically(session)))
+    try:
+        await client.run_until_disconnected()
+    finally:
+        for task in background:
+            task.cancel()
+        if isinstance(session, MemoryFileSession):
+            session.flush()
+        if recorder:
+            recorder.close()
+        if sampler.running:
+            logger.info(f"🔥 Profile written to {sampler.stop()}")
 
 
 # --- ▶️ Main Menu ---
@@ -325,14 +699,17 @@ async def main():
             print("Invalid option.")
 
 
-async def auto_start():
+async def auto_start(record_path=None):
     """Run monitoring directly without showing the menu."""
     config = load_config()
-    await start_monitoring(config, auto=True)
+    await start_monitoring(config, auto=True, record_path=record_path)
 
 
 if __name__ == "__main__":
     if len(sys.argv) > 1 and sys.argv[1] == "--headless":
-        asyncio.run(auto_start())
+        record_path = None
+        if "--record" in sys.argv[2:3] and len(sys.argv) > 3:
+            record_path = sys.argv[3]
+        asyncio.run(auto_start(record_path))
     else:
         asyncio.run(main())
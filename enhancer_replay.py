@@ -0,0 +1,184 @@
+"""Replay recorded channel traffic through the real enhancer handler offline.
+
+Record production traffic first:
+
+    python3 emoji_enhancer.py --headless --record traffic.jsonl
+
+then replay it against a local fake client (no Telegram account involved):
+
+    python3 enhancer_replay.py traffic.jsonl --speed 10 --flood-every 200
+"""
+import argparse
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+from telethon import events
+from telethon.errors import FloodWaitError
+from telethon.tl import types
+
+from emoji_enhancer import load_config, logger, metrics, start_monitoring
+
+
+def load_recording(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def build_entities(raw_entities):
+    entities = []
+    for raw in raw_entities:
+        fields = dict(raw)
+        cls = getattr(types, fields.pop("_"))
+        entities.append(cls(**fields))
+    return entities
+
+
+class FakeMessage:
+    def __init__(self, record):
+        self.id = record["message_id"]
+        self.text = record["text"]
+        self.entities = build_entities(record.get("entities", []))
+
+
+class FakeEvent:
+    """Just enough of a Telethon message event for the enhancer handler."""
+
+    def __init__(self, client, record):
+        self._client = client
+        self.chat_id = record["chat_id"]
+        self.chat = SimpleNamespace(username=record.get("chat"))
+        self.message = FakeMessage(record)
+
+    async def edit(self, text, formatting_entities=None):
+        await self._client.edit(self, text, formatting_entities)
+
+
+class FakeClient:
+    """Local stand-in for TelegramClient that replays a recording.
+
+    Edits are recorded instead of sent; every ``flood_every``-th edit raises
+    ``FloodWaitError`` the way Telegram does when an account edits too fast.
+    """
+
+    def __init__(self, recording, speed=1.0, edit_latency=0.05,
+                 flood_every=0, flood_seconds=5):
+        self.recording = recording
+        self.speed = speed
+        self.edit_latency = edit_latency
+        self.flood_every = flood_every
+        self.flood_seconds = flood_seconds
+        self.handlers = []
+        self.edits = []
+        self.flood_waits = 0
+        self.latencies = []
+        self.elapsed = 0.0
+
+    def add_event_handler(self, callback, event_builder):
+        self.handlers.append((callback, event_builder))
+
+    async def start(self, phone=None):
+        return self
+
+    async def edit(self, event, text, formatting_entities):
+        await asyncio.sleep(self.edit_latency)
+        attempt = len(self.edits) + self.flood_waits + 1
+        if self.flood_every and attempt % self.flood_every == 0:
+            self.flood_waits += 1
+            raise FloodWaitError(request=None, capture=self.flood_seconds)
+        self.edits.append((event.chat_id, event.message.id, text, formatting_entities))
+
+    def _matches(self, builder, record):
+        if isinstance(builder, events.MessageEdited):
+            if not record.get("edited"):
+                return False
+        elif record.get("edited"):
+            return False
+        chats = builder.chats
+        if chats is None:
+            return True
+        if not isinstance(chats, (list, tuple, set)):
+            chats = [chats]
+        names = {str(record["chat_id"])}
+        if record.get("chat"):
+            names.update({record["chat"], f"@{record['chat']}"})
+        return any(str(chat) in names for chat in chats)
+
+    async def _dispatch(self, record):
+        started = time.perf_counter()
+        for callback, builder in self.handlers:
+            if self._matches(builder, record):
+                await callback(FakeEvent(self, record))
+        self.latencies.append((time.perf_counter() - started) * 1000)
+
+    async def run_until_disconnected(self):
+        loop_start = time.perf_counter()
+        tasks = []
+        for record in self.recording:
+            if self.speed > 0:
+                delay = record["t"] / self.speed - (time.perf_counter() - loop_start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            # Telethon dispatches each update in its own task
+            tasks.append(asyncio.create_task(self._dispatch(record)))
+        await asyncio.gather(*tasks)
+        self.elapsed = time.perf_counter() - loop_start
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def print_report(client):
+    count = len(client.latencies)
+    rate = count / client.elapsed if client.elapsed else 0.0
+    print("\n--- Replay Report ---")
+    print(f"Events:       {count} in {client.elapsed:.2f}s ({rate:.1f} events/s)")
+    print(f"Edits:        {len(client.edits)}")
+    print(f"FloodWaits:   {client.flood_waits}")
+    for pct in (50, 95, 99):
+        print(f"Latency p{pct}:  {percentile(client.latencies, pct):.2f} ms")
+    print(f"Latency max:  {max(client.latencies, default=0.0):.2f} ms")
+    print(f"Metrics:      {metrics.snapshot()}")
+
+
+async def replay(args):
+    recording = load_recording(args.recording)
+    config = load_config()
+    if not config["channels"]:
+        config["channels"] = sorted(
+            {f"@{r['chat']}" if r.get("chat") else r["chat_id"] for r in recording}, key=str
+        )
+    config["admins"] = {"replay": {"api_id": "0", "api_hash": ""}}
+
+    client = FakeClient(
+        recording,
+        speed=args.speed,
+        edit_latency=args.edit_latency,
+        flood_every=args.flood_every,
+        flood_seconds=args.flood_seconds,
+    )
+    logger.info(f"▶️ Replaying {len(recording)} events at {args.speed}x")
+    await start_monitoring(config, auto=True, client=client)
+    print_report(client)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("recording", help="JSON-lines file written by --record")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="replay speed multiple; 0 replays as fast as possible")
+    parser.add_argument("--edit-latency", type=float, default=0.05,
+                        help="simulated event.edit round trip in seconds")
+    parser.add_argument("--flood-every", type=int, default=0,
+                        help="raise FloodWaitError on every Nth edit (0 = never)")
+    parser.add_argument("--flood-seconds", type=int, default=5)
+    asyncio.run(replay(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
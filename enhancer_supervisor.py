@@ -0,0 +1,261 @@
+"""Run the enhancer as several worker processes under one supervisor.
+
+Every configured admin gets its own worker process (a Telegram session can
+only be used by one process) and the channels are spread across the workers:
+
+    python3 enhancer_supervisor.py
+
+Crashed workers are restarted with backoff. A worker that keeps crashing is
+parked for a while and its channels are moved to the remaining workers.
+``SIGHUP`` re-reads the config file, rebalances channels for added or removed
+admins and tells the unchanged workers to reload their emoji map. ``SIGUSR1``
+is forwarded to every worker to toggle its sampling profiler. Send both to
+the supervisor only (``systemctl kill --kill-who=main``).
+"""
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import queue
+import signal
+import time
+
+from emoji_enhancer import METRICS_INTERVAL, load_config, logger, metrics, start_monitoring
+
+METRICS_PUSH_INTERVAL = 30  # seconds between worker → supervisor metric pushes
+RESTART_BACKOFF = (1, 2, 5, 10, 30)  # seconds before each consecutive restart
+MAX_RESTARTS = 5  # crashes within RESTART_WINDOW before a worker is parked
+RESTART_WINDOW = 300
+PARK_SECONDS = 600  # how long a parked worker stays out of the rotation
+# Signals a worker handles itself once running; ignored until then
+WORKER_SIGNALS = (signal.SIGHUP, signal.SIGUSR1)
+
+
+# --- 👷 Worker Side ---
+def run_worker(phone, channels, metrics_queue):
+    """Process entry point: monitor ``channels`` under admin ``phone``."""
+    config = load_config()
+    config["admins"] = {phone: config["admins"][phone]}
+    config["channels"] = channels
+    try:
+        asyncio.run(_worker_main(phone, config, metrics_queue))
+    except asyncio.CancelledError:
+        pass  # stopped by the supervisor
+
+
+async def _worker_main(phone, config, metrics_queue):
+    async def push_metrics():
+        while True:
+            await asyncio.sleep(METRICS_PUSH_INTERVAL)
+            metrics_queue.put((phone, metrics.snapshot()))
+
+    # Cancelling lets start_monitoring flush its session before exiting
+    asyncio.get_running_loop().add_signal_handler(
+        signal.SIGTERM, asyncio.current_task().cancel
+    )
+    task = asyncio.create_task(push_metrics())
+    try:
+        await start_monitoring(config, auto=True)
+    finally:
+        task.cancel()
+        metrics_queue.put((phone, metrics.snapshot()))
+
+
+# --- 🧭 Channel Assignment ---
+def assign_channels(channels, phones):
+    """Spread channels over admins with rendezvous hashing.
+
+    Adding or removing an admin only moves the channels that admin gains or
+    loses; every other channel stays where it was.
+    """
+    assignment = {phone: [] for phone in phones}
+    if not phones:
+        return assignment
+    for ch in channels:
+        owner = max(
+            phones,
+            key=lambda phone: hashlib.blake2b(f"{phone}|{ch}".encode('utf-8')).digest(),
+        )
+        assignment[owner].append(ch)
+    return assignment
+
+
+def merge_snapshots(snapshots):
+    """Combine worker metric snapshots into one process-wide view."""
+    merged = {}
+    weighted = {}
+    for snap in snapshots:
+        for name, value in snap.items():
+            if name.endswith("_avg"):
+                base = name[:-len("_avg")]
+                count = snap.get(f"{base}_count", 0)
+                total, seen = weighted.get(base, (0.0, 0))
+                weighted[base] = (total + value * count, seen + count)
+            elif name.endswith("_max"):
+                merged[name] = max(merged.get(name, 0), value)
+            elif name != "cache_hit_rate":
+                merged[name] = merged.get(name, 0) + value
+    for base, (total, count) in weighted.items():
+        merged[f"{base}_avg"] = round(total / count, 3) if count else 0.0
+    hits = merged.get("cache_hits", 0)
+    lookups = hits + merged.get("cache_misses", 0)
+    merged["cache_hit_rate"] = round(hits / lookups, 3) if lookups else 0.0
+    return merged
+
+
+# --- 🧑‍✈️ Supervisor ---
+class Supervisor:
+    def __init__(self):
+        self.ctx = multiprocessing.get_context("spawn")
+        self.metrics_queue = self.ctx.Queue()
+        self.config = load_config()
+        self.processes = {}  # phone -> Process
+        self.assignment = {}  # phone -> channels
+        self.crashes = {}  # phone -> recent crash timestamps
+        self.restart_at = {}  # phone -> time a pending restart is due
+        self.parked_until = {}  # phone -> time a parked worker may return
+        self.snapshots = {}  # phone -> latest metrics snapshot
+        self.running = True
+        self.reload_requested = False
+
+    def active_phones(self, now):
+        return [
+            phone for phone in self.config["admins"]
+            if self.parked_until.get(phone, 0) <= now
+        ]
+
+    def start_worker(self, phone):
+        channels = self.assignment.get(phone, [])
+        if not channels:
+            return
+        proc = self.ctx.Process(
+            target=run_worker,
+            args=(phone, channels, self.metrics_queue),
+            name=f"enhancer-{phone}",
+            daemon=True,
+        )
+        # The ignored disposition is inherited, so a signal reaching the worker
+        # before start_monitoring installs its handlers can't kill it
+        previous = {sig: signal.signal(sig, signal.SIG_IGN) for sig in WORKER_SIGNALS}
+        try:
+            proc.start()
+        finally:
+            for sig, handler in previous.items():
+                signal.signal(sig, handler)
+        self.processes[phone] = proc
+        logger.info(f"👷 Worker {phone} (pid {proc.pid}) → {', '.join(channels)}")
+
+    def stop_worker(self, phone):
+        proc = self.processes.pop(phone, None)
+        self.restart_at.pop(phone, None)
+        if proc and proc.is_alive():
+            proc.terminate()
+            proc.join(timeout=10)
+            if proc.is_alive():
+                proc.kill()
+
+    def rebalance(self, now):
+        new_assignment = assign_channels(self.config["channels"], self.active_phones(now))
+        for phone in set(self.assignment) | set(new_assignment):
+            if self.assignment.get(phone) == new_assignment.get(phone):
+                continue
+            self.stop_worker(phone)
+            self.assignment[phone] = new_assignment.get(phone, [])
+            self.start_worker(phone)
+        self.assignment = {p: chs for p, chs in new_assignment.items() if chs}
+
+    def reload(self, now):
+        old_processes = dict(self.processes)
+        self.config = load_config()
+        for phone in set(self.parked_until) - set(self.config["admins"]):
+            del self.parked_until[phone]
+        self.rebalance(now)
+        # Workers that kept their channels only need a fresh emoji map
+        for phone, proc in old_processes.items():
+            if self.processes.get(phone) is proc and proc.is_alive():
+                os.kill(proc.pid, signal.SIGHUP)
+        logger.info("🔁 Supervisor configuration reloaded")
+
+    def check_workers(self, now):
+        for phone, proc in list(self.processes.items()):
+            if proc.is_alive() or phone in self.restart_at:
+                continue
+            crashes = [t for t in self.crashes.get(phone, []) if now - t < RESTART_WINDOW]
+            crashes.append(now)
+            self.crashes[phone] = crashes
+            logger.error(f"💥 Worker {phone} exited with code {proc.exitcode}")
+            if len(crashes) > MAX_RESTARTS:
+                logger.error(f"⏸️ Parking worker {phone} for {PARK_SECONDS}s")
+                del self.processes[phone]
+                self.parked_until[phone] = now + PARK_SECONDS
+                self.crashes[phone] = []
+                self.rebalance(now)
+                continue
+            delay = RESTART_BACKOFF[min(len(crashes), len(RESTART_BACKOFF)) - 1]
+            self.restart_at[phone] = now + delay
+
+        for phone, due in list(self.restart_at.items()):
+            if due <= now:
+                del self.restart_at[phone]
+                self.processes.pop(phone, None)
+                self.start_worker(phone)
+
+        # Parked workers whose time is up come back into the rotation
+        if any(until <= now for until in self.parked_until.values()):
+            self.parked_until = {p: t for p, t in self.parked_until.items() if t > now}
+            self.rebalance(now)
+
+    def drain_metrics(self):
+        while True:
+            try:
+                phone, snap = self.metrics_queue.get_nowait()
+            except queue.Empty:
+                return
+            self.snapshots[phone] = snap
+
+    def run(self):
+        if not self.config["admins"] or not self.config["channels"]:
+            print("⚠️ Configure at least one admin and one channel first.")
+            return
+
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_reload)
+        signal.signal(signal.SIGUSR1, self._on_profile)
+
+        self.rebalance(time.monotonic())
+        next_report = time.monotonic() + METRICS_INTERVAL
+        try:
+            while self.running:
+                now = time.monotonic()
+                if self.reload_requested:
+                    self.reload_requested = False
+                    self.reload(now)
+                self.check_workers(now)
+                self.drain_metrics()
+                if now >= next_report:
+                    next_report = now + METRICS_INTERVAL
+                    logger.info(
+                        f"📊 Metrics ({len(self.processes)} workers): "
+                        f"{merge_snapshots(self.snapshots.values())}"
+                    )
+                time.sleep(1)
+        finally:
+            for phone in list(self.processes):
+                self.stop_worker(phone)
+            logger.info("Supervisor stopped")
+
+    def _on_stop(self, signum, frame):
+        self.running = False
+
+    def _on_reload(self, signum, frame):
+        self.reload_requested = True
+
+    def _on_profile(self, signum, frame):
+        for proc in list(self.processes.values()):
+            if proc.is_alive():
+                os.kill(proc.pid, signal.SIGUSR1)
+
+
+if __name__ == "__main__":
+    Supervisor().run()
@@ -14,17 +14,41 @@ __last_updated__ = "2025-01-27"
 from config.settings import *
 from config.database import *
 from utils.validators import InputValidator
+from utils.woocommerce import WooCommerceClient
+from utils.product_cache import ProductCache
+from utils.catalog import CatalogMirror
+from utils.circuit_breaker import CircuitBreaker, CircuitOpenError
+from utils.async_db import AsyncDatabase
+from utils.cart_cache import CartCache
+from utils.debounce import EditDebouncer
+from utils.photo_cache import PhotoIdCache
+from utils.product_store import ProductStore
+from utils.image_cache import ImageCache
+from utils.callback_router import CallbackRouter, product_index_payload
+from utils.update_processor import PerUserUpdateProcessor
+from utils.state_store import SQLitePersistence
+from utils.idle_sweeper import IdleSweeper, approximate_size
+from utils.checkout import CheckoutService
+from utils.admin_outbox import AdminOutbox
+from utils.reply_composer import MAX_MESSAGE_LENGTH, ReplyComposer
 # Rate limiting temporarily removed to avoid issues
 # from utils.rate_limiter import RateLimiter, user_action_store
+import os
 import time
+import functools
+import hashlib
+import importlib.util
+import socket
 
 # Import Telegram libraries
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, InputMediaPhoto
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, InputMediaPhoto, Message
+from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, TypeHandler, filters
+from telegram.error import BadRequest
+from telegram.helpers import escape_markdown
 
-# Import WooCommerce function
-import requests
-from requests.auth import HTTPBasicAuth
+# Import async HTTP client used for WooCommerce
+import asyncio
+import httpx
 
 # Import Persian date library
 try:
@@ -94,54 +118,306 @@ def create_back_to_post_button(context):
         # Fallback: direct link to channel when no specific post
         return InlineKeyboardButton("🛒 ادامه خرید", url="https://t.me/hom_plast")
 
-def fetch_product_from_woocommerce(sku: str):
-    """Fetch product from WooCommerce API"""
+# config.database calls run on a bounded thread pool, never on the event loop
+DB_MAX_WORKERS = int(os.getenv('DB_MAX_WORKERS', '8'))
+DB_SLOW_QUERY_MS = int(os.getenv('DB_SLOW_QUERY_MS', '500'))
+db = AsyncDatabase({
+    'get_user_cart': get_user_cart,
+    'add_to_cart': add_to_cart,
+    'update_cart_quantity': update_cart_quantity,
+    'remove_from_cart': remove_from_cart,
+    'clear_user_cart': clear_user_cart,
+    'create_order': create_order,
+    'save_user': save_user,
+    'get_user_info': get_user_info,
+    'get_user_orders': get_user_orders,
+    'update_user_name': update_user_name,
+    'update_user_phone': update_user_phone,
+    'save_product_to_db': save_product_to_db,
+}, max_workers=DB_MAX_WORKERS, slow_query_ms=DB_SLOW_QUERY_MS)
+
+# Per-user cart cache with write-through to config.database
+cart_cache = CartCache(
+    db.get_user_cart, db.add_to_cart, db.update_cart_quantity, db.remove_from_cart, db.clear_user_cart
+)
+
+def place_order(user_id, cart_items, customer_name, customer_phone):
+    """Create the order and empty the cart in one database job"""
+    order_id = create_order(user_id, cart_items, customer_name=customer_name, customer_phone=customer_phone)
+    if order_id:
+        try:
+            clear_user_cart(user_id)
+        except Exception as e:
+            # The order exists; a repeated checkout of this cart returns it and clears again
+            logger.error(f"Order {order_id} placed but cart of user {user_id} not cleared: {e}")
+    return order_id
+
+async def place_order_async(user_id, cart_items, customer_name, customer_phone):
+    order_id = await db.run(place_order, user_id, cart_items, customer_name, customer_phone)
+    if order_id:
+        cart_cache.invalidate(user_id)
+    return order_id
+
+async def latest_order_id(user_id):
+    orders = await db.get_user_orders(user_id)
+    return max((order['order_id'] for order in orders or []), default=None)
+
+async def find_order(user_id, cart_items, after_order_id):
+    """An order newer than after_order_id with the cart's item count and total"""
+    total = sum(float(item.get('price') or 0) * item['quantity'] for item in cart_items)
+    for order in sorted(await db.get_user_orders(user_id) or [], key=lambda o: o['order_id']):
+        if after_order_id is not None and order['order_id'] <= after_order_id:
+            continue
+        if order.get('item_count') == len(cart_items) \
+                and abs(float(order.get('total_amount') or 0) - total) < 1:
+            return order['order_id']
+    return None
+
+# Every checkout path places orders through here, at most once per cart
+checkout_service = CheckoutService(
+    place_order_async,
+    latest_order_id,
+    find_order,
+    path=os.getenv('CHECKOUT_DB_PATH', 'checkout.db'),
+    ttl=int(os.getenv('CHECKOUT_KEY_TTL', '3600')),
+)
+
+# Admin notifications are queued here and delivered by a background worker
+admin_outbox = AdminOutbox(
+    path=os.getenv('ADMIN_OUTBOX_DB_PATH', 'admin_outbox.db'),
+    min_interval=float(os.getenv('ADMIN_OUTBOX_INTERVAL', '3')),
+    max_attempts=int(os.getenv('ADMIN_OUTBOX_MAX_ATTEMPTS', '8')),
+)
+
+# Shared pooled WooCommerce client (keep-alive, gzip, per-call timeouts)
+wc_client = WooCommerceClient(WC_URL, WC_CONSUMER_KEY, WC_CONSUMER_SECRET, timeout=5)
+
+async def probe_woocommerce():
+    """Cheapest possible request to check whether WooCommerce is back"""
+    await wc_client.get("/products", params={'per_page': 1, '_fields': 'id'}, timeout=5)
+
+# Fail fast while WooCommerce is down or very slow
+wc_breaker = CircuitBreaker(
+    "WooCommerce",
+    probe=probe_woocommerce,
+    failure_threshold=int(os.getenv('WC_BREAKER_FAILURES', '5')),
+    slow_call_seconds=float(os.getenv('WC_BREAKER_SLOW_SECONDS', '2.5')),
+    probe_interval=int(os.getenv('WC_BREAKER_PROBE_INTERVAL', '15')),
+)
+
+def parse_woocommerce_product(product, sku):
+    """Convert a raw WooCommerce product dict into the bot's product_info dict"""
+    name = product.get('name', f'Product {sku}')
+    price = float(product.get('regular_price', 0))
+
+    stock_status = product.get('stock_status', 'outofstock')
+    stock_quantity = product.get('stock_quantity', 0)
+    manage_stock = product.get('manage_stock', False)
+    in_stock = stock_status == 'instock'
+
+    if price <= 30000:
+        min_quantity = 12
+    elif 30000 < price <= 100000:
+        min_quantity = 6
+    else:
+        min_quantity = 1
+
+    # Get product images
+    images = []
+    if product.get('images'):
+        for img in product.get('images', []):
+            if img.get('src'):
+                images.append(img.get('src'))
+
+    return {
+        'product_id': sku,
+        'wc_id': product.get('id'),
+        'name': name,
+        'price': price,
+        'min_quantity': min_quantity,
+        'in_stock': in_stock,
+        'stock_quantity': stock_quantity,
+        'manage_stock': manage_stock,
+        'images': images  # List of image URLs
+    }
+
+async def fetch_product_from_woocommerce(sku: str, timeout=None):
+    """Fetch product from WooCommerce API.
+
+    Returns None for unknown SKUs and for products whose data can't be used;
+    network and HTTP errors (including httpx.TimeoutException and non-JSON
+    responses) and CircuitOpenError are raised so they are never cached as
+    "not found".
+    """
+    product = await wc_breaker.call(wc_client.get_product_by_sku, sku, timeout=timeout)
+    if not product:
+        return None
     try:
-        url = f"{WC_URL}/wp-json/wc/v3/products"
-        auth = HTTPBasicAuth(WC_CONSUMER_KEY, WC_CONSUMER_SECRET)
-        response = requests.get(url, params={'sku': sku}, auth=auth, timeout=5)
-
-        if response.status_code == 200:
-            products = response.json()
-            if products and len(products) > 0:
-                product = products[0]
-                name = product.get('name', f'Product {sku}')
-                price = float(product.get('regular_price', 0))
-
-                stock_status = product.get('stock_status', 'outofstock')
-                stock_quantity = product.get('stock_quantity', 0)
-                manage_stock = product.get('manage_stock', False)
-                in_stock = stock_status == 'instock'
-
-                if price <= 30000:
-                    min_quantity = 12
-                elif 30000 < price <= 100000:
-                    min_quantity = 6
-                else:
-                    min_quantity = 1
-
-                # Get product images
-                images = []
-                if product.get('images'):
-                    for img in product.get('images', []):
-                        if img.get('src'):
-                            images.append(img.get('src'))
-                
-                logger.info(f"Product: {name}, Price: {price}, Min: {min_quantity}, Stock: {stock_status}, Qty: {stock_quantity}, Images: {len(images)}")
-                return {
-                    'product_id': sku,
-                    'name': name,
-                    'price': price,
-                    'min_quantity': min_quantity,
-                    'in_stock': in_stock,
-                    'stock_quantity': stock_quantity,
-                    'manage_stock': manage_stock,
-                    'images': images  # List of image URLs
-                }
+        product_info = parse_woocommerce_product(product, sku)
+    except (ValueError, TypeError) as e:
+        logger.error(f"Unusable WooCommerce data for product {sku}: {e}")
         return None
-    except Exception as e:
-        logger.error(f"Error: {e}")
+    logger.info(f"Product: {product_info['name']}, Price: {product_info['price']}, Min: {product_info['min_quantity']}, In stock: {product_info['in_stock']}, Qty: {product_info['stock_quantity']}, Images: {len(product_info['images'])}")
+    return product_info
+
+# Product cache settings (seconds), overridable from the environment
+PRODUCT_CACHE_TTL = int(os.getenv('PRODUCT_CACHE_TTL', '60'))
+PRODUCT_CACHE_STALE_TTL = int(os.getenv('PRODUCT_CACHE_STALE_TTL', '600'))
+PRODUCT_CACHE_NEGATIVE_TTL = int(os.getenv('PRODUCT_CACHE_NEGATIVE_TTL', '30'))
+PRODUCT_CACHE_SIZE = int(os.getenv('PRODUCT_CACHE_SIZE', '1000'))
+
+product_cache = ProductCache(
+    fetch_product_from_woocommerce,
+    ttl=PRODUCT_CACHE_TTL,
+    stale_ttl=PRODUCT_CACHE_STALE_TTL,
+    negative_ttl=PRODUCT_CACHE_NEGATIVE_TTL,
+    maxsize=PRODUCT_CACHE_SIZE,
+)
+
+# Local catalog mirror, synced in the background from WooCommerce
+CATALOG_SYNC_ENABLED = os.getenv('CATALOG_SYNC_ENABLED', '1') == '1'
+CATALOG_DB_PATH = os.getenv('CATALOG_DB_PATH', 'catalog.db')
+CATALOG_SYNC_INTERVAL = int(os.getenv('CATALOG_SYNC_INTERVAL', '60'))
+CATALOG_FULL_SYNC_INTERVAL = int(os.getenv('CATALOG_FULL_SYNC_INTERVAL', str(6 * 3600)))
+
+def save_products_to_db(products):
+    """Write synced catalog products to the main database"""
+    for product_info in products:
+        try:
+            save_product_to_db(product_info)
+        except Exception as e:
+            logger.error(f"Error saving product {product_info.get('product_id')} to database: {e}")
+
+async def store_products(products):
+    """Save products on the database pool and drop the carts that show old data"""
+    await db.run(save_products_to_db, products)
+    # Cached carts carry product names and prices from the database
+    cart_cache.invalidate_all()
+
+def forget_removed_products(skus):
+    """Products left the shop: don't serve them from the product cache either"""
+    for sku in skus:
+        product_cache.invalidate(sku)
+
+catalog = CatalogMirror(
+    wc_client,
+    parse_woocommerce_product,
+    path=CATALOG_DB_PATH,
+    on_products=store_products,
+    on_removed=forget_removed_products,
+)
+
+async def get_product(sku: str):
+    """Get product info by SKU: local catalog mirror first, then the product cache.
+
+    While WooCommerce is unreachable the last known data is returned with
+    'possibly_stale' set instead of failing. The flag is also set for a
+    cached entry past its TTL and whenever the breaker is not closed.
+    """
+    woocommerce_down = wc_breaker.state != wc_breaker.CLOSED
+    product_info = catalog.get(sku)
+    if product_info is not None:
+        if woocommerce_down:
+            return {**product_info, 'possibly_stale': True}
+        return product_info
+    try:
+        product_info = await product_cache.get(sku)
+        if product_info is not None and (woocommerce_down or product_cache.is_stale(sku)):
+            return {**product_info, 'possibly_stale': True}
+        return product_info
+    except (httpx.HTTPError, CircuitOpenError) as e:
+        last_known = product_cache.peek(sku)
+        if last_known is None:
+            raise
+        logger.warning(f"Serving last known data for product {sku}: {e}")
+        return {**last_known, 'possibly_stale': True}
+
+# One shared record per product; user_data keeps only the SKU ('current_sku')
+product_store = ProductStore(maxsize=int(os.getenv('PRODUCT_STORE_SIZE', '5000')))
+
+async def get_current_product(context):
+    """The product the user is choosing a quantity for, or None.
+
+    Re-fetched by SKU if the shared record was evicted or the bot restarted.
+    """
+    sku = context.user_data.get('current_sku')
+    if not sku:
         return None
+    product = product_store.get(sku)
+    if product is None:
+        try:
+            product_info = await get_product(sku)
+        except (httpx.HTTPError, CircuitOpenError) as e:
+            logger.warning(f"Could not reload current product {sku}: {e}")
+            return None
+        product = product_store.intern(product_info) if product_info else None
+    return product
+
+async def revalidate_cart(cart_items):
+    """Re-check price and stock of every cart line with one batched WooCommerce request.
+
+    Returns a list of conflict lines for the user (empty if the cart is still valid).
+    If WooCommerce can't be reached the cart is accepted as is; a product whose
+    data can't be parsed is reported as unavailable.
+    """
+    ids, skus = [], []
+    for item in cart_items:
+        sku = str(item['product_id'])
+        known = catalog.get(sku) or product_cache.peek(sku)
+        if known and known.get('wc_id'):
+            ids.append(known['wc_id'])
+        else:
+            skus.append(sku)
+    try:
+        raw_products = await wc_breaker.call(wc_client.get_products_batch, ids, skus, timeout=5)
+    except (httpx.HTTPError, CircuitOpenError) as e:
+        logger.warning(f"Skipping checkout revalidation: {e}")
+        return []
+
+    fresh = {}
+    for raw in raw_products:
+        sku = str(raw.get('sku') or '')
+        if not sku:
+            continue
+        try:
+            fresh[sku] = parse_woocommerce_product(raw, sku)
+        except (ValueError, TypeError) as e:
+            # Malformed product (e.g. empty price): reported below as unavailable
+            logger.warning(f"Checkout revalidation could not parse product {sku}: {e}")
+            continue
+        product_cache.put(sku, fresh[sku])
+        product_store.intern(fresh[sku])
+    # Every lookup path sees the checked stock and price, not the stale copies
+    # (the mirror writes changed products to the main database itself)
+    mirrored = set(await catalog.update(list(fresh.values())))
+
+    conflicts = []
+    for item in cart_items:
+        sku = str(item['product_id'])
+        name = item.get('product_name') or f"محصول {sku}"
+        product_info = fresh.get(sku)
+        if not product_info or not product_info['in_stock']:
+            conflicts.append(f"• {name}: ناموجود")
+            continue
+        if product_info['manage_stock'] and product_info['stock_quantity'] is not None \
+                and product_info['stock_quantity'] < item['quantity']:
+            conflicts.append(f"• {name}: فقط {product_info['stock_quantity']} عدد موجود است")
+        if item.get('price') is not None and float(item['price']) != product_info['price']:
+            conflicts.append(f"• {name}: قیمت جدید {product_info['price']:,.0f} تومان")
+
+    unmirrored = [info for sku, info in fresh.items() if sku not in mirrored]
+    if conflicts and unmirrored:
+        # Store the fresh prices so the edited cart shows them
+        await store_products(unmirrored)
+    return conflicts
+
+def format_cart_conflicts(conflicts):
+    """Format revalidation conflicts as one message"""
+    return (
+        "*⚠️ برخی از اقلام سبد خرید تغییر کرده‌اند:*\n\n"
+        + "\n".join(conflicts)
+        + "\n\nلطفاً سبد خرید را ویرایش کنید و دوباره تلاش کنید."
+    )
 
 def format_cart(cart_items):
     """Format cart items for display"""
@@ -185,12 +461,15 @@ def create_channel_button():
     keyboard = [[InlineKeyboardButton("📱 بازگشت به کانال", url="https://t.me/hom_plast")]]
     return InlineKeyboardMarkup(keyboard)
 
-def calculate_effective_quantity_limits(product_info, user_id, exclude_product_id=None):
+async def calculate_effective_quantity_limits(product_info, user_id, exclude_product_id=None):
     """
     Calculate effective min and max quantities based on product info and cart.
     Returns: (effective_min, effective_max, remaining_stock, current_cart_qty)
     """
     try:
+        # Prefer the latest stock and price from the local catalog mirror
+        product_info = catalog.get(product_info.get('product_id', '')) or product_info
+
         # Calculate original minimum based on price
         product_price = float(product_info.get('price', 0))
         if product_price <= 30000:
@@ -200,22 +479,15 @@ def calculate_effective_quantity_limits(product_info, user_id, exclude_product_i
         else:
             original_min = 1
         
-        # Get current quantity in cart for this product
+        # Get current quantity in cart for this product (from the cart cache, no DB read)
         current_cart_qty = 0
-        cart_items = get_user_cart(user_id)
         other_cart_qty = 0
-        
-        if cart_items:
-            for item in cart_items:
-                if item and isinstance(item, dict):
-                    item_product_id = str(item.get('product_id', ''))
-                    product_id = str(product_info.get('product_id', ''))
-                    if item_product_id == product_id:
-                        # Skip the item being edited if exclude_product_id is provided
-                        if exclude_product_id and item_product_id == str(exclude_product_id):
-                            continue  # Skip the item being edited
-                        current_cart_qty = item.get('quantity', 0)
-                        other_cart_qty += item.get('quantity', 0)
+        product_id = str(product_info.get('product_id', ''))
+        item = await cart_cache.get_item(user_id, product_id)
+        # Skip the item being edited if exclude_product_id is provided
+        if item and not (exclude_product_id and product_id == str(exclude_product_id)):
+            current_cart_qty = item.get('quantity', 0)
+            other_cart_qty += item.get('quantity', 0)
         
         # Calculate effective min and max based on stock
         if product_info.get('manage_stock') and product_info.get('stock_quantity'):
@@ -316,6 +588,8 @@ def format_product_with_quantity(product_info, current_quantity, effective_min,
             f"*🔢 تعداد انتخاب شده: {current_quantity}*\n\n"
             f"از دکمه‌های زیر برای تغییر تعداد استفاده کنید یا تعداد را تایپ کنید:"
         )
+        if product_info.get('possibly_stale'):
+            message += "\n\n⚠️ قیمت و موجودی ممکن است به‌روز نباشد."
         return message
     except Exception as e:
         logger.error(f"Error formatting product message: {e}", exc_info=True)
@@ -327,12 +601,112 @@ def format_product_with_quantity(product_info, current_quantity, effective_min,
             f"از دکمه‌های زیر برای تغییر تعداد استفاده کنید:"
         )
 
+# Telegram file_ids of product images already uploaded once
+photo_ids = PhotoIdCache(path=os.getenv('PHOTO_ID_DB_PATH', 'photo_ids.db'))
+
+# Downsized product images, uploaded by the bot instead of fetched by Telegram
+IMAGE_CACHE_DIR = os.getenv('IMAGE_CACHE_DIR', 'image_cache')
+IMAGE_CACHE_MAX_MB = int(os.getenv('IMAGE_CACHE_MAX_MB', '200'))
+IMAGE_MAX_SIDE = int(os.getenv('IMAGE_MAX_SIDE', '1280'))
+IMAGE_JPEG_QUALITY = int(os.getenv('IMAGE_JPEG_QUALITY', '85'))
+GALLERY_PREFETCH = int(os.getenv('GALLERY_PREFETCH', '2'))
+image_cache = ImageCache(
+    directory=IMAGE_CACHE_DIR,
+    max_bytes=IMAGE_CACHE_MAX_MB * 1024 * 1024,
+    max_side=IMAGE_MAX_SIDE,
+    quality=IMAGE_JPEG_QUALITY,
+)
+
+async def send_cached_photo(url, send):
+    """Send or edit a photo by cached file_id, then optimised bytes, then the image URL.
+
+    send: callable(photo) returning the Telegram call's coroutine; the
+    file_id of the resulting message is cached for the URL.
+    """
+    file_id = photo_ids.get(url)
+    if file_id:
+        try:
+            return await send(file_id)
+        except BadRequest as e:
+            if 'not modified' in str(e).lower():
+                raise
+            logger.warning(f"Cached file_id for {url} rejected, re-sending image: {e}")
+            await photo_ids.invalidate([url])
+    result = None
+    data = await image_cache.get(url)
+    if data:
+        try:
+            result = await send(data)
+        except BadRequest as e:
+            if 'not modified' in str(e).lower():
+                raise
+            logger.warning(f"Optimised upload of {url} rejected, sending URL: {e}")
+            await image_cache.discard([url])
+    if result is None:
+        result = await send(url)
+    if isinstance(result, Message) and result.photo:
+        await photo_ids.put(url, result.photo[-1].file_id)
+    return result
+
+def prefetch_gallery(images, index):
+    """Warm the image cache for the next gallery images not yet uploaded to Telegram"""
+    upcoming = images[index + 1:index + 1 + GALLERY_PREFETCH]
+    image_cache.prefetch(url for url in upcoming if url not in photo_ids.file_ids)
+
+# Rapid ➕/➖ taps edit the product message at most once per window
+QUANTITY_RENDER_WINDOW = float(os.getenv('QUANTITY_RENDER_WINDOW', '0.7'))
+quantity_debouncer = EditDebouncer(window=QUANTITY_RENDER_WINDOW)
+
+async def render_quantity_message(context, message, product_id):
+    """Edit the message of product_id to show the quantity currently stored in user_data"""
+    user_data = context.user_data
+    if not user_data.get('awaiting_quantity') or user_data.get('awaiting_quantity_typing'):
+        return  # Flow finished, cancelled or switched to typing before the edit was due
+    if str(user_data.get('current_sku')) != str(product_id):
+        return  # Another product was opened; user_data no longer describes this message
+    product_info = await get_current_product(context)
+    if not product_info:
+        return
+    
+    current_quantity = user_data.get('current_quantity', 1)
+    effective_min = user_data.get('effective_min', 1)
+    effective_max = user_data.get('effective_max', 999999)
+    images = product_info.images
+    
+    text = format_product_with_quantity(product_info, current_quantity, effective_min, effective_max)
+    keyboard = create_quantity_keyboard(
+        product_info['product_id'], current_quantity, effective_min, effective_max,
+        image_index=user_data.get('current_image_index', 0),
+        total_images=len(images)
+    )
+    try:
+        if message.photo:
+            await context.bot.edit_message_caption(
+                chat_id=message.chat_id,
+                message_id=message.message_id,
+                caption=text,
+                reply_markup=keyboard,
+                parse_mode='Markdown'
+            )
+        else:
+            await context.bot.edit_message_text(
+                text,
+                chat_id=message.chat_id,
+                message_id=message.message_id,
+                reply_markup=keyboard,
+                parse_mode='Markdown'
+            )
+    except BadRequest as e:
+        # Taps that net out to the displayed quantity leave nothing to change
+        if 'not modified' not in str(e).lower():
+            raise
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /start command with validation"""
     user = update.effective_user
 
     # Save user info
-    save_user(user.id, user.username, user.first_name, user.last_name)
+    await db.save_user(user.id, user.username, user.first_name, user.last_name)
 
     # Log for debugging
     logger.info(f"Start command called with args: {context.args}")
@@ -394,8 +768,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             try:
                 # Try to fetch product from WooCommerce
                 try:
-                    product_info = fetch_product_from_woocommerce(clean_sku)
-                except requests.exceptions.Timeout:
+                    product_info = await get_product(clean_sku)
+                except (httpx.TimeoutException, CircuitOpenError):
                     raise TimeoutError("WooCommerce API timeout")
                 except Exception as e:
                     logger.error(f"Error fetching product {clean_sku} from WooCommerce: {e}")
@@ -421,20 +795,22 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                             parse_mode='Markdown'
                         )
                     else:
-                        # Try to save product to database
-                        try:
-                            save_product_to_db(product_info)
-                        except Exception as e:
-                            logger.error(f"Error saving product to database: {e}")
-                            # Continue anyway - database save failure shouldn't block user
-
-                        context.user_data['current_product'] = product_info
+                        # Save product to database unless the catalog sync already did
+                        if not catalog.has(clean_sku):
+                            try:
+                                await db.save_product_to_db(product_info)
+                            except Exception as e:
+                                logger.error(f"Error saving product to database: {e}")
+                                # Continue anyway - database save failure shouldn't block user
+
+                        product_info = product_store.intern(product_info)
+                        context.user_data['current_sku'] = product_info.product_id
                         context.user_data['awaiting_quantity'] = True
                         
                         try:
                             # Calculate effective min/max quantities
                             user_id = update.effective_user.id
-                            effective_min, effective_max, remaining_stock, current_cart_qty = calculate_effective_quantity_limits(
+                            effective_min, effective_max, remaining_stock, current_cart_qty = await calculate_effective_quantity_limits(
                                 product_info, user_id
                             )
                             
@@ -450,8 +826,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                             )
 
                             # Get product images
-                            images = product_info.get('images', [])
-                            context.user_data['product_images'] = images
+                            images = product_info.images
+                            changed_images = await photo_ids.track_product_images(product_info['product_id'], images)
+                            if changed_images:
+                                await image_cache.discard(changed_images)
                             context.user_data['current_image_index'] = 0
                             
                             # Create quantity keyboard with image gallery if multiple images
@@ -466,13 +844,17 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
                             
                             # Send product with image if available
                             if images and len(images) > 0:
-                                await context.bot.send_photo(
-                                    chat_id=update.effective_user.id,
-                                    photo=images[0],
-                                    caption=message,
-                                    reply_markup=keyboard,
-                                    parse_mode='Markdown'
+                                await send_cached_photo(
+                                    images[0],
+                                    lambda photo: context.bot.send_photo(
+                                        chat_id=update.effective_user.id,
+                                        photo=photo,
+                                        caption=message,
+                                        reply_markup=keyboard,
+                                        parse_mode='Markdown'
+                                    )
                                 )
+                                prefetch_gallery(images, 0)
                             else:
                                 await context.bot.send_message(
                                     chat_id=update.effective_user.id,
@@ -584,7 +966,7 @@ async def handle_quantity(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         # Get product info from WooCommerce to check stock
         try:
-            product_info = fetch_product_from_woocommerce(product_id)
+            product_info = await get_product(product_id)
         except Exception as e:
             logger.error(f"Error fetching product {product_id} for quantity update: {e}")
             await update.message.reply_text("**❌ خطا در دریافت اطلاعات محصول.**", parse_mode='Markdown')
@@ -608,7 +990,7 @@ async def handle_quantity(update: Update, context: ContextTypes.DEFAULT_TYPE):
             available_stock = product_info['stock_quantity']
 
             # Get OTHER items in cart (excluding the one being edited)
-            cart_items = get_user_cart(user_id)
+            cart_items = await cart_cache.get_cart(user_id)
             other_cart_qty = 0
             for item in cart_items:
                 if str(item['product_id']) == str(product_id):
@@ -650,10 +1032,10 @@ async def handle_quantity(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 )
                 return
 
-        if update_cart_quantity(user_id, product_id, clean_quantity):
+        if await cart_cache.update_quantity(user_id, product_id, clean_quantity):
             context.user_data['awaiting_new_quantity'] = False
             context.user_data.pop('editing_product_id', None)
-            cart_items = get_user_cart(user_id)
+            cart_items = await cart_cache.get_cart(user_id)
             cart_text = format_cart(cart_items)
 
             keyboard = create_cart_keyboard(context)
@@ -677,7 +1059,7 @@ async def handle_quantity(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(f"**❌ {error_msg}**", parse_mode='Markdown')
         return
 
-    product_info = context.user_data.get('current_product')
+    product_info = await get_current_product(context)
     if not product_info:
         await update.message.reply_text("**❌ خطا!**", parse_mode='Markdown')
         context.user_data.clear()
@@ -686,7 +1068,7 @@ async def handle_quantity(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     
     # Calculate effective min/max using the helper function
-    effective_min, effective_max, remaining_stock, current_cart_qty = calculate_effective_quantity_limits(
+    effective_min, effective_max, remaining_stock, current_cart_qty = await calculate_effective_quantity_limits(
         product_info, user_id
     )
     
@@ -716,7 +1098,7 @@ async def handle_quantity(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # Get current image index
         current_image_index = context.user_data.get('current_image_index', 0)
-        images = context.user_data.get('product_images', [])
+        images = product_info.images
         
         # Show updated product with quantity buttons
         message = format_product_with_quantity(
@@ -730,11 +1112,14 @@ async def handle_quantity(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # Send with image if available, otherwise text
         if images and len(images) > 0:
-            await update.message.reply_photo(
-                photo=images[current_image_index],
-                caption=message,
-                reply_markup=keyboard,
-                parse_mode='Markdown'
+            await send_cached_photo(
+                images[current_image_index],
+                lambda photo: update.message.reply_photo(
+                    photo=photo,
+                    caption=message,
+                    reply_markup=keyboard,
+                    parse_mode='Markdown'
+                )
             )
         else:
             await update.message.reply_text(message, reply_markup=keyboard, parse_mode='Markdown')
@@ -742,9 +1127,11 @@ async def handle_quantity(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Try to add to cart (original flow for direct typing)
-    if add_to_cart(user_id, product_info['product_id'], clean_quantity):
+    # Before the cart changes, so a checkout still running can't record its key afterwards
+    await checkout_service.forget(user_id)
+    if await cart_cache.add(user_id, product_info['product_id'], clean_quantity):
         context.user_data['awaiting_quantity'] = False
-        cart_items = get_user_cart(user_id)
+        cart_items = await cart_cache.get_cart(user_id)
         cart_text = format_cart(cart_items)
 
         keyboard = create_cart_keyboard(context)
@@ -755,138 +1142,156 @@ async def handle_quantity(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode='Markdown'
         )
 
-async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle button callbacks"""
+async def cb_edit_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Ask for a new name"""
+    query = update.callback_query
+    user_id = update.effective_user.id
+    try:
+        await query.message.delete()
+    except Exception:
+        pass
+    await context.bot.send_message(
+        chat_id=user_id,
+        text="**✏️ نام جدید خود را وارد کنید:**",
+        parse_mode='Markdown'
+    )
+    context.user_data['awaiting_name'] = True
+    context.user_data['editing_profile'] = True
+
+async def cb_edit_phone(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Ask for a new phone number"""
     query = update.callback_query
-    await query.answer()
     user_id = update.effective_user.id
+    try:
+        await query.message.delete()
+    except Exception:
+        pass
+    keyboard = [[KeyboardButton("📱 ارسال شماره", request_contact=True)]]
+    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
+    await context.bot.send_message(
+        chat_id=user_id,
+        text="**✏️ شماره جدید خود را وارد کنید:**\n(می‌توانید تایپ کنید یا از دکمه استفاده کنید)",
+        reply_markup=reply_markup,
+        parse_mode='Markdown'
+    )
+    context.user_data['editing_phone'] = True
+    context.user_data['awaiting_phone'] = True
 
-    if query.data == "edit_name":
-        try:
-            await query.message.delete()
-        except Exception:
-            pass
-        await context.bot.send_message(
-            chat_id=user_id,
-            text="**✏️ نام جدید خود را وارد کنید:**",
-            parse_mode='Markdown'
-        )
-        context.user_data['awaiting_name'] = True
-        context.user_data['editing_profile'] = True
-        return
+async def cb_cancel_edit(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Leave profile editing"""
+    query = update.callback_query
+    user_id = update.effective_user.id
+    try:
+        await query.message.delete()
+    except Exception:
+        pass
+    reply_markup = create_main_menu_keyboard()
+    await context.bot.send_message(
+        chat_id=user_id,
+        text="**✅ بازگشت به منو**",
+        reply_markup=reply_markup,
+        parse_mode='Markdown'
+    )
 
-    elif query.data == "edit_phone":
-        try:
-            await query.message.delete()
-        except Exception:
-            pass
-        keyboard = [[KeyboardButton("📱 ارسال شماره", request_contact=True)]]
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
-        await context.bot.send_message(
-            chat_id=user_id,
-            text="**✏️ شماره جدید خود را وارد کنید:**\n(می‌توانید تایپ کنید یا از دکمه استفاده کنید)",
-            reply_markup=reply_markup,
-            parse_mode='Markdown'
-        )
-        context.user_data['editing_phone'] = True
-        context.user_data['awaiting_phone'] = True
-        return
+async def cb_add_more(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Point the user back to the channel to add products"""
+    query = update.callback_query
+    await query.edit_message_text(
+        "**✅ برای افزودن محصول، به کانال مراجعه کنید.**",
+        parse_mode='Markdown'
+    )
 
-    elif query.data == "cancel_edit":
-        try:
-            await query.message.delete()
-        except Exception:
-            pass
-        reply_markup = create_main_menu_keyboard()
-        await context.bot.send_message(
-            chat_id=user_id,
-            text="**✅ بازگشت به منو**",
-            reply_markup=reply_markup,
-            parse_mode='Markdown'
-        )
+async def cb_edit_cart(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """List cart items to pick one for editing"""
+    query = update.callback_query
+    user_id = update.effective_user.id
+    cart_items = await cart_cache.get_cart(user_id)
+    if not cart_items:
+        await query.edit_message_text("**🛒 سبد خالی است.**", parse_mode='Markdown')
         return
+    keyboard = []
+    for item in cart_items:
+        product_name = item.get('product_name') or f"محصول {item['product_id']}"
+        keyboard.append([InlineKeyboardButton(f"✏️ {product_name}", callback_data=f"edit_{item['product_id']}")])
+    keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data="back_to_cart")])
+    await query.edit_message_text(
+        "**✏️ محصول مورد نظر را انتخاب کنید:**",
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        parse_mode='Markdown'
+    )
 
-    if query.data == "add_more":
-        await query.edit_message_text(
-            "**✅ برای افزودن محصول، به کانال مراجعه کنید.**",
-            parse_mode='Markdown'
-        )
-    elif query.data == "edit_cart":
-        cart_items = get_user_cart(user_id)
-        if not cart_items:
-            await query.edit_message_text("**🛒 سبد خالی است.**", parse_mode='Markdown')
-            return
-        keyboard = []
-        for item in cart_items:
-            product_name = item.get('product_name') or f"محصول {item['product_id']}"
-            keyboard.append([InlineKeyboardButton(f"✏️ {product_name}", callback_data=f"edit_{item['product_id']}")])
-        keyboard.append([InlineKeyboardButton("🔙 بازگشت", callback_data="back_to_cart")])
+async def cb_edit_item(update: Update, context: ContextTypes.DEFAULT_TYPE, product_id):
+    """Offer quantity change or removal for one cart item"""
+    query = update.callback_query
+    keyboard = [
+        [InlineKeyboardButton("✏️ تغییر تعداد", callback_data=f"change_qty_{product_id}")],
+        [InlineKeyboardButton("🗑 حذف محصول", callback_data=f"remove_{product_id}")],
+        [InlineKeyboardButton("🔙 بازگشت", callback_data="edit_cart")]
+    ]
+    await query.edit_message_text("**انتخاب کنید:**", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+
+async def cb_change_quantity(update: Update, context: ContextTypes.DEFAULT_TYPE, product_id):
+    """Ask for a new quantity of a cart item"""
+    query = update.callback_query
+    user_id = update.effective_user.id
+    context.user_data['editing_product_id'] = product_id
+    context.user_data['awaiting_new_quantity'] = True
+
+    keyboard = [[KeyboardButton("🔙 بازگشت به سبد")]]
+    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
+    reply = ReplyComposer(functools.partial(context.bot.send_message, user_id))
+    reply.side(query.edit_message_text("**✏️ تعداد جدید را وارد کنید:**", parse_mode='Markdown'))
+    reply.add("برای لغو و بازگشت به سبد خرید، دکمه زیر را بزنید:", reply_markup=reply_markup, parse_mode=None)
+    await reply.flush()
+
+async def cb_remove_item(update: Update, context: ContextTypes.DEFAULT_TYPE, product_id):
+    """Remove an item from the cart"""
+    query = update.callback_query
+    user_id = update.effective_user.id
+    await cart_cache.remove(user_id, product_id)
+    cart_items = await cart_cache.get_cart(user_id)
+    if cart_items:
+        cart_text = format_cart(cart_items)
+        keyboard = create_cart_keyboard(context)
         await query.edit_message_text(
-            "**✏️ محصول مورد نظر را انتخاب کنید:**",
+            f"*✅ حذف شد!*\n\n{cart_text}",
             reply_markup=InlineKeyboardMarkup(keyboard),
             parse_mode='Markdown'
         )
-    elif query.data.startswith("edit_"):
-        product_id = query.data.replace("edit_", "")
-        keyboard = [
-            [InlineKeyboardButton("✏️ تغییر تعداد", callback_data=f"change_qty_{product_id}")],
-            [InlineKeyboardButton("🗑 حذف محصول", callback_data=f"remove_{product_id}")],
-            [InlineKeyboardButton("🔙 بازگشت", callback_data="edit_cart")]
-        ]
-        await query.edit_message_text("**انتخاب کنید:**", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
-    elif query.data.startswith("change_qty_"):
-        product_id = query.data.replace("change_qty_", "")
-        context.user_data['editing_product_id'] = product_id
-        context.user_data['awaiting_new_quantity'] = True
-
-        keyboard = [[KeyboardButton("🔙 بازگشت به سبد")]]
-        reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
-        await query.edit_message_text("**✏️ تعداد جدید را وارد کنید:**", parse_mode='Markdown')
-        await context.bot.send_message(
-            chat_id=user_id,
-            text="برای لغو و بازگشت به سبد خرید، دکمه زیر را بزنید:",
-            reply_markup=reply_markup
-        )
-    elif query.data.startswith("remove_"):
-        product_id = query.data.replace("remove_", "")
-        remove_from_cart(user_id, product_id)
-        cart_items = get_user_cart(user_id)
-        if cart_items:
-            cart_text = format_cart(cart_items)
-            keyboard = create_cart_keyboard(context)
-            await query.edit_message_text(
-                f"*✅ حذف شد!*\n\n{cart_text}",
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode='Markdown'
-            )
-        else:
-            # Cart is now empty → clear inline keyboard and show menus
-            try:
-                await query.edit_message_text("*🛒 سبد خالی شد.*", reply_markup=None, parse_mode='Markdown')
-            except Exception:
-                pass
-            await query.message.reply_text("*📱 بازگشت به کانال:*", reply_markup=create_channel_button(), parse_mode='Markdown')
-            reply_markup = create_main_menu_keyboard()
-            await query.message.reply_text("*منوی اصلی:*", reply_markup=reply_markup, parse_mode='Markdown')
-    elif query.data == "back_to_cart":
-        cart_items = get_user_cart(user_id)
-        if not cart_items:
-            # Cart is empty: clear inline keyboard and restore menus
-            try:
-                await query.edit_message_text("*🛒 سبد خالی شد.*", reply_markup=None, parse_mode='Markdown')
-            except Exception:
-                pass
-            await query.message.reply_text("*📱 بازگشت به کانال:*", reply_markup=create_channel_button(), parse_mode='Markdown')
-            reply_markup = create_main_menu_keyboard()
-            await query.message.reply_text("*منوی اصلی:*", reply_markup=reply_markup, parse_mode='Markdown')
-        else:
-            cart_text = format_cart(cart_items)
-            keyboard = create_cart_keyboard(context)
-            await query.edit_message_text(cart_text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
-    elif query.data == "cancel_product_add":
-        # Cancel product addition - same pattern as cart cancellation
-        context.user_data.clear()  # Clear all pending states including awaiting_quantity
-        
+    else:
+        # Cart is now empty → clear inline keyboard and show menus
+        reply = ReplyComposer(query.message.reply_text)
+        reply.side(query.edit_message_text("*🛒 سبد خالی شد.*", reply_markup=None, parse_mode='Markdown'),
+                   ignore_errors=True)
+        reply.add("*📱 بازگشت به کانال:*", reply_markup=create_channel_button())
+        reply.add("*منوی اصلی:*", reply_markup=create_main_menu_keyboard())
+        await reply.flush(ordered=False)
+
+async def cb_back_to_cart(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show the cart again"""
+    query = update.callback_query
+    user_id = update.effective_user.id
+    cart_items = await cart_cache.get_cart(user_id)
+    if not cart_items:
+        # Cart is empty: clear inline keyboard and restore menus
+        reply = ReplyComposer(query.message.reply_text)
+        reply.side(query.edit_message_text("*🛒 سبد خالی شد.*", reply_markup=None, parse_mode='Markdown'),
+                   ignore_errors=True)
+        reply.add("*📱 بازگشت به کانال:*", reply_markup=create_channel_button())
+        reply.add("*منوی اصلی:*", reply_markup=create_main_menu_keyboard())
+        await reply.flush(ordered=False)
+    else:
+        cart_text = format_cart(cart_items)
+        keyboard = create_cart_keyboard(context)
+        await query.edit_message_text(cart_text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+
+async def cb_cancel_product_add(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Cancel adding the current product"""
+    query = update.callback_query
+    # Cancel product addition - same pattern as cart cancellation
+    context.user_data.clear()  # Clear all pending states including awaiting_quantity
+    
+    async def mark_cancelled():
         # Check if message is a photo or text
         try:
             if query.message.photo:
@@ -906,435 +1311,402 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             except:
                 pass
             await query.message.reply_text("*❌ افزودن محصول لغو شد.*", parse_mode='Markdown')
-        
-        await query.message.reply_text("*📱 بازگشت به کانال:*", reply_markup=create_channel_button(), parse_mode='Markdown')
-        # Restore main menu
-        reply_markup = create_main_menu_keyboard()
-        await query.message.reply_text("*منوی اصلی:*", reply_markup=reply_markup, parse_mode='Markdown')
-    elif query.data.startswith("qty_dec_"):
-        # Decrease quantity
-        product_id = query.data.replace("qty_dec_", "")
-        product_info = context.user_data.get('current_product')
-        if not product_info or str(product_info['product_id']) != str(product_id):
-            await query.answer("❌ خطا در دریافت اطلاعات محصول", show_alert=True)
-            return
-        
-        current_quantity = context.user_data.get('current_quantity', 1)
-        effective_min = context.user_data.get('effective_min', 1)
-        effective_max = context.user_data.get('effective_max', 999999)
-        
-        # Decrease quantity
-        new_quantity = max(effective_min, current_quantity - 1)
-        context.user_data['current_quantity'] = new_quantity
-        
-        # Recalculate limits (in case stock changed)
-        user_id = update.effective_user.id
-        effective_min, effective_max, remaining_stock, _ = calculate_effective_quantity_limits(
-            product_info, user_id
-        )
-        context.user_data['effective_min'] = effective_min
-        context.user_data['effective_max'] = effective_max
-        
-        # Update message
-        message = format_product_with_quantity(
-            product_info, new_quantity, effective_min, effective_max, remaining_stock
-        )
-        keyboard = create_quantity_keyboard(product_id, new_quantity, effective_min, effective_max)
-        await query.edit_message_text(message, reply_markup=keyboard, parse_mode='Markdown')
-        await query.answer()
-    elif query.data.startswith("qty_inc_"):
-        # Increase quantity
-        product_id = query.data.replace("qty_inc_", "")
-        product_info = context.user_data.get('current_product')
-        if not product_info or str(product_info['product_id']) != str(product_id):
-            await query.answer("❌ خطا در دریافت اطلاعات محصول", show_alert=True)
-            return
-        
-        current_quantity = context.user_data.get('current_quantity', 1)
-        effective_min = context.user_data.get('effective_min', 1)
-        effective_max = context.user_data.get('effective_max', 999999)
-        
-        # Increase quantity
+
+    reply = ReplyComposer(query.message.reply_text)
+    reply.side(mark_cancelled())
+    reply.add("*📱 بازگشت به کانال:*", reply_markup=create_channel_button())
+    # Restore main menu
+    reply.add("*منوی اصلی:*", reply_markup=create_main_menu_keyboard())
+    await reply.flush(ordered=False)
+
+async def cb_step_quantity(update: Update, context: ContextTypes.DEFAULT_TYPE, product_id, increase):
+    """Decrease / increase quantity: state changes now, the message is re-rendered debounced"""
+    query = update.callback_query
+    product_info = await get_current_product(context)
+    if not product_info or str(product_info['product_id']) != str(product_id):
+        await query.answer("❌ خطا در دریافت اطلاعات محصول", show_alert=True)
+        return
+    
+    current_quantity = context.user_data.get('current_quantity', 1)
+    effective_min = context.user_data.get('effective_min', 1)
+    effective_max = context.user_data.get('effective_max', 999999)
+    
+    if increase:
         new_quantity = min(effective_max, current_quantity + 1)
-        context.user_data['current_quantity'] = new_quantity
-        
-        # Recalculate limits (in case stock changed)
-        user_id = update.effective_user.id
-        effective_min, effective_max, remaining_stock, _ = calculate_effective_quantity_limits(
-            product_info, user_id
-        )
-        context.user_data['effective_min'] = effective_min
-        context.user_data['effective_max'] = effective_max
-        
-        # Get current image index
-        current_image_index = context.user_data.get('current_image_index', 0)
-        images = context.user_data.get('product_images', [])
-        
-        # Update message
-        message = format_product_with_quantity(
-            product_info, new_quantity, effective_min, effective_max, remaining_stock
-        )
-        keyboard = create_quantity_keyboard(
-            product_id, new_quantity, effective_min, effective_max,
-            image_index=current_image_index,
-            total_images=len(images)
-        )
-        
-        # Update photo if images exist, otherwise update text
-        if images and len(images) > 0:
-            await query.edit_message_caption(
-                caption=message,
-                reply_markup=keyboard,
-                parse_mode='Markdown'
-            )
-        else:
-            await query.edit_message_text(message, reply_markup=keyboard, parse_mode='Markdown')
-        await query.answer()
-    elif query.data.startswith("img_prev_"):
-        # Navigate to previous image
-        # Format: img_prev_{product_id}_{index}
-        data = query.data.replace("img_prev_", "")
-        # Find last underscore (separates product_id from index)
-        last_underscore = data.rfind("_")
-        if last_underscore > 0:
-            product_id = data[:last_underscore]
-            current_index = int(data[last_underscore + 1:])
-            
-            product_info = context.user_data.get('current_product')
-            if not product_info or str(product_info['product_id']) != str(product_id):
-                await query.answer("❌ خطا در دریافت اطلاعات محصول", show_alert=True)
-                return
-            
-            images = context.user_data.get('product_images', [])
-            if not images or len(images) == 0:
-                await query.answer("⚠️ تصویری موجود نیست", show_alert=True)
-                return
-            
-            # Go to previous image
-            new_index = max(0, current_index - 1)
-            context.user_data['current_image_index'] = new_index
-            
-            # Get current quantity and limits
-            current_quantity = context.user_data.get('current_quantity', 1)
-            effective_min = context.user_data.get('effective_min', 1)
-            effective_max = context.user_data.get('effective_max', 999999)
-            user_id = update.effective_user.id
-            _, _, remaining_stock, _ = calculate_effective_quantity_limits(product_info, user_id)
-            
-            # Format message
-            message = format_product_with_quantity(
-                product_info, current_quantity, effective_min, effective_max, remaining_stock
-            )
-            
-            # Create keyboard
-            keyboard = create_quantity_keyboard(
-                product_id, current_quantity, effective_min, effective_max,
-                image_index=new_index,
-                total_images=len(images)
-            )
-            
-            # Update photo
-            await query.edit_message_media(
-                media=InputMediaPhoto(media=images[new_index], caption=message, parse_mode='Markdown'),
-                reply_markup=keyboard
-            )
-            await query.answer()
-    elif query.data.startswith("img_next_"):
-        # Navigate to next image
-        # Format: img_next_{product_id}_{index}
-        data = query.data.replace("img_next_", "")
-        # Find last underscore (separates product_id from index)
-        last_underscore = data.rfind("_")
-        if last_underscore > 0:
-            product_id = data[:last_underscore]
-            current_index = int(data[last_underscore + 1:])
-            
-            product_info = context.user_data.get('current_product')
-            if not product_info or str(product_info['product_id']) != str(product_id):
-                await query.answer("❌ خطا در دریافت اطلاعات محصول", show_alert=True)
-                return
-            
-            images = context.user_data.get('product_images', [])
-            if not images or len(images) == 0:
-                await query.answer("⚠️ تصویری موجود نیست", show_alert=True)
-                return
-            
-            # Go to next image
-            new_index = min(len(images) - 1, current_index + 1)
-            context.user_data['current_image_index'] = new_index
-            
-            # Get current quantity and limits
-            current_quantity = context.user_data.get('current_quantity', 1)
-            effective_min = context.user_data.get('effective_min', 1)
-            effective_max = context.user_data.get('effective_max', 999999)
-            user_id = update.effective_user.id
-            _, _, remaining_stock, _ = calculate_effective_quantity_limits(product_info, user_id)
-            
-            # Format message
-            message = format_product_with_quantity(
-                product_info, current_quantity, effective_min, effective_max, remaining_stock
-            )
-            
-            # Create keyboard
-            keyboard = create_quantity_keyboard(
-                product_id, current_quantity, effective_min, effective_max,
-                image_index=new_index,
-                total_images=len(images)
-            )
-            
-            # Update photo
-            await query.edit_message_media(
-                media=InputMediaPhoto(media=images[new_index], caption=message, parse_mode='Markdown'),
-                reply_markup=keyboard
-            )
-            await query.answer()
-    elif query.data == "img_info":
-        # Just show image info (no action needed)
-        await query.answer()
-    elif query.data == "qty_display":
-        # Just show current quantity (no action needed)
-        await query.answer()
-    elif query.data == "qty_min_reached":
-        await query.answer("⚠️ به حداقل تعداد رسیده‌اید", show_alert=True)
-    elif query.data == "qty_max_reached":
-        await query.answer("⚠️ به حداکثر تعداد رسیده‌اید", show_alert=True)
-    elif query.data.startswith("qty_add_cart_"):
-        # Add to cart with current quantity
-        product_id = query.data.replace("qty_add_cart_", "")
-        product_info = context.user_data.get('current_product')
-        if not product_info or str(product_info['product_id']) != str(product_id):
-            await query.answer("❌ خطا در دریافت اطلاعات محصول", show_alert=True)
-            return
-        
-        current_quantity = context.user_data.get('current_quantity', 1)
-        user_id = update.effective_user.id
-        
-        # Validate quantity one more time before adding
-        effective_min, effective_max, remaining_stock, current_cart_qty = calculate_effective_quantity_limits(
-            product_info, user_id
+    else:
+        new_quantity = max(effective_min, current_quantity - 1)
+    context.user_data['current_quantity'] = new_quantity
+    
+    # Recalculate limits (in case stock changed)
+    user_id = update.effective_user.id
+    effective_min, effective_max, remaining_stock, _ = await calculate_effective_quantity_limits(
+        product_info, user_id
+    )
+    context.user_data['effective_min'] = effective_min
+    context.user_data['effective_max'] = effective_max
+    
+    message = query.message
+    await quantity_debouncer.request(
+        (message.chat_id, message.message_id),
+        lambda: render_quantity_message(context, message, product_id)
+    )
+
+async def cb_gallery(update: Update, context: ContextTypes.DEFAULT_TYPE, product_id, index, step):
+    """Show the previous (step=-1) or next (step=1) image of the current product"""
+    query = update.callback_query
+    product_info = await get_current_product(context)
+    if not product_info or str(product_info['product_id']) != str(product_id):
+        await query.answer("❌ خطا در دریافت اطلاعات محصول", show_alert=True)
+        return
+    
+    images = product_info.images
+    if not images or len(images) == 0:
+        await query.answer("⚠️ تصویری موجود نیست", show_alert=True)
+        return
+    
+    new_index = min(len(images) - 1, max(0, index + step))
+    context.user_data['current_image_index'] = new_index
+    
+    # Get current quantity and limits
+    current_quantity = context.user_data.get('current_quantity', 1)
+    effective_min = context.user_data.get('effective_min', 1)
+    effective_max = context.user_data.get('effective_max', 999999)
+    user_id = update.effective_user.id
+    _, _, remaining_stock, _ = await calculate_effective_quantity_limits(product_info, user_id)
+    
+    # Format message
+    message = format_product_with_quantity(
+        product_info, current_quantity, effective_min, effective_max, remaining_stock
+    )
+    
+    # Create keyboard
+    keyboard = create_quantity_keyboard(
+        product_id, current_quantity, effective_min, effective_max,
+        image_index=new_index,
+        total_images=len(images)
+    )
+    
+    # Update photo
+    await send_cached_photo(
+        images[new_index],
+        lambda photo: query.edit_message_media(
+            media=InputMediaPhoto(media=photo, caption=message, parse_mode='Markdown'),
+            reply_markup=keyboard
         )
+    )
+    await query.answer()
+    # Warm the images the user is paging towards
+    if step > 0:
+        prefetch_gallery(images, new_index)
+    else:
+        prefetch_gallery(images[::-1], len(images) - 1 - new_index)
+
+async def cb_noop(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Informational buttons (image position, current quantity) need no action"""
+    query = update.callback_query
+    await query.answer()
+
+async def cb_min_reached(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """The quantity is already at its minimum"""
+    query = update.callback_query
+    await query.answer("⚠️ به حداقل تعداد رسیده‌اید", show_alert=True)
+
+async def cb_max_reached(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """The quantity is already at its maximum"""
+    query = update.callback_query
+    await query.answer("⚠️ به حداکثر تعداد رسیده‌اید", show_alert=True)
+
+async def cb_add_to_cart(update: Update, context: ContextTypes.DEFAULT_TYPE, product_id):
+    """Add the current product to the cart with the chosen quantity"""
+    query = update.callback_query
+    # Add to cart with current quantity
+    product_info = await get_current_product(context)
+    if not product_info or str(product_info['product_id']) != str(product_id):
+        await query.answer("❌ خطا در دریافت اطلاعات محصول", show_alert=True)
+        return
+    
+    current_quantity = context.user_data.get('current_quantity', 1)
+    user_id = update.effective_user.id
+    
+    # Validate quantity one more time before adding
+    effective_min, effective_max, remaining_stock, current_cart_qty = await calculate_effective_quantity_limits(
+        product_info, user_id
+    )
+    
+    # Check if quantity is valid
+    if current_quantity < effective_min:
+        await query.answer(f"❌ حداقل {effective_min} عدد باید انتخاب کنید", show_alert=True)
+        return
+    
+    if current_quantity > effective_max:
+        await query.answer(f"❌ حداکثر {effective_max} عدد می‌توانید انتخاب کنید", show_alert=True)
+        return
+    
+    # Add to cart
+    # Before the cart changes, so a checkout still running can't record its key afterwards
+    await checkout_service.forget(user_id)
+    if await cart_cache.add(user_id, product_info['product_id'], current_quantity):
+        context.user_data['awaiting_quantity'] = False
+        cart_items = await cart_cache.get_cart(user_id)
+        cart_text = format_cart(cart_items)
         
-        # Check if quantity is valid
-        if current_quantity < effective_min:
-            await query.answer(f"❌ حداقل {effective_min} عدد باید انتخاب کنید", show_alert=True)
-            return
-        
-        if current_quantity > effective_max:
-            await query.answer(f"❌ حداکثر {effective_max} عدد می‌توانید انتخاب کنید", show_alert=True)
-            return
+        keyboard = create_cart_keyboard(context)
+        reply_markup = InlineKeyboardMarkup(keyboard)
         
-        # Add to cart
-        if add_to_cart(user_id, product_info['product_id'], current_quantity):
-            context.user_data['awaiting_quantity'] = False
-            cart_items = get_user_cart(user_id)
-            cart_text = format_cart(cart_items)
-            
-            keyboard = create_cart_keyboard(context)
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            
-            # Cart should always be displayed as text message without product image
-            # If it's a photo message, edit caption first, then try to convert to text
-            # If it's a text message, just edit it
-            try:
-                if query.message.photo:
-                    # It's a photo message - first update caption, then try to convert to text
-                    # We'll use edit_message_media to convert photo to text
-                    try:
-                        # Try to convert photo message to text message using edit_message_media
-                        # This doesn't work directly, so we'll just update caption and keep photo
-                        # But user wants no image, so we'll delete and send new
-                        await query.edit_message_caption(
-                            caption=f"*✅ اضافه شد!*\n\n{cart_text}",
-                            reply_markup=reply_markup,
-                            parse_mode='Markdown'
-                        )
-                        # Now delete the photo message
-                        await query.message.delete()
-                        # Send new text message using context.bot.send_message (not reply_text to avoid triggering handlers)
-                        await context.bot.send_message(
-                            chat_id=user_id,
-                            text=f"*✅ اضافه شد!*\n\n{cart_text}",
-                            reply_markup=reply_markup,
-                            parse_mode='Markdown'
-                        )
-                    except Exception as e:
-                        # If editing caption fails, just delete and send new
-                        await query.message.delete()
-                        await context.bot.send_message(
-                            chat_id=user_id,
-                            text=f"*✅ اضافه شد!*\n\n{cart_text}",
-                            reply_markup=reply_markup,
-                            parse_mode='Markdown'
-                        )
-                else:
-                    # It's a text message - just edit it
-                    await query.edit_message_text(
-                        f"*✅ اضافه شد!*\n\n{cart_text}",
+        # Cart should always be displayed as text message without product image
+        # If it's a photo message, edit caption first, then try to convert to text
+        # If it's a text message, just edit it
+        try:
+            if query.message.photo:
+                # It's a photo message - first update caption, then try to convert to text
+                # We'll use edit_message_media to convert photo to text
+                try:
+                    # Try to convert photo message to text message using edit_message_media
+                    # This doesn't work directly, so we'll just update caption and keep photo
+                    # But user wants no image, so we'll delete and send new
+                    await query.edit_message_caption(
+                        caption=f"*✅ اضافه شد!*\n\n{cart_text}",
                         reply_markup=reply_markup,
                         parse_mode='Markdown'
                     )
-            except Exception as e:
-                logger.error(f"Error updating cart message: {e}", exc_info=True)
-                # If editing fails, try to delete and send new message
-                try:
+                    # Now delete the photo message
                     await query.message.delete()
-                except:
-                    pass
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=f"*✅ اضافه شد!*\n\n{cart_text}",
-                    reply_markup=reply_markup,
-                    parse_mode='Markdown'
-                )
-            
-            await query.answer("✅ به سبد خرید اضافه شد")
-        else:
-            await query.answer("❌ خطا در افزودن به سبد خرید", show_alert=True)
-    elif query.data.startswith("qty_type_"):
-        # Switch to typing mode
-        product_id = query.data.replace("qty_type_", "")
-        product_info = context.user_data.get('current_product')
-        if not product_info or str(product_info['product_id']) != str(product_id):
-            await query.answer("❌ خطا در دریافت اطلاعات محصول", show_alert=True)
-            return
-        
-        context.user_data['awaiting_quantity'] = True
-        context.user_data['awaiting_quantity_typing'] = True
-        
-        effective_min = context.user_data.get('effective_min', 1)
-        
-        message_text = (
-            f"*⌨️ تعداد را تایپ کنید:*\n\n"
-            f"*📊 حداقل:* {effective_min} عدد\n\n"
-            f"تعداد مورد نظر خود را وارد کنید:"
-        )
-        
-        # Check if message is a photo or text
-        try:
-            if query.message.photo:
-                # It's a photo message - edit caption
-                await query.edit_message_caption(
-                    caption=message_text,
-                    parse_mode='Markdown'
-                )
+                    # Send new text message using context.bot.send_message (not reply_text to avoid triggering handlers)
+                    await context.bot.send_message(
+                        chat_id=user_id,
+                        text=f"*✅ اضافه شد!*\n\n{cart_text}",
+                        reply_markup=reply_markup,
+                        parse_mode='Markdown'
+                    )
+                except Exception as e:
+                    # If editing caption fails, just delete and send new
+                    await query.message.delete()
+                    await context.bot.send_message(
+                        chat_id=user_id,
+                        text=f"*✅ اضافه شد!*\n\n{cart_text}",
+                        reply_markup=reply_markup,
+                        parse_mode='Markdown'
+                    )
             else:
-                # It's a text message
+                # It's a text message - just edit it
                 await query.edit_message_text(
-                    message_text,
+                    f"*✅ اضافه شد!*\n\n{cart_text}",
+                    reply_markup=reply_markup,
                     parse_mode='Markdown'
                 )
         except Exception as e:
-            # If editing fails, delete and send new message
+            logger.error(f"Error updating cart message: {e}", exc_info=True)
+            # If editing fails, try to delete and send new message
             try:
                 await query.message.delete()
             except:
                 pass
-            await query.message.reply_text(
-                message_text,
+            await context.bot.send_message(
+                chat_id=user_id,
+                text=f"*✅ اضافه شد!*\n\n{cart_text}",
+                reply_markup=reply_markup,
                 parse_mode='Markdown'
             )
         
-        await query.answer()
-    elif query.data == "cancel_order":
-        clear_user_cart(user_id)
-        context.user_data.clear()  # Clear any pending states
-        # Clear any inline keyboard on the cart message
+        await query.answer("✅ به سبد خرید اضافه شد")
+    else:
+        await query.answer("❌ خطا در افزودن به سبد خرید", show_alert=True)
+
+async def cb_type_quantity(update: Update, context: ContextTypes.DEFAULT_TYPE, product_id):
+    """Switch the quantity prompt to typing mode"""
+    query = update.callback_query
+    # Switch to typing mode
+    product_info = await get_current_product(context)
+    if not product_info or str(product_info['product_id']) != str(product_id):
+        await query.answer("❌ خطا در دریافت اطلاعات محصول", show_alert=True)
+        return
+    
+    context.user_data['awaiting_quantity'] = True
+    context.user_data['awaiting_quantity_typing'] = True
+    
+    effective_min = context.user_data.get('effective_min', 1)
+    
+    message_text = (
+        f"*⌨️ تعداد را تایپ کنید:*\n\n"
+        f"*📊 حداقل:* {effective_min} عدد\n\n"
+        f"تعداد مورد نظر خود را وارد کنید:"
+    )
+    
+    # Check if message is a photo or text
+    try:
+        if query.message.photo:
+            # It's a photo message - edit caption
+            await query.edit_message_caption(
+                caption=message_text,
+                parse_mode='Markdown'
+            )
+        else:
+            # It's a text message
+            await query.edit_message_text(
+                message_text,
+                parse_mode='Markdown'
+            )
+    except Exception as e:
+        # If editing fails, delete and send new message
         try:
-            await query.edit_message_text("*❌ سبد خرید لغو شد.*", reply_markup=None, parse_mode='Markdown')
-        except Exception:
+            await query.message.delete()
+        except:
             pass
-        await query.message.reply_text("*📱 بازگشت به کانال:*", reply_markup=create_channel_button(), parse_mode='Markdown')
-        # Restore main menu
-        reply_markup = create_main_menu_keyboard()
-        await query.message.reply_text("*منوی اصلی:*", reply_markup=reply_markup, parse_mode='Markdown')
-    elif query.data == "finish_order":
-        logger.info(f"User {user_id} attempting to finish order")
-        
-        user_info = get_user_info(user_id)
-        if user_info and user_info.get('phone_number') and user_info.get('first_name'):
-            cart_items = get_user_cart(user_id)
-            if not cart_items:
-                await query.edit_message_text("**❌ سبد خالی!**", parse_mode='Markdown')
-                return
-            user_name = user_info.get('first_name', 'مشتری')
-            phone = user_info.get('phone_number')
-            order_id = create_order(user_id, cart_items, customer_name=user_name, customer_phone=phone)
-            if order_id:
-                clear_user_cart(user_id)
-                cart_text = format_cart(cart_items)
-                confirmation = (
-                    f"**✅ سفارش ثبت شد!**\n\n"
-                    f"**📋 شماره: {order_id:04d}**\n"
-                    f"**👤 {user_name}**\n\n"
-                    f"{cart_text}\n\n"
-                    f"**✅ برای ادمین ارسال شد.**\n"
-                    f"**⏰ به زودی تماس می‌گیریم.**\n\n"
-                    f"**🙏 متشکریم!**"
-                )
-                await query.edit_message_text(confirmation, parse_mode='Markdown')
-                
-                # Calculate total amount and 2% discount
-                total_amount = sum(item.get('price', 0) * item['quantity'] for item in cart_items)
-                total_amount = float(total_amount)  # Convert Decimal to float
-                discounted_amount = int(total_amount * 0.98)  # 2% off
-                # Round down to nearest thousand
-                discounted_amount = (discounted_amount // 1000) * 1000
-                
-                logger.info(f"Sending promo message. Total: {total_amount}, Discounted: {discounted_amount}")
-                
-                # Send promotional message with website link
-                promo_keyboard = [[InlineKeyboardButton("🌐 homplast.com", url="https://homplast.com")]]
-                promo_markup = InlineKeyboardMarkup(promo_keyboard)
-                promo_message = (
-                    f"😍 می‌دونستی اگه این سفارش رو از طریق وبسایت ما انجام می‌دادی، "
-                    f"دو درصد تخفیف ویژه می‌گرفتی و بجای *{int(total_amount):,}* فقط "
-                    f"*{discounted_amount:,}* تومان پرداخت می‌کردی!!!"
-                )
-                try:
-                    await query.message.reply_text(
-                        promo_message,
-                        reply_markup=promo_markup,
-                        parse_mode='Markdown'
-                    )
-                    logger.info("Promo message sent successfully")
-                except Exception as e:
-                    logger.error(f"Failed to send promo message: {e}")
-                
-                # Send channel button after promo
-                await query.message.reply_text("**📱 بازگشت به کانال:**", reply_markup=create_channel_button(), parse_mode='Markdown')
-                
-                # Reset keyboard to main menu (removes any previous keyboards like "انصراف")
-                main_menu = create_main_menu_keyboard()
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=f"✅  سفارش شما به شماره *{order_id:04d}* ثبت شد!\n\n"
-                         f"📞 به زودی با شما تماس گرفته خواهد شد.\n\n"
-                         f"برای سفارش جدید، به کانال مراجعه کنید",
-                    reply_markup=main_menu,
-                    parse_mode='Markdown'
-                )
-                
-                admin_msg = (
-                    f"**🔔 سفارش جدید!**\n\n"
-                    f"**📋 #{order_id:04d}**\n"
-                    f"**👤 {user_name}**\n"
-                    f"**📱 {phone}**\n"
-                    f"**🆔 {user_id}**\n\n"
-                    f"{cart_text}"
-                )
-                try:
-                    await context.bot.send_message(chat_id=ADMIN_ID, text=admin_msg, parse_mode='Markdown')
-                except Exception as e:
-                    logger.error(f"Error: {e}")
+        await query.message.reply_text(
+            message_text,
+            parse_mode='Markdown'
+        )
+    
+    await query.answer()
+
+async def cb_cancel_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Empty the cart and cancel the order"""
+    query = update.callback_query
+    user_id = update.effective_user.id
+    await cart_cache.clear(user_id)
+    context.user_data.clear()  # Clear any pending states
+    reply = ReplyComposer(query.message.reply_text)
+    # Clear any inline keyboard on the cart message
+    reply.side(query.edit_message_text("*❌ سبد خرید لغو شد.*", reply_markup=None, parse_mode='Markdown'),
+               ignore_errors=True)
+    reply.add("*📱 بازگشت به کانال:*", reply_markup=create_channel_button())
+    # Restore main menu
+    reply.add("*منوی اصلی:*", reply_markup=create_main_menu_keyboard())
+    await reply.flush(ordered=False)
+
+def format_order_confirmation(order_id, user_name, cart_text):
+    return (
+        f"**✅ سفارش ثبت شد!**\n\n"
+        f"**📋 شماره: {order_id:04d}**\n"
+        f"**👤 {user_name}**\n\n"
+        f"{cart_text}\n\n"
+        f"**✅ برای ادمین ارسال شد.**\n"
+        f"**⏰ به زودی تماس می‌گیریم.**\n\n"
+        f"**🙏 متشکریم!**"
+    )
+
+async def checkout_cart(user_id, cart_items, user_info):
+    """Place the (revalidated) cart as the user's order and queue the admin notification.
+
+    Returns (order_id, confirmation text), or None if the order could not be
+    created. A repeated checkout of the same cart returns the existing order
+    without notifying the admin again.
+    """
+    user_name = user_info.get('first_name', 'مشتری') if user_info else 'مشتری'
+    phone = user_info.get('phone_number') if user_info else None
+    result = await checkout_service.checkout(user_id, cart_items, user_name, phone)
+    if result is None:
+        return None
+    order_id = result['order_id']
+    cart_text = format_cart(cart_items)
+    if result['duplicate']:
+        # The cart may have survived the first attempt; it belongs to the placed order
+        await cart_cache.clear(user_id)
+    else:
+        admin_msg = (
+            f"**🔔 سفارش جدید!**\n\n"
+            f"**📋 #{order_id:04d}**\n"
+            f"**👤 {escape_markdown(str(user_name))}**\n"
+            f"**📱 {escape_markdown(str(phone))}**\n"
+            f"**🆔 {user_id}**\n\n"
+            f"{cart_text}"
+        )
+        await admin_outbox.enqueue(admin_msg)
+    return order_id, format_order_confirmation(order_id, user_name, cart_text)
+
+async def cb_finish_order(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Place the order for the cart"""
+    query = update.callback_query
+    user_id = update.effective_user.id
+    logger.info(f"User {user_id} attempting to finish order")
+    
+    user_info = await db.get_user_info(user_id)
+    if user_info and user_info.get('phone_number') and user_info.get('first_name'):
+        cart_items = await cart_cache.get_cart(user_id)
+        if not cart_items:
+            await query.edit_message_text("**❌ سبد خالی!**", parse_mode='Markdown')
+            return
+        conflicts = await revalidate_cart(cart_items)
+        if conflicts:
+            await query.edit_message_text(
+                format_cart_conflicts(conflicts),
+                reply_markup=InlineKeyboardMarkup(create_cart_keyboard(context)),
+                parse_mode='Markdown'
+            )
+            return
+        placed = await checkout_cart(user_id, cart_items, user_info)
+        if placed:
+            order_id, confirmation = placed
+            reply = ReplyComposer(query.message.reply_text)
+            reply.side(query.edit_message_text(confirmation, parse_mode='Markdown'))
+            
+            # Calculate total amount and 2% discount
+            total_amount = sum(item.get('price', 0) * item['quantity'] for item in cart_items)
+            total_amount = float(total_amount)  # Convert Decimal to float
+            discounted_amount = int(total_amount * 0.98)  # 2% off
+            # Round down to nearest thousand
+            discounted_amount = (discounted_amount // 1000) * 1000
+            
+            logger.info(f"Sending promo message. Total: {total_amount}, Discounted: {discounted_amount}")
+            
+            # Promotional message with website link
+            promo_keyboard = [[InlineKeyboardButton("🌐 homplast.com", url="https://homplast.com")]]
+            promo_markup = InlineKeyboardMarkup(promo_keyboard)
+            promo_message = (
+                f"😍 می‌دونستی اگه این سفارش رو از طریق وبسایت ما انجام می‌دادی، "
+                f"دو درصد تخفیف ویژه می‌گرفتی و بجای *{int(total_amount):,}* فقط "
+                f"*{discounted_amount:,}* تومان پرداخت می‌کردی!!!"
+            )
+            reply.add(promo_message, reply_markup=promo_markup)
+            # Channel button after promo (merged into the promo message)
+            reply.add("**📱 بازگشت به کانال:**", reply_markup=create_channel_button())
+            # Reset keyboard to main menu (removes any previous keyboards like "انصراف")
+            reply.add(
+                f"✅  سفارش شما به شماره *{order_id:04d}* ثبت شد!\n\n"
+                f"📞 به زودی با شما تماس گرفته خواهد شد.\n\n"
+                f"برای سفارش جدید، به کانال مراجعه کنید",
+                reply_markup=create_main_menu_keyboard(),
+            )
+            await reply.flush()
+    else:
+        # Check if user has name but not phone, or missing both
+        user_info = await db.get_user_info(user_id)
+        if user_info and user_info.get('first_name') and not user_info.get('phone_number'):
+            await query.edit_message_text("**📱 لطفاً شماره تماس خود را وارد کنید:**", parse_mode='Markdown')
+            context.user_data['awaiting_phone'] = True
         else:
-            # Check if user has name but not phone, or missing both
-            user_info = get_user_info(user_id)
-            if user_info and user_info.get('first_name') and not user_info.get('phone_number'):
-                await query.edit_message_text("**📱 لطفاً شماره تماس خود را وارد کنید:**", parse_mode='Markdown')
-                context.user_data['awaiting_phone'] = True
-            else:
-                await query.edit_message_text("**✍️ لطفاً ابتدا ثبت نام کنید:**", parse_mode='Markdown')
-                context.user_data['awaiting_name'] = True
+            await query.edit_message_text("**✍️ لطفاً ابتدا ثبت نام کنید:**", parse_mode='Markdown')
+            context.user_data['awaiting_name'] = True
+
+# Inline button routes: exact action names, then '<prefix><payload>' actions
+callback_router = CallbackRouter()
+callback_router.exact("edit_name", cb_edit_name)
+callback_router.exact("edit_phone", cb_edit_phone)
+callback_router.exact("cancel_edit", cb_cancel_edit)
+callback_router.exact("add_more", cb_add_more)
+callback_router.exact("edit_cart", cb_edit_cart)
+callback_router.exact("back_to_cart", cb_back_to_cart)
+callback_router.exact("cancel_product_add", cb_cancel_product_add)
+callback_router.exact("img_info", cb_noop)
+callback_router.exact("qty_display", cb_noop)
+callback_router.exact("qty_min_reached", cb_min_reached)
+callback_router.exact("qty_max_reached", cb_max_reached)
+callback_router.exact("cancel_order", cb_cancel_order)
+callback_router.exact("finish_order", cb_finish_order)
+callback_router.prefix("edit_", cb_edit_item)
+callback_router.prefix("change_qty_", cb_change_quantity)
+callback_router.prefix("remove_", cb_remove_item)
+callback_router.prefix("qty_inc_", functools.partial(cb_step_quantity, increase=True))
+callback_router.prefix("qty_dec_", functools.partial(cb_step_quantity, increase=False))
+callback_router.prefix("img_prev_", functools.partial(cb_gallery, step=-1), parse=product_index_payload)
+callback_router.prefix("img_next_", functools.partial(cb_gallery, step=1), parse=product_index_payload)
+callback_router.prefix("qty_add_cart_", cb_add_to_cart)
+callback_router.prefix("qty_type_", cb_type_quantity)
+
+async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle button callbacks"""
+    await update.callback_query.answer()
+    await callback_router.dispatch(update, context)
 
 async def handle_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle name input with validation"""
@@ -1354,7 +1726,7 @@ async def handle_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     user_id = update.effective_user.id
     # Update user name in database using the proper function
-    if not update_user_name(user_id, clean_name):
+    if not await db.update_user_name(user_id, clean_name):
         await update.message.reply_text("**❌ خطا در ذخیره نام. لطفاً دوباره تلاش کنید.**", parse_mode='Markdown')
         return
     
@@ -1379,10 +1751,12 @@ async def handle_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def show_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show user orders"""
     user_id = update.effective_user.id
-    orders = get_user_orders(user_id)
+    orders = await db.get_user_orders(user_id)
+    reply = ReplyComposer(update.message.reply_text)
     if not orders:
-        await update.message.reply_text("**📋 هنوز سفارشی ندارید.**", parse_mode='Markdown')
-        await update.message.reply_text("**📱 بازگشت به کانال:**", reply_markup=create_channel_button(), parse_mode='Markdown')
+        reply.add("**📋 هنوز سفارشی ندارید.**")
+        reply.add("**📱 بازگشت به کانال:**", reply_markup=create_channel_button())
+        await reply.flush()
         return
     text = "**🛒 سفارشات شما:**\n\n"
     for order in orders:
@@ -1395,8 +1769,9 @@ async def show_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"{order['total_amount']:,.0f} تومان - {order['item_count']} محصول\n"
             f"➖➖➖➖➖\n\n"
         )
-    await update.message.reply_text(text, parse_mode='Markdown')
-    await update.message.reply_text("**📱 بازگشت به کانال:**", reply_markup=create_channel_button(), parse_mode='Markdown')
+    reply.add(text)
+    reply.add("**📱 بازگشت به کانال:**", reply_markup=create_channel_button())
+    await reply.flush()
 
 async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle contact input"""
@@ -1404,7 +1779,7 @@ async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if contact:
         phone = contact.phone_number
-        update_user_phone(user_id, phone)
+        await db.update_user_phone(user_id, phone)
         if context.user_data.get('editing_phone'):
             context.user_data.clear()
             reply_markup = create_main_menu_keyboard()
@@ -1412,7 +1787,7 @@ async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         if context.user_data.get('registering'):
             # Send admin notification for new user registration
-            user_info = get_user_info(user_id)
+            user_info = await db.get_user_info(user_id)
             user_name = user_info.get('first_name', 'نامشخص') if user_info else 'نامشخص'
             username = update.effective_user.username or 'نامشخص'
             first_name_user = update.effective_user.first_name or 'نامشخص'
@@ -1421,15 +1796,12 @@ async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
             admin_registration_msg = (
                 f"**👤 کاربر جدید ثبت نام کرد!**\n\n"
                 f"**🆔 شناسه:** {user_id}\n"
-                f"**👤 نام:** {user_name}\n"
-                f"**📱 شماره:** {phone}\n"
-                f"**@username:** @{username}\n"
-                f"**نام تلگرام:** {first_name_user} {last_name_user}"
+                f"**👤 نام:** {escape_markdown(str(user_name))}\n"
+                f"**📱 شماره:** {escape_markdown(str(phone))}\n"
+                f"**@username:** @{escape_markdown(username)}\n"
+                f"**نام تلگرام:** {escape_markdown(first_name_user)} {escape_markdown(last_name_user)}"
             )
-            try:
-                await context.bot.send_message(chat_id=ADMIN_ID, text=admin_registration_msg, parse_mode='Markdown')
-            except Exception as e:
-                logger.error(f"Error sending registration notification: {e}")
+            await admin_outbox.enqueue(admin_registration_msg)
             
             context.user_data.clear()
             reply_markup = create_main_menu_keyboard()
@@ -1439,47 +1811,31 @@ async def handle_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 parse_mode='Markdown'
             )
             return
-        cart_items = get_user_cart(user_id)
+        cart_items = await cart_cache.get_cart(user_id)
         if not cart_items:
             reply_markup = create_main_menu_keyboard()
             await update.message.reply_text("**❌ سبد خالی!**", reply_markup=reply_markup, parse_mode='Markdown')
             return
-        user_info = get_user_info(user_id)
-        user_name = user_info.get('first_name', 'مشتری') if user_info else 'مشتری'
-        phone = user_info.get('phone_number') if user_info else None
-        order_id = create_order(user_id, cart_items, customer_name=user_name, customer_phone=phone)
-        if order_id:
-            clear_user_cart(user_id)
-            cart_text = format_cart(cart_items)
-            confirmation = (
-                f"**✅ سفارش ثبت شد!**\n\n"
-                f"**📋 شماره: {order_id:04d}**\n"
-                f"**👤 {user_name}**\n\n"
-                f"{cart_text}\n\n"
-                f"**✅ برای ادمین ارسال شد.**\n"
-                f"**⏰ به زودی تماس می‌گیریم.**\n\n"
-                f"**🙏 متشکریم!**"
+        conflicts = await revalidate_cart(cart_items)
+        if conflicts:
+            await update.message.reply_text(
+                format_cart_conflicts(conflicts),
+                reply_markup=InlineKeyboardMarkup(create_cart_keyboard(context)),
+                parse_mode='Markdown'
             )
+            return
+        user_info = await db.get_user_info(user_id)
+        placed = await checkout_cart(user_id, cart_items, user_info)
+        if placed:
+            order_id, confirmation = placed
             reply_markup = create_main_menu_keyboard()
             await update.message.reply_text(confirmation, reply_markup=reply_markup, parse_mode='Markdown')
-            admin_msg = (
-                f"**🔔 سفارش جدید!**\n\n"
-                f"**📋 #{order_id:04d}**\n"
-                f"**👤 {user_name}**\n"
-                f"**📱 {phone}**\n"
-                f"**🆔 {user_id}**\n\n"
-                f"{cart_text}"
-            )
-            try:
-                await context.bot.send_message(chat_id=ADMIN_ID, text=admin_msg, parse_mode='Markdown')
-            except Exception as e:
-                logger.error(f"Error: {e}")
             context.user_data.clear()
 
 async def register_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle user registration"""
     user_id = update.effective_user.id
-    user_info = get_user_info(user_id)
+    user_info = await db.get_user_info(user_id)
     if user_info and user_info.get('phone_number') and user_info.get('first_name'):
         keyboard = [
             [InlineKeyboardButton("✏️ ویرایش نام", callback_data="edit_name")],
@@ -1516,17 +1872,18 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         from telegram import ReplyKeyboardRemove
         remove_keyboard = ReplyKeyboardRemove(remove_keyboard=True)
         cancel_msg = "**✅ بازگشت به منوی اصلی**" if "بازگشت" in text else "**✅ عملیات لغو شد**"
-        await update.message.reply_text(cancel_msg, reply_markup=remove_keyboard, parse_mode='Markdown')
-        await update.message.reply_text("**📱 بازگشت به کانال:**", reply_markup=create_channel_button(), parse_mode='Markdown')
-        reply_markup = create_main_menu_keyboard()
-        await update.message.reply_text("**منوی اصلی:**", reply_markup=reply_markup, parse_mode='Markdown')
+        reply = ReplyComposer(update.message.reply_text)
+        reply.add(cancel_msg, reply_markup=remove_keyboard)
+        reply.add("**📱 بازگشت به کانال:**", reply_markup=create_channel_button())
+        reply.add("**منوی اصلی:**", reply_markup=create_main_menu_keyboard())
+        await reply.flush(ordered=False)
         return
 
     if text == "🔙 بازگشت به سبد":
         if context.user_data.get('awaiting_new_quantity'):
             context.user_data.clear()
             user_id = update.effective_user.id
-            cart_items = get_user_cart(user_id)
+            cart_items = await cart_cache.get_cart(user_id)
             cart_text = format_cart(cart_items)
             keyboard = create_cart_keyboard(context)
             reply_markup = InlineKeyboardMarkup(keyboard)
@@ -1578,7 +1935,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         clean_phone = result
         
         user_id = update.effective_user.id
-        update_user_phone(user_id, clean_phone)
+        await db.update_user_phone(user_id, clean_phone)
         if context.user_data.get('editing_phone'):
             context.user_data.clear()
             reply_markup = create_main_menu_keyboard()
@@ -1586,7 +1943,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         if context.user_data.get('registering'):
             # Send admin notification for new user registration
-            user_info = get_user_info(user_id)
+            user_info = await db.get_user_info(user_id)
             user_name = user_info.get('first_name', 'نامشخص') if user_info else 'نامشخص'
             username = update.effective_user.username or 'نامشخص'
             first_name_user = update.effective_user.first_name or 'نامشخص'
@@ -1595,15 +1952,12 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             admin_registration_msg = (
                 f"**👤 کاربر جدید ثبت نام کرد!**\n\n"
                 f"**🆔 شناسه:** {user_id}\n"
-                f"**👤 نام:** {user_name}\n"
-                f"**📱 شماره:** {clean_phone}\n"
-                f"**@username:** @{username}\n"
-                f"**نام تلگرام:** {first_name_user} {last_name_user}"
+                f"**👤 نام:** {escape_markdown(str(user_name))}\n"
+                f"**📱 شماره:** {escape_markdown(str(clean_phone))}\n"
+                f"**@username:** @{escape_markdown(username)}\n"
+                f"**نام تلگرام:** {escape_markdown(first_name_user)} {escape_markdown(last_name_user)}"
             )
-            try:
-                await context.bot.send_message(chat_id=ADMIN_ID, text=admin_registration_msg, parse_mode='Markdown')
-            except Exception as e:
-                logger.error(f"Error sending registration notification: {e}")
+            await admin_outbox.enqueue(admin_registration_msg)
             
             context.user_data.clear()
             reply_markup = create_main_menu_keyboard()
@@ -1613,41 +1967,25 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 parse_mode='Markdown'
             )
             return
-        cart_items = get_user_cart(user_id)
+        cart_items = await cart_cache.get_cart(user_id)
         if not cart_items:
             reply_markup = create_main_menu_keyboard()
             await update.message.reply_text("**❌ سبد خالی!**", reply_markup=reply_markup, parse_mode='Markdown')
             return
-        user_info = get_user_info(user_id)
-        user_name = user_info.get('first_name', 'مشتری') if user_info else 'مشتری'
-        phone = user_info.get('phone_number') if user_info else None
-        order_id = create_order(user_id, cart_items, customer_name=user_name, customer_phone=phone)
-        if order_id:
-            clear_user_cart(user_id)
-            cart_text = format_cart(cart_items)
-            confirmation = (
-                f"**✅ سفارش ثبت شد!**\n\n"
-                f"**📋 شماره: {order_id:04d}**\n"
-                f"**👤 {user_name}**\n\n"
-                f"{cart_text}\n\n"
-                f"**✅ برای ادمین ارسال شد.**\n"
-                f"**⏰ به زودی تماس می‌گیریم.**\n\n"
-                f"**🙏 متشکریم!**"
+        conflicts = await revalidate_cart(cart_items)
+        if conflicts:
+            await update.message.reply_text(
+                format_cart_conflicts(conflicts),
+                reply_markup=InlineKeyboardMarkup(create_cart_keyboard(context)),
+                parse_mode='Markdown'
             )
+            return
+        user_info = await db.get_user_info(user_id)
+        placed = await checkout_cart(user_id, cart_items, user_info)
+        if placed:
+            order_id, confirmation = placed
             reply_markup = create_main_menu_keyboard()
             await update.message.reply_text(confirmation, reply_markup=reply_markup, parse_mode='Markdown')
-            admin_msg = (
-                f"**🔔 سفارش جدید!**\n\n"
-                f"**📋 #{order_id:04d}**\n"
-                f"**👤 {user_name}**\n"
-                f"**📱 {phone}**\n"
-                f"**🆔 {user_id}**\n\n"
-                f"{cart_text}"
-            )
-            try:
-                await context.bot.send_message(chat_id=ADMIN_ID, text=admin_msg, parse_mode='Markdown')
-            except Exception as e:
-                logger.error(f"Error: {e}")
             context.user_data.clear()
         return
     if text == "📦 سفارشات من":
@@ -1656,7 +1994,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await register_user(update, context)
     elif text == "🛒 مشاهده سبد خرید":
         user_id = update.effective_user.id
-        cart_items = get_user_cart(user_id)
+        cart_items = await cart_cache.get_cart(user_id)
         if cart_items:
             cart_text = format_cart(cart_items)
             keyboard = create_cart_keyboard(context)
@@ -1667,12 +2005,13 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 parse_mode='Markdown'
             )
         else:
-            await update.message.reply_text(
+            reply = ReplyComposer(update.message.reply_text)
+            reply.add(
                 "**🛒 سبد خرید شما خالی است!**\n\n"
-                "برای سفارش، از کانال دکمه «سفارش محصول» را بزنید.",
-                parse_mode='Markdown'
+                "برای سفارش، از کانال دکمه «سفارش محصول» را بزنید."
             )
-            await update.message.reply_text("**📱 بازگشت به کانال:**", reply_markup=create_channel_button(), parse_mode='Markdown')
+            reply.add("**📱 بازگشت به کانال:**", reply_markup=create_channel_button())
+            await reply.flush()
     elif text == "☎️ پشتیبانی":
         admin_username = ADMIN_USERNAME if ADMIN_USERNAME.startswith('@') else f'@{ADMIN_USERNAME}'
         await update.message.reply_text(f"برای تماس با پشتیبانی، روی لینک زیر کلیک کنید:\n\n{admin_username}")
@@ -1688,10 +2027,197 @@ async def version_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     await update.message.reply_text(version_info, parse_mode='Markdown')
 
+background_tasks = []
+
+# Conversation state (user_data) survives restarts; loaded per user on first update
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', 'state.db')
+STATE_FLUSH_INTERVAL = float(os.getenv('STATE_FLUSH_INTERVAL', '5'))
+state_persistence = SQLitePersistence(path=STATE_DB_PATH, update_interval=STATE_FLUSH_INTERVAL)
+
+# Different users' updates run concurrently; one user's updates stay in order
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', '32'))
+UPDATE_LOCK_SHARDS = int(os.getenv('UPDATE_LOCK_SHARDS', '1024'))
+update_processor = PerUserUpdateProcessor(max_workers=UPDATE_WORKERS, shards=UPDATE_LOCK_SHARDS)
+
+# Abandoned order flows are forgotten after FLOW_STATE_IDLE_SECONDS without activity
+FLOW_STATE_IDLE_SECONDS = int(os.getenv('FLOW_STATE_IDLE_SECONDS', str(6 * 3600)))
+FLOW_STATE_SWEEP_TICK = int(os.getenv('FLOW_STATE_SWEEP_TICK', '60'))
+FLOW_STATE_KEYS = (
+    'current_sku', 'current_quantity', 'effective_min', 'effective_max', 'current_image_index',
+    'awaiting_quantity', 'awaiting_quantity_typing', 'awaiting_new_quantity', 'awaiting_name',
+    'awaiting_phone', 'editing_product_id', 'editing_profile', 'editing_phone', 'registering',
+    'user_name', 'source_message_id', 'source_channel',
+)
+flow_sweeper = IdleSweeper(idle_seconds=FLOW_STATE_IDLE_SECONDS, tick=FLOW_STATE_SWEEP_TICK)
+
+def clear_flow_state(user_data):
+    """Remove the order flow keys from user_data; returns approximate bytes freed"""
+    reclaimed = 0
+    for key in FLOW_STATE_KEYS + ('last_active',):
+        if key in user_data:
+            reclaimed += approximate_size(user_data.pop(key))
+    return reclaimed
+
+async def track_activity(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Record user activity for the idle-state sweeper (runs before every handler)"""
+    if not update.effective_user:
+        return
+    flow_sweeper.touch(update.effective_user.id)
+    # Wall-clock last activity is persisted with the flow state, so state
+    # restored after a restart still ages out
+    user_data = context.user_data
+    now = time.time()
+    last_active = user_data.get('last_active')
+    if last_active is not None and now - last_active >= FLOW_STATE_IDLE_SECONDS:
+        clear_flow_state(user_data)
+        last_active = None
+    # Refreshed once per sweep tick, not on every update, to spare state writes
+    if last_active is None or now - last_active >= FLOW_STATE_SWEEP_TICK:
+        user_data['last_active'] = now
+
+def expire_flow_state(application, user_id):
+    """Drop an idle user's in-progress flow state; returns approximate bytes freed"""
+    user_data = application.user_data.get(user_id)
+    if not user_data:
+        return 0
+    reclaimed = clear_flow_state(user_data)
+    if user_data:
+        application.mark_data_for_update_persistence(user_ids=user_id)
+    else:
+        # Nothing left: remove the entry from memory and from persistence
+        application.drop_user_data(user_id)
+    return reclaimed
+
+async def purge_idle_state(interval=3600):
+    """Delete stored flow state of users who never came back after a restart"""
+    while True:
+        await state_persistence.purge_idle(FLOW_STATE_IDLE_SECONDS)
+        await asyncio.sleep(interval)
+
+async def on_startup(application):
+    """Load persistent caches, warm the catalog mirror and start its background sync"""
+    await photo_ids.load()
+    await image_cache.load()
+    await checkout_service.load()
+    await admin_outbox.load()
+    background_tasks.append(asyncio.create_task(
+        admin_outbox.run(functools.partial(application.bot.send_message, ADMIN_ID))
+    ))
+    background_tasks.append(asyncio.create_task(
+        flow_sweeper.run(functools.partial(expire_flow_state, application))
+    ))
+    background_tasks.append(asyncio.create_task(purge_idle_state()))
+    if CATALOG_SYNC_ENABLED:
+        await catalog.load()
+        background_tasks.append(asyncio.create_task(
+            catalog.run(CATALOG_SYNC_INTERVAL, CATALOG_FULL_SYNC_INTERVAL)
+        ))
+
+async def on_shutdown(application):
+    """Stop background jobs and release pooled connections when the bot stops"""
+    for task in background_tasks:
+        task.cancel()
+    background_tasks.clear()
+    await wc_client.aclose()
+    await image_cache.aclose()
+    await asyncio.to_thread(db.shutdown)
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show internal cache statistics (admin chat only)"""
+    if str(update.effective_chat.id) != str(ADMIN_ID):
+        return
+    sections = {
+        'Product cache': product_cache.stats(),
+        'Product records': product_store.stats(),
+        'Catalog mirror': catalog.stats(),
+        'WooCommerce breaker': wc_breaker.stats(),
+        'Cart cache': cart_cache.stats(),
+        'Checkout': checkout_service.stats(),
+        'Admin outbox': admin_outbox.stats(),
+        'Replies': ReplyComposer.stats(),
+        'Database pool': db.stats(),
+        'Database latency': db.query_stats(),
+        'Quantity edits': quantity_debouncer.stats(),
+        'Photo file_ids': photo_ids.stats(),
+        'Image cache': image_cache.stats(),
+        'Updates': update_processor.stats(),
+        'Conversation state': state_persistence.stats(),
+        'Idle flow state': flow_sweeper.stats(),
+        'Callbacks': callback_router.stats(),
+        'Callback latency': callback_router.route_stats(),
+    }
+    # Sections are packed into as few messages as Telegram's length limit allows
+    reply = ReplyComposer(update.message.reply_text)
+    for title, values in sections.items():
+        text = f"📊 {title}\n" + "\n".join(f"{key}: {value}" for key, value in values.items())
+        if len(text) > MAX_MESSAGE_LENGTH:
+            text = text[:MAX_MESSAGE_LENGTH - 1] + "…"
+        reply.add(text, parse_mode=None)
+    await reply.flush()
+
+# Webhook server settings (the public base URL and port come from config.settings)
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram-webhook')
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+
+def webhook_secret():
+    """Secret Telegram echoes in X-Telegram-Bot-Api-Secret-Token on every webhook call"""
+    secret = os.getenv('WEBHOOK_SECRET')
+    if secret:
+        return secret
+    # Stable across restarts without extra configuration, and never the token itself
+    return hashlib.sha256(f"webhook:{BOT_TOKEN}".encode()).hexdigest()
+
+def webhook_unavailable(port):
+    """Why the webhook server can't start here, or None.
+
+    Checked before run_webhook: once the Application has run, its shutdown
+    has closed the database pool and HTTP clients, so polling can't take over.
+    """
+    if importlib.util.find_spec('tornado') is None:
+        return 'webhook mode needs: pip install "python-telegram-bot[webhooks]"'
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+            # Same option as the webhook server: only a live listener blocks the port
+            probe.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            probe.bind((WEBHOOK_LISTEN, int(port or 8443)))
+    except OSError as e:
+        return f"cannot listen on {WEBHOOK_LISTEN}:{port or 8443}: {e}"
+    return None
+
+def run_webhook(application, base_url, port):
+    """Serve updates on an embedded webhook server until stopped.
+
+    python-telegram-bot's server (tornado, the "webhooks" extra) rejects
+    requests without the secret token, queues updates for the update
+    processor, registers the webhook on start and stops cleanly on SIGINT or
+    SIGTERM.
+    """
+    webhook_url = f"{base_url.rstrip('/')}/{WEBHOOK_PATH}"
+    logger.info(f"Starting webhook server on {WEBHOOK_LISTEN}:{port} for {webhook_url}")
+    application.run_webhook(
+        listen=WEBHOOK_LISTEN,
+        port=int(port or 8443),
+        url_path=WEBHOOK_PATH,
+        webhook_url=webhook_url,
+        secret_token=webhook_secret(),
+        allowed_updates=Update.ALL_TYPES,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        bootstrap_retries=3,
+    )
+
 def main():
     """Main entry point - Supports both webhook and polling modes"""
     logger.info("Starting bot...")
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(update_processor)
+        .persistence(state_persistence)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     from telegram import BotCommand
     commands = [BotCommand("start", "شروع و منوی اصلی"), BotCommand("version", "نسخه ربات")]
     
@@ -1701,8 +2227,10 @@ def main():
     # application.add_handler(CommandHandler("start", start, filters=private_filter))
     # ... (and add filter to other handlers)
     
+    application.add_handler(TypeHandler(Update, track_activity), group=-1)
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("version", version_command))
+    application.add_handler(CommandHandler("stats", stats_command))
     application.add_handler(CallbackQueryHandler(button_callback))
     application.add_handler(MessageHandler(filters.CONTACT, handle_contact))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
@@ -1712,22 +2240,20 @@ def main():
     loop.run_until_complete(application.bot.set_my_commands(commands))
     logger.info("Bot started!")
     
-    # Try to use webhook if configured, otherwise fallback to polling
+    # Webhook when a public URL is configured and the server can start, polling otherwise.
+    # No fallback once run_webhook has started: its shutdown already released the resources.
     try:
         from config.settings import WEBHOOK_URL, WEBHOOK_PORT
-        if WEBHOOK_URL and WEBHOOK_URL != '':
-            logger.info(f"Configuring webhook to {WEBHOOK_URL}")
-            webhook_path = f"/webhook/{BOT_TOKEN}"
-            # For now, keep using polling as webhook requires additional setup
-            # You can switch to webhook later when ready
-            logger.info("Using polling mode (webhook setup requires additional configuration)")
-            application.run_polling()
-        else:
-            application.run_polling()
-    except Exception as e:
-        logger.error(f"Error setting up webhook: {e}")
+    except ImportError:
+        WEBHOOK_URL, WEBHOOK_PORT = '', None
+    if WEBHOOK_URL:
+        problem = webhook_unavailable(WEBHOOK_PORT)
+        if problem is None:
+            run_webhook(application, WEBHOOK_URL, WEBHOOK_PORT)
+            return
+        logger.error(f"Error setting up webhook: {problem}")
         logger.info("Falling back to polling mode")
-        application.run_polling()
+    application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
     try:
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent outbox for admin notifications.
+
+Handlers enqueue() a notification (one SQLite insert) and move on; a single
+background worker delivers it to the admin group. The worker:
+
+- sends at most one message per ``min_interval`` seconds, below Telegram's
+  per-group limit (about 20 messages a minute);
+- merges everything that is due into one digest message, up to Telegram's
+  message length, so a burst of orders becomes a few messages;
+- honours RetryAfter and retries other failures with exponential backoff;
+  a notification that fails ``max_attempts`` times is kept in the table,
+  marked dead, instead of being dropped;
+- when Telegram rejects a digest (BadRequest, e.g. broken Markdown), sends
+  its notifications one by one, so one bad message can't hold back the
+  others; a rejected single notification is resent once as plain text and
+  then marked dead without further retries.
+
+Undelivered notifications survive restarts and go out once the bot is back.
+"""
+
+import asyncio
+import logging
+import sqlite3
+import time
+
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_LENGTH = 4096
+DIGEST_SEPARATOR = "\n\n➖➖➖➖➖\n\n"
+
+
+class AdminOutbox:
+    """Queue of admin notifications delivered by a rate-limited worker"""
+
+    def __init__(self, path='admin_outbox.db', min_interval=3.0, max_attempts=8,
+                 backoff_base=5.0, backoff_max=600.0):
+        self.path = path
+        self.min_interval = min_interval
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.pending = 0
+        self._wakeup = asyncio.Event()
+        self._solo = set()  # row ids to send on their own after their digest was rejected
+        self.counters = {'queued': 0, 'sent': 0, 'messages': 0, 'digests': 0,
+                         'retries': 0, 'rate_limited': 0, 'rejected': 0, 'dead': 0}
+
+    # --- SQLite (worker thread) ---
+    def _connect(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "text TEXT NOT NULL, parse_mode TEXT, attempts INTEGER NOT NULL DEFAULT 0, "
+            "next_attempt REAL NOT NULL, dead INTEGER NOT NULL DEFAULT 0)"
+        )
+        return conn
+
+    def _execute(self, sql, params=()):
+        conn = self._connect()
+        try:
+            with conn:
+                return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+    def _execute_many(self, sql, rows):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany(sql, rows)
+        finally:
+            conn.close()
+
+    async def load(self):
+        try:
+            rows = await asyncio.to_thread(
+                self._execute, "SELECT COUNT(*) FROM outbox WHERE dead = 0"
+            )
+            self.pending = rows[0][0]
+        except sqlite3.Error as e:
+            logger.error(f"Could not read admin outbox {self.path}: {e}")
+        if self.pending:
+            logger.info(f"{self.pending} admin notifications waiting from the last run")
+            self._wakeup.set()
+
+    # --- Producers ---
+    async def enqueue(self, text, parse_mode='Markdown'):
+        """Store a notification for delivery; returns once it is persisted"""
+        try:
+            await asyncio.to_thread(
+                self._execute,
+                "INSERT INTO outbox (text, parse_mode, next_attempt) VALUES (?, ?, ?)",
+                (text, parse_mode, time.time()),
+            )
+        except sqlite3.Error as e:
+            logger.error(f"Could not queue admin notification: {e}")
+            return False
+        self.counters['queued'] += 1
+        self.pending += 1
+        self._wakeup.set()
+        return True
+
+    # --- Worker ---
+    def _digest(self, rows):
+        """Take due rows in order while the merged text fits in one message"""
+        batch = [rows[0]]
+        if rows[0][0] in self._solo:
+            return batch
+        length = len(rows[0][1])
+        for row in rows[1:]:
+            # Markdown and plain text can't share a message
+            if row[2] != batch[0][2] or row[0] in self._solo:
+                break
+            length += len(DIGEST_SEPARATOR) + len(row[1])
+            if length > MAX_MESSAGE_LENGTH:
+                break
+            batch.append(row)
+        return batch
+
+    async def _next_delay(self):
+        rows = await asyncio.to_thread(
+            self._execute, "SELECT MIN(next_attempt) FROM outbox WHERE dead = 0"
+        )
+        next_attempt = rows[0][0]
+        return None if next_attempt is None else max(0.0, next_attempt - time.time())
+
+    async def _wait(self, timeout):
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _mark_dead(self, dead, error):
+        """dead: (attempts, row id) pairs"""
+        await asyncio.to_thread(
+            self._execute_many, "UPDATE outbox SET attempts = ?, dead = 1 WHERE id = ?", dead
+        )
+        self._solo.difference_update(row_id for _, row_id in dead)
+        self.pending -= len(dead)
+        self.counters['dead'] += len(dead)
+        logger.error(f"Giving up on {len(dead)} admin notifications: {error}")
+
+    async def _failed(self, batch, error):
+        rows, dead = [], []
+        for row_id, _, _, attempts in batch:
+            attempts += 1
+            if attempts >= self.max_attempts:
+                dead.append((attempts, row_id))
+            else:
+                delay = min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1))
+                rows.append((attempts, time.time() + delay, row_id))
+        await asyncio.to_thread(
+            self._execute_many,
+            "UPDATE outbox SET attempts = ?, next_attempt = ? WHERE id = ?",
+            rows,
+        )
+        if dead:
+            await self._mark_dead(dead, error)
+        self.counters['retries'] += len(rows)
+        logger.warning(f"Admin notification delivery failed, retrying {len(rows)}: {error}")
+
+    async def _rejected(self, batch, error):
+        """Telegram refused the content itself; sending it again unchanged can't help"""
+        self.counters['rejected'] += 1
+        if len(batch) > 1:
+            self._solo.update(row[0] for row in batch)
+            logger.warning(
+                f"Admin digest of {len(batch)} rejected, sending them one by one: {error}"
+            )
+            return
+        row_id, _, parse_mode, attempts = batch[0]
+        if parse_mode:
+            logger.warning(
+                f"Admin notification {row_id} rejected, resending as plain text: {error}"
+            )
+            await asyncio.to_thread(
+                self._execute, "UPDATE outbox SET parse_mode = NULL WHERE id = ?", (row_id,)
+            )
+            return
+        await self._mark_dead([(attempts + 1, row_id)], error)
+
+    async def deliver_due(self, send):
+        """Send one message with the oldest due notifications.
+
+        Returns False when nothing was due.
+        """
+        rows = await asyncio.to_thread(
+            self._execute,
+            "SELECT id, text, parse_mode, attempts FROM outbox "
+            "WHERE dead = 0 AND next_attempt <= ? ORDER BY id LIMIT 50",
+            (time.time(),),
+        )
+        if not rows:
+            return False
+        batch = self._digest(rows)
+        text = DIGEST_SEPARATOR.join(row[1] for row in batch)
+        try:
+            await send(text, parse_mode=batch[0][2])
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            if hasattr(retry_after, 'total_seconds'):
+                retry_after = retry_after.total_seconds()
+            self.counters['rate_limited'] += 1
+            logger.warning(f"Admin notifications rate limited for {retry_after}s")
+            await asyncio.sleep(retry_after)
+            return True
+        except BadRequest as e:
+            await self._rejected(batch, e)
+            return True
+        except TelegramError as e:
+            await self._failed(batch, e)
+            return True
+        await asyncio.to_thread(
+            self._execute_many, "DELETE FROM outbox WHERE id = ?", [(row[0],) for row in batch]
+        )
+        self._solo.difference_update(row[0] for row in batch)
+        self.pending -= len(batch)
+        self.counters['sent'] += len(batch)
+        self.counters['messages'] += 1
+        if len(batch) > 1:
+            self.counters['digests'] += 1
+        return True
+
+    async def run(self, send):
+        """Deliver notifications until cancelled.
+
+        send: async callable(text, parse_mode=...) posting to the admin chat
+        """
+        while True:
+            # Cleared before the table is read, so an enqueue() during this pass
+            # still wakes the wait below
+            self._wakeup.clear()
+            try:
+                if await self.deliver_due(send):
+                    await asyncio.sleep(self.min_interval)
+                    continue
+                await self._wait(await self._next_delay())
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Admin outbox worker error: {e}", exc_info=True)
+                await asyncio.sleep(self.min_interval)
+
+    def stats(self):
+        return {**self.counters, 'pending': self.pending, 'min_interval': self.min_interval}
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Awaitable access to the blocking config.database functions.
+
+config.database is synchronous, so calling it from a handler stalls the event
+loop and with it every other user's update. AsyncDatabase runs each call on
+a bounded thread pool instead: handlers await the result, the loop keeps
+serving other updates, and at most ``max_workers`` queries (and so database
+connections) are active at once.
+"""
+
+import asyncio
+import functools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncDatabase:
+    """``await db.<name>(...)`` runs the registered blocking function off the loop"""
+
+    def __init__(self, functions, max_workers=8, slow_query_ms=500):
+        """
+        functions: mapping of name -> blocking database function
+        max_workers: size of the thread pool, i.e. concurrent queries
+        slow_query_ms: calls slower than this are logged
+        """
+        self._functions = dict(functions)
+        self.max_workers = max_workers
+        self.slow_query_ms = slow_query_ms
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='db')
+        self._timings = {}  # name -> [count, total_ms, max_ms]
+        self.in_flight = 0
+        self.counters = {'calls': 0, 'errors': 0, 'slow': 0, 'queued_ms_total': 0.0}
+
+    def __getattr__(self, name):
+        try:
+            func = self.__dict__['_functions'][name]
+        except KeyError:
+            raise AttributeError(name) from None
+        return functools.partial(self.run, func)
+
+    async def run(self, func, *args, **kwargs):
+        """Run any blocking ``func(*args, **kwargs)`` on the database pool"""
+        name = getattr(func, '__name__', repr(func))
+        submitted = time.perf_counter()
+        started = None
+
+        def call():
+            nonlocal started
+            started = time.perf_counter()
+            return func(*args, **kwargs)
+
+        self.counters['calls'] += 1
+        self.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, call)
+        except Exception:
+            self.counters['errors'] += 1
+            raise
+        finally:
+            self.in_flight -= 1
+            done = time.perf_counter()
+            if started is not None:
+                self.counters['queued_ms_total'] += (started - submitted) * 1000
+                self._record(name, (done - started) * 1000)
+
+    def _record(self, name, took):
+        timing = self._timings.get(name)
+        if timing is None:
+            timing = self._timings[name] = [0, 0.0, 0.0]
+        timing[0] += 1
+        timing[1] += took
+        timing[2] = max(timing[2], took)
+        if took > self.slow_query_ms:
+            self.counters['slow'] += 1
+            logger.warning(f"Slow database call {name}: {took:.0f}ms")
+
+    def shutdown(self):
+        """Wait for running queries and stop the pool"""
+        self._executor.shutdown(wait=True)
+
+    def stats(self):
+        calls = self.counters['calls']
+        return {
+            'calls': calls,
+            'errors': self.counters['errors'],
+            'slow': self.counters['slow'],
+            'in_flight': self.in_flight,
+            'max_workers': self.max_workers,
+            'avg_queue_ms': round(self.counters['queued_ms_total'] / calls, 1) if calls else 0.0,
+        }
+
+    def query_stats(self):
+        """Per-function latency, slowest total time first"""
+        return {
+            name: f"{count} calls, avg {total / count:.1f}ms, max {peak:.1f}ms"
+            for name, (count, total, peak) in sorted(
+                self._timings.items(), key=lambda item: item[1][1], reverse=True)
+        }
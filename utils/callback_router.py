@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Table-driven dispatch of inline-button callback data.
+
+Callback data is either an exact action name ("finish_order") or a prefix
+followed by a payload ("qty_inc_123"). Exact names are one dict lookup;
+prefixed actions are found by looking up each underscore-terminated head of
+the data, so dispatch cost doesn't grow with the number of routes. Payloads
+are parsed once into keyword arguments for the handler, and every route
+records its own call count and latency.
+"""
+
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def product_payload(rest):
+    """Default payload parser: the rest of the data is a product id"""
+    return {'product_id': rest}
+
+
+def product_index_payload(rest):
+    """'<product_id>_<index>' -> product id (may contain '_') and int index"""
+    product_id, sep, index = rest.rpartition('_')
+    if not sep or not product_id:
+        raise ValueError(f"expected <product_id>_<index>, got {rest!r}")
+    return {'product_id': product_id, 'index': int(index)}
+
+
+class CallbackRouter:
+    """Maps callback data to handlers ``async handler(update, context, **fields)``"""
+
+    def __init__(self, separator='_'):
+        self.separator = separator
+        self._exact = {}  # data -> handler
+        self._prefixes = {}  # prefix (ending in separator) -> (handler, parse)
+        self._timings = {}  # route name -> [count, total_ms, max_ms]
+        self.counters = {'dispatched': 0, 'unmatched': 0, 'bad_payload': 0, 'errors': 0}
+
+    def exact(self, data, handler):
+        self._exact[data] = handler
+        return handler
+
+    def prefix(self, prefix, handler, parse=product_payload):
+        if not prefix.endswith(self.separator):
+            raise ValueError(f"prefix {prefix!r} must end with {self.separator!r}")
+        for other in self._prefixes:
+            if other.startswith(prefix) or prefix.startswith(other):
+                raise ValueError(f"prefix {prefix!r} overlaps {other!r}")
+        self._prefixes[prefix] = (handler, parse)
+        return handler
+
+    def resolve(self, data):
+        """Return (route name, handler, fields), or None if nothing matches.
+
+        Raises ValueError if a prefix matches but its payload doesn't parse.
+        """
+        handler = self._exact.get(data)
+        if handler is not None:
+            return data, handler, {}
+        sep = self.separator
+        end = data.find(sep)
+        while end != -1:
+            head = data[:end + 1]
+            route = self._prefixes.get(head)
+            if route is not None:
+                handler, parse = route
+                return head, handler, parse(data[end + 1:])
+            end = data.find(sep, end + 1)
+        return None
+
+    async def dispatch(self, update, context):
+        data = update.callback_query.data or ''
+        try:
+            resolved = self.resolve(data)
+        except ValueError as e:
+            self.counters['bad_payload'] += 1
+            logger.warning(f"Malformed callback data {data!r}: {e}")
+            return
+        if resolved is None:
+            self.counters['unmatched'] += 1
+            logger.warning(f"No callback route for {data!r}")
+            return
+
+        name, handler, fields = resolved
+        self.counters['dispatched'] += 1
+        started = time.perf_counter()
+        try:
+            await handler(update, context, **fields)
+        except Exception:
+            self.counters['errors'] += 1
+            raise
+        finally:
+            took = (time.perf_counter() - started) * 1000
+            timing = self._timings.get(name)
+            if timing is None:
+                timing = self._timings[name] = [0, 0.0, 0.0]
+            timing[0] += 1
+            timing[1] += took
+            timing[2] = max(timing[2], took)
+
+    def stats(self):
+        return {**self.counters, 'routes': len(self._exact) + len(self._prefixes)}
+
+    def route_stats(self):
+        """Per-route latency, slowest total time first"""
+        return {
+            name: f"{count} calls, avg {total / count:.1f}ms, max {peak:.1f}ms"
+            for name, (count, total, peak) in sorted(
+                self._timings.items(), key=lambda item: item[1][1], reverse=True)
+        }
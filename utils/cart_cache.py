@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Per-user cart cache in front of config.database.
+
+Each user's cart is read from the database once and then served from memory,
+indexed by product id. Every write goes to the database first and is then
+applied to (or, where the database merges rows itself, invalidates) the
+cached copy, so the cache never disagrees with a successful write. The
+database functions are awaited (see utils.async_db), so a miss never blocks
+the event loop.
+"""
+
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class CartCache:
+    """Write-through cache of user carts keyed by user id, then product id"""
+
+    def __init__(self, load_cart, add_item, update_quantity, remove_item, clear_cart,
+                 maxsize=10000):
+        """
+        All are async callables:
+        load_cart(user_id) -> list of cart item dicts
+        add_item(user_id, product_id, quantity) -> bool
+        update_quantity(user_id, product_id, quantity) -> bool
+        remove_item(user_id, product_id)
+        clear_cart(user_id)
+        """
+        self._load_cart = load_cart
+        self._add_item = add_item
+        self._update_quantity = update_quantity
+        self._remove_item = remove_item
+        self._clear_cart = clear_cart
+        self.maxsize = maxsize
+        self._carts = OrderedDict()  # user_id -> OrderedDict(product_id -> item)
+        self.counters = {'hits': 0, 'loads': 0}
+
+    async def _cart(self, user_id):
+        carts = self._carts
+        cart = carts.get(user_id)
+        if cart is None:
+            self.counters['loads'] += 1
+            items = await self._load_cart(user_id)
+            cart = OrderedDict(
+                (str(item['product_id']), item) for item in (items or [])
+                if item and isinstance(item, dict)
+            )
+            # Don't cache a cart read before invalidate_all swapped the dict
+            if carts is self._carts:
+                carts[user_id] = cart
+                while len(carts) > self.maxsize:
+                    carts.popitem(last=False)
+        else:
+            self.counters['hits'] += 1
+            carts.move_to_end(user_id)
+        return cart
+
+    # --- Reads ---
+    async def get_cart(self, user_id):
+        """All cart items of a user, in the order they were added"""
+        return list((await self._cart(user_id)).values())
+
+    async def get_item(self, user_id, product_id):
+        """The cart item for one product, or None"""
+        return (await self._cart(user_id)).get(str(product_id))
+
+    # --- Writes (database first, then cache) ---
+    async def add(self, user_id, product_id, quantity):
+        ok = await self._add_item(user_id, product_id, quantity)
+        # The database decides how an existing line is merged; re-read next time
+        self.invalidate(user_id)
+        return ok
+
+    async def update_quantity(self, user_id, product_id, quantity):
+        ok = await self._update_quantity(user_id, product_id, quantity)
+        if ok:
+            item = self._carts.get(user_id, {}).get(str(product_id))
+            if item is not None:
+                item['quantity'] = quantity
+            else:
+                self.invalidate(user_id)
+        return ok
+
+    async def remove(self, user_id, product_id):
+        result = await self._remove_item(user_id, product_id)
+        cart = self._carts.get(user_id)
+        if cart is not None:
+            cart.pop(str(product_id), None)
+        return result
+
+    async def clear(self, user_id):
+        result = await self._clear_cart(user_id)
+        self._carts[user_id] = OrderedDict()
+        return result
+
+    # --- Invalidation ---
+    def invalidate(self, user_id):
+        self._carts.pop(user_id, None)
+
+    def invalidate_all(self):
+        """Forget every cart, e.g. after product names or prices changed.
+
+        Safe to call from a worker thread: the dict is swapped, not mutated.
+        """
+        self._carts = OrderedDict()
+
+    def stats(self):
+        return {**self.counters, 'users': len(self._carts)}
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Local mirror of the WooCommerce catalog.
+
+A background job pulls every published product page by page, then polls
+only products modified since the newest one it has seen. The incremental
+poll asks for products in any status, so a product that is unpublished,
+made private or trashed is removed from the mirror on the next poll; only
+a product deleted outright stays until the next full sync. A product that
+can't be parsed (e.g. an empty price) is logged and skipped. Lookups read
+an in-memory dict; the mirror is also kept in a small SQLite file so a
+restart starts warm instead of empty.
+"""
+
+import asyncio
+import json
+import logging
+import sqlite3
+
+from utils.woocommerce import PRODUCT_FIELDS
+
+logger = logging.getLogger(__name__)
+
+
+class CatalogMirror:
+    """In-memory product catalog kept in sync with WooCommerce"""
+
+    def __init__(self, wc_client, parse_product, path='catalog.db', on_products=None,
+                 on_removed=None, per_page=100):
+        """
+        wc_client: utils.woocommerce.WooCommerceClient
+        parse_product: callable(raw_product, sku) -> product_info dict
+        on_products: optional async callable(list of product_info) awaited
+            after a sync that changed products, e.g. to update the main
+            database on its own executor
+        on_removed: optional callable(list of skus) run after a sync that
+            removed products no longer published
+        """
+        self.wc_client = wc_client
+        self.parse_product = parse_product
+        self.path = path
+        self.on_products = on_products
+        self.on_removed = on_removed
+        self.per_page = per_page
+        self.products = {}  # sku -> product_info
+        self.last_modified = None  # newest date_modified_gmt seen
+        self.ready = False
+        self.counters = {'full_syncs': 0, 'incremental_syncs': 0, 'sync_errors': 0,
+                         'products_synced': 0, 'products_changed': 0, 'products_removed': 0,
+                         'parse_errors': 0}
+
+    def get(self, sku):
+        return self.products.get(str(sku))
+
+    def has(self, sku):
+        return str(sku) in self.products
+
+    # --- Persistence (runs in a worker thread) ---
+    def _connect(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS products "
+            "(sku TEXT PRIMARY KEY, data TEXT NOT NULL, modified TEXT)"
+        )
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        return conn
+
+    def _read(self):
+        with self._connect() as conn:
+            rows = conn.execute("SELECT sku, data FROM products").fetchall()
+            meta = conn.execute("SELECT value FROM meta WHERE key = 'last_modified'").fetchone()
+        conn.close()
+        return {sku: json.loads(data) for sku, data in rows}, (meta[0] if meta else None)
+
+    def _write(self, changed, removed):
+        with self._connect() as conn:
+            conn.executemany("DELETE FROM products WHERE sku = ?", [(sku,) for sku in removed])
+            conn.executemany(
+                "INSERT OR REPLACE INTO products (sku, data, modified) VALUES (?, ?, ?)",
+                [(sku, json.dumps(info, ensure_ascii=False), modified)
+                 for sku, info, modified in changed],
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('last_modified', ?)",
+                (self.last_modified,),
+            )
+        conn.close()
+
+    async def _store(self, changed, removed):
+        await asyncio.to_thread(self._write, changed, removed)
+        # Only real changes: polling modified_after returns the newest product again
+        if self.on_products and changed:
+            await self.on_products([info for _, info, _ in changed])
+
+    async def load(self):
+        """Warm the mirror from the local SQLite file"""
+        try:
+            self.products, self.last_modified = await asyncio.to_thread(self._read)
+        except sqlite3.Error as e:
+            logger.error(f"Could not read catalog mirror {self.path}: {e}")
+            return
+        self.ready = bool(self.products)
+        logger.info(f"Catalog mirror loaded {len(self.products)} products from {self.path}")
+
+    # --- Sync ---
+    async def _fetch_all(self, status='publish', **params):
+        """Rows of (sku, product_info, date_modified_gmt, status)"""
+        fields = f"{PRODUCT_FIELDS},date_modified_gmt,status"
+        page = 1
+        rows = []
+        while True:
+            batch = await self.wc_client.get_products(
+                fields=fields, status=status, per_page=self.per_page, page=page,
+                orderby='modified', order='asc', timeout=30, **params
+            )
+            for raw in batch:
+                sku = str(raw.get('sku') or '')
+                if not sku:
+                    continue
+                try:
+                    info = self.parse_product(raw, sku)
+                except (ValueError, TypeError, KeyError) as e:
+                    # One malformed product (e.g. an empty price) must not abort the sync
+                    self.counters['parse_errors'] += 1
+                    logger.warning(f"Catalog skipped product {sku}: {e}")
+                    continue
+                rows.append((sku, info, raw.get('date_modified_gmt'), raw.get('status', status)))
+            if len(batch) < self.per_page:
+                return rows
+            page += 1
+
+    async def _apply(self, rows, replace_all):
+        published = {sku: (info, modified) for sku, info, modified, status in rows
+                     if status == 'publish'}
+        if replace_all:
+            removed = [sku for sku in self.products if sku not in published]
+        else:
+            removed = [sku for sku, _, _, status in rows
+                       if status != 'publish' and sku in self.products]
+        changed = [(sku, info, modified) for sku, (info, modified) in published.items()
+                   if self.products.get(sku) != info]
+        for sku in removed:
+            del self.products[sku]
+        for sku, info, _ in changed:
+            self.products[sku] = info
+        modified = [m for _, _, m, _ in rows if m]
+        if modified:
+            self.last_modified = max([self.last_modified or ''] + modified)
+        self.ready = True
+        self.counters['products_synced'] += len(rows)
+        self.counters['products_changed'] += len(changed)
+        self.counters['products_removed'] += len(removed)
+        await self._store(changed, removed)
+        if removed:
+            logger.info(f"Catalog removed {len(removed)} products no longer published")
+            if self.on_removed:
+                self.on_removed(removed)
+
+    async def update(self, products):
+        """Apply product_info fetched elsewhere (e.g. checkout revalidation).
+
+        Only products already in the mirror are updated; returns their SKUs.
+        """
+        mirrored = [info for info in products if str(info['product_id']) in self.products]
+        changed = [(str(info['product_id']), info, None) for info in mirrored
+                   if self.products[str(info['product_id'])] != info]
+        for sku, info, _ in changed:
+            self.products[sku] = info
+        if changed:
+            self.counters['products_changed'] += len(changed)
+            await self._store(changed, [])
+        return [str(info['product_id']) for info in mirrored]
+
+    async def full_sync(self):
+        rows = await self._fetch_all()
+        await self._apply(rows, replace_all=True)
+        self.counters['full_syncs'] += 1
+        logger.info(f"Catalog full sync: {len(rows)} products")
+
+    async def incremental_sync(self):
+        if not self.last_modified:
+            return await self.full_sync()
+        # Unpublished, private and trashed products must leave the mirror too;
+        # 'any' excludes the trash, so that is asked for separately
+        since = {'modified_after': self.last_modified, 'dates_are_gmt': 'true'}
+        rows = await self._fetch_all(status='any', **since)
+        rows += await self._fetch_all(status='trash', **since)
+        await self._apply(rows, replace_all=False)
+        self.counters['incremental_syncs'] += 1
+        if rows:
+            logger.info(f"Catalog incremental sync: {len(rows)} changed products")
+
+    async def run(self, interval=60, full_interval=6 * 3600):
+        """Sync forever: full pull on start and every full_interval, else incremental.
+
+        A failed full pull is retried with exponential backoff (capped at
+        full_interval) instead of on every pass.
+        """
+        loop = asyncio.get_running_loop()
+        next_full = loop.time()
+        full_failures = 0
+        while True:
+            full = loop.time() >= next_full
+            try:
+                if full:
+                    await self.full_sync()
+                    next_full = loop.time() + full_interval
+                    full_failures = 0
+                elif self.last_modified:
+                    await self.incremental_sync()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.counters['sync_errors'] += 1
+                if full:
+                    full_failures += 1
+                    retry = min(full_interval, interval * 2 ** full_failures)
+                    next_full = loop.time() + retry
+                    logger.error(f"Catalog full sync failed, retrying in {retry:.0f}s: {e}")
+                else:
+                    logger.error(f"Catalog sync failed: {e}")
+            await asyncio.sleep(interval)
+
+    def stats(self):
+        return {**self.counters, 'size': len(self.products), 'ready': self.ready,
+                'last_modified': self.last_modified}
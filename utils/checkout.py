@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Idempotent order placement.
+
+Every checkout path goes through CheckoutService.checkout(). The order is
+keyed by a digest of the user's cart snapshot: a second submission of the
+same cart (double tap, retried update) gets the first order back, marked as
+a duplicate, instead of creating another one. Concurrent submissions share
+one in-flight placement.
+
+The key is written to SQLite as pending before the order is created, with
+the user's newest order id at that moment. If the bot stops between
+creating the order and recording it, the retry finds the pending key and
+looks for a matching order newer than that id before placing a new one.
+
+Only each user's last checkout is remembered (for ``ttl`` seconds), and
+forget() is called when the cart changes, so ordering the same items again
+later is a new order.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def cart_snapshot_key(user_id, cart_items):
+    """Digest of the user and their cart lines (product, quantity, price)"""
+    lines = sorted(
+        (str(item['product_id']), int(item['quantity']), str(item.get('price')))
+        for item in cart_items
+    )
+    payload = json.dumps([str(user_id), lines], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class CheckoutService:
+    """Places each distinct cart snapshot at most once"""
+
+    def __init__(self, place_order, latest_order_id, find_order, path='checkout.db',
+                 ttl=3600):
+        """
+        All are async callables:
+        place_order(user_id, cart_items, customer_name, customer_phone) -> order id
+            (falsy on failure); creates the order and empties the cart
+        latest_order_id(user_id) -> the user's newest order id, or None
+        find_order(user_id, cart_items, after_order_id) -> id of an order newer
+            than after_order_id matching the cart, or None
+        """
+        self._place_order = place_order
+        self._latest_order_id = latest_order_id
+        self._find_order = find_order
+        self.path = path
+        self.ttl = ttl
+        # user_id -> (key, order_id or None while pending, placed_at, after_order_id)
+        self._last = {}
+        self._generation = {}  # user_id -> number of forget() calls, see _place
+        self._inflight = {}  # key -> task
+        self.counters = {'placed': 0, 'duplicates': 0, 'coalesced': 0, 'reconciled': 0,
+                         'failed': 0}
+
+    # --- SQLite (worker thread) ---
+    def _connect(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS checkout_keys (user_id INTEGER PRIMARY KEY, "
+            "key TEXT NOT NULL, order_id INTEGER, placed_at REAL NOT NULL, "
+            "after_order_id INTEGER)"
+        )
+        return conn
+
+    def _read(self, cutoff):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM checkout_keys WHERE placed_at < ?", (cutoff,))
+            rows = conn.execute(
+                "SELECT user_id, key, order_id, placed_at, after_order_id FROM checkout_keys"
+            )
+            return {row[0]: tuple(row[1:]) for row in rows}
+        finally:
+            conn.close()
+
+    def _execute(self, sql, params):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(sql, params)
+        finally:
+            conn.close()
+
+    async def _save(self, user_id, entry):
+        self._last[user_id] = entry
+        await asyncio.to_thread(
+            self._execute,
+            "INSERT OR REPLACE INTO checkout_keys "
+            "(user_id, key, order_id, placed_at, after_order_id) VALUES (?, ?, ?, ?, ?)",
+            (user_id, *entry),
+        )
+
+    async def _delete(self, user_id):
+        self._last.pop(user_id, None)
+        await asyncio.to_thread(
+            self._execute, "DELETE FROM checkout_keys WHERE user_id = ?", (user_id,)
+        )
+
+    async def load(self):
+        try:
+            self._last = await asyncio.to_thread(self._read, time.time() - self.ttl)
+        except sqlite3.Error as e:
+            logger.error(f"Could not read checkout keys from {self.path}: {e}")
+
+    # --- Checkout ---
+    def _entry(self, user_id, key):
+        entry = self._last.get(user_id)
+        if entry is None or entry[0] != key or time.time() - entry[2] > self.ttl:
+            return None
+        return entry
+
+    async def forget(self, user_id):
+        """The user's cart is changing: the next checkout is a new order"""
+        self._generation[user_id] = self._generation.get(user_id, 0) + 1
+        if user_id not in self._last:
+            return
+        try:
+            await self._delete(user_id)
+        except sqlite3.Error as e:
+            logger.error(f"Could not forget checkout of user {user_id}: {e}")
+
+    async def checkout(self, user_id, cart_items, customer_name, customer_phone):
+        """Place the cart as an order.
+
+        Returns {'order_id', 'duplicate'} or None if the order could not be created.
+        """
+        key = cart_snapshot_key(user_id, cart_items)
+        entry = self._entry(user_id, key)
+        if entry is not None and entry[1] is not None:
+            self.counters['duplicates'] += 1
+            logger.info(f"Repeated checkout of user {user_id} returns order {entry[1]}")
+            return {'order_id': entry[1], 'duplicate': True}
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.counters['coalesced'] += 1
+            result = await asyncio.shield(task)
+            return {**result, 'duplicate': True} if result else None
+
+        task = asyncio.create_task(
+            self._place(key, entry, user_id, cart_items, customer_name, customer_phone)
+        )
+        self._inflight[key] = task
+        task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # Shielded so a cancelled handler doesn't abort a half-placed order
+        return await asyncio.shield(task)
+
+    async def _place(self, key, pending, user_id, cart_items, customer_name, customer_phone):
+        generation = self._generation.get(user_id, 0)
+        if pending is not None:
+            # An earlier attempt stopped after marking the key: did it create the order?
+            order_id = await self._find_order(user_id, cart_items, pending[3])
+            if order_id:
+                self.counters['reconciled'] += 1
+                logger.info(f"Checkout of user {user_id} matches unrecorded order {order_id}")
+                await self._record(user_id, generation, (key, order_id, *pending[2:]))
+                return {'order_id': order_id, 'duplicate': True}
+            after_order_id = pending[3]
+        else:
+            after_order_id = await self._latest_order_id(user_id)
+
+        placed_at = time.time()
+        try:
+            await self._save(user_id, (key, None, placed_at, after_order_id))
+        except sqlite3.Error as e:
+            logger.error(f"Could not mark checkout of user {user_id} as pending: {e}")
+
+        order_id = await self._place_order(user_id, cart_items, customer_name, customer_phone)
+        if not order_id:
+            self.counters['failed'] += 1
+            try:
+                await self._delete(user_id)
+            except sqlite3.Error as e:
+                logger.error(f"Could not clear pending checkout of user {user_id}: {e}")
+            return None
+        self.counters['placed'] += 1
+        await self._record(user_id, generation, (key, order_id, placed_at, after_order_id))
+        return {'order_id': order_id, 'duplicate': False}
+
+    async def _record(self, user_id, generation, entry):
+        try:
+            if self._generation.get(user_id, 0) != generation:
+                # The cart changed while the order was being placed; this key is stale
+                await self._delete(user_id)
+            else:
+                await self._save(user_id, entry)
+        except sqlite3.Error as e:
+            logger.error(f"Could not record checkout key of order {entry[1]}: {e}")
+
+    def stats(self):
+        pending = sum(1 for entry in self._last.values() if entry[1] is None)
+        return {**self.counters, 'remembered': len(self._last), 'pending': pending,
+                'in_flight': len(self._inflight)}
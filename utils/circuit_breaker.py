@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Circuit breaker for calls to an upstream service (WooCommerce).
+
+After enough consecutive failures or slow calls the circuit opens and every
+call fails immediately with CircuitOpenError. While open, a background probe
+checks the upstream periodically and closes the circuit once it answers, so
+no user request ever has to wait on a dead server to find out.
+"""
+
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the upstream while the circuit is open"""
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+
+    def __init__(self, name, probe=None, failure_threshold=5, slow_call_seconds=2.0,
+                 probe_interval=15):
+        """
+        probe: async callable() that raises if the upstream is still unhealthy
+        failure_threshold: consecutive failed or slow calls before opening
+        slow_call_seconds: a successful call slower than this counts as a failure
+        probe_interval: seconds between recovery probes while open
+        """
+        self.name = name
+        self.probe = probe
+        self.failure_threshold = failure_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.probe_interval = probe_interval
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._probe_task = None
+        self.counters = {'calls': 0, 'failures': 0, 'slow_calls': 0, 'rejected': 0,
+                         'trips': 0, 'probes': 0}
+
+    @property
+    def is_open(self):
+        return self.state == self.OPEN
+
+    async def call(self, func, *args, **kwargs):
+        if self.is_open:
+            self.counters['rejected'] += 1
+            raise CircuitOpenError(f"{self.name} circuit is open")
+
+        self.counters['calls'] += 1
+        started = time.monotonic()
+        try:
+            result = await func(*args, **kwargs)
+        except Exception:
+            self.counters['failures'] += 1
+            self._record_failure()
+            raise
+        if time.monotonic() - started > self.slow_call_seconds:
+            self.counters['slow_calls'] += 1
+            self._record_failure()
+        else:
+            self.consecutive_failures = 0
+        return result
+
+    def _record_failure(self):
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.failure_threshold and not self.is_open:
+            self._open()
+
+    def _open(self):
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+        self.counters['trips'] += 1
+        logger.warning(f"{self.name} circuit opened after {self.consecutive_failures} failures")
+        if self.probe and (self._probe_task is None or self._probe_task.done()):
+            self._probe_task = asyncio.create_task(self._probe_until_healthy())
+
+    def close(self):
+        if self.is_open:
+            open_for = time.monotonic() - self.opened_at
+            logger.info(f"{self.name} circuit closed after {open_for:.0f}s")
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+
+    async def _probe_until_healthy(self):
+        while self.is_open:
+            await asyncio.sleep(self.probe_interval)
+            self.counters['probes'] += 1
+            started = time.monotonic()
+            try:
+                await self.probe()
+            except Exception as e:
+                logger.info(f"{self.name} probe failed: {e}")
+                continue
+            if time.monotonic() - started <= self.slow_call_seconds:
+                self.close()
+
+    def stats(self):
+        return {**self.counters, 'state': self.state,
+                'consecutive_failures': self.consecutive_failures}
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Debouncing of repeated edits to the same Telegram message.
+
+The first request for a message renders immediately; further requests
+within the window are folded into one trailing render, which reads the
+latest state when it runs. A message is therefore edited at most once per
+window however fast the user taps.
+"""
+
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class EditDebouncer:
+    """At most one render per key (e.g. chat id + message id) per window"""
+
+    def __init__(self, window=0.7, max_tracked=5000):
+        self.window = window
+        self.max_tracked = max_tracked
+        self._last = {}  # key -> loop time of the last render
+        self._pending = {}  # key -> scheduled trailing render task
+        self.counters = {'requests': 0, 'renders': 0, 'coalesced': 0}
+
+    async def request(self, key, render):
+        """Ask for ``render`` (async callable, no args) to run for ``key``"""
+        self.counters['requests'] += 1
+        if key in self._pending:
+            self.counters['coalesced'] += 1
+            return
+        loop = asyncio.get_running_loop()
+        wait = self._last.get(key, 0) + self.window - loop.time()
+        if wait <= 0:
+            await self._render(key, render)
+        else:
+            self._pending[key] = asyncio.create_task(self._render_later(key, wait, render))
+
+    async def _render_later(self, key, wait, render):
+        try:
+            await asyncio.sleep(wait)
+            await self._render(key, render)
+        finally:
+            self._pending.pop(key, None)
+
+    async def _render(self, key, render):
+        self._last[key] = asyncio.get_running_loop().time()
+        if len(self._last) > self.max_tracked:
+            self._prune()
+        self.counters['renders'] += 1
+        try:
+            await render()
+        except Exception as e:
+            logger.error(f"Debounced render for {key} failed: {e}", exc_info=True)
+
+    def _prune(self):
+        cutoff = asyncio.get_running_loop().time() - self.window
+        self._last = {k: t for k, t in self._last.items() if t >= cutoff}
+
+    def stats(self):
+        return {**self.counters, 'pending': len(self._pending)}
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Expiry of per-user state after a period of inactivity.
+
+Activity is recorded with touch(); expiry uses a hashed timer wheel instead
+of periodically scanning every user. Each tracked key sits in exactly one
+wheel slot. When its slot comes due the key is either expired or, if it was
+touched in the meantime, moved to the slot of its new deadline. touch() and
+each expiry or reschedule are O(1), so the cost of a tick depends on the
+keys due in it, not on how many users the bot has seen.
+"""
+
+import asyncio
+import logging
+import math
+import pickle
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def approximate_size(value):
+    """Serialized size in bytes, a cheap stand-in for memory held by a value"""
+    try:
+        return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return 0
+
+
+class IdleSweeper:
+    """Calls on_expire(key) for keys not touched for ``idle_seconds``"""
+
+    def __init__(self, idle_seconds, tick=60, clock=time.monotonic):
+        self.idle_seconds = idle_seconds
+        self.tick = tick
+        self._clock = clock
+        # Deadlines are at most idle_seconds ahead, so one lap of the wheel covers them
+        self._slots = [set() for _ in range(math.ceil(idle_seconds / tick) + 2)]
+        self._last_seen = {}  # key -> last activity time
+        self._due_tick = {}  # key -> tick number of the slot holding it
+        self._current_tick = int(clock() // tick)
+        self.counters = {'expired': 0, 'rescheduled': 0, 'bytes_reclaimed': 0}
+
+    def _schedule(self, key, deadline):
+        due = max(int(deadline // self.tick) + 1, self._current_tick + 1)
+        # While advance() lags behind the clock the deadline can be more than a
+        # lap past _current_tick; the key is checked early and rescheduled then
+        due = min(due, self._current_tick + len(self._slots) - 1)
+        self._slots[due % len(self._slots)].add(key)
+        self._due_tick[key] = due
+
+    def touch(self, key):
+        now = self._clock()
+        self._last_seen[key] = now
+        if key not in self._due_tick:
+            self._schedule(key, now + self.idle_seconds)
+
+    def advance(self, on_expire):
+        """Process every slot that came due since the last call"""
+        now = self._clock()
+        target = int(now // self.tick)
+        expired = []
+        while self._current_tick < target:
+            self._current_tick += 1
+            index = self._current_tick % len(self._slots)
+            bucket, self._slots[index] = self._slots[index], set()
+            for key in bucket:
+                if self._due_tick.get(key) != self._current_tick:
+                    continue
+                del self._due_tick[key]
+                deadline = self._last_seen[key] + self.idle_seconds
+                if deadline > now:
+                    self.counters['rescheduled'] += 1
+                    self._schedule(key, deadline)
+                else:
+                    del self._last_seen[key]
+                    expired.append(key)
+
+        for key in expired:
+            try:
+                reclaimed = on_expire(key) or 0
+            except Exception as e:
+                logger.error(f"Expiring idle state of {key} failed: {e}", exc_info=True)
+                continue
+            self.counters['expired'] += 1
+            self.counters['bytes_reclaimed'] += reclaimed
+        if expired:
+            logger.info(f"Expired idle state of {len(expired)} users")
+        return expired
+
+    async def run(self, on_expire):
+        """Advance the wheel once per tick until cancelled"""
+        while True:
+            await asyncio.sleep(self.tick)
+            self.advance(on_expire)
+
+    def stats(self):
+        return {**self.counters, 'tracked': len(self._last_seen),
+                'idle_seconds': self.idle_seconds}
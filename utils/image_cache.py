@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+Optimised product images in a size-bounded on-disk LRU cache.
+
+WooCommerce serves the original uploads, which are often several megabytes.
+Each image is downloaded once, downsized and recompressed to a JPEG Telegram
+handles well, and kept on disk so the bot can upload the small bytes itself
+instead of asking Telegram to fetch the original from the shop server.
+
+Pillow is optional: without it the original bytes are cached as-is as long
+as they fit Telegram's photo upload limit.
+"""
+
+import asyncio
+import hashlib
+import io
+import logging
+import os
+import tempfile
+from collections import OrderedDict
+
+import httpx
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # pragma: no cover - optional dependency
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Telegram rejects uploaded photos larger than this
+TELEGRAM_PHOTO_LIMIT = 10 * 1024 * 1024
+
+
+class ImageCache:
+    """Download, optimise and cache images by URL; least recently used evicted first"""
+
+    def __init__(self, directory='image_cache', max_bytes=200 * 1024 * 1024, max_side=1280,
+                 quality=85, max_download=25 * 1024 * 1024, timeout=15.0, prefetch_concurrency=4):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_side = max_side
+        self.quality = quality
+        self.max_download = max_download
+        self.timeout = timeout
+        self._entries = OrderedDict()  # file name -> size, least recently used first
+        self._total = 0
+        self._inflight = {}  # url -> task
+        self._prefetching = {}  # url -> background prefetch task
+        self._prefetch_slots = asyncio.Semaphore(prefetch_concurrency)
+        self._client = None
+        self.counters = {'hits': 0, 'misses': 0, 'downloaded_bytes': 0, 'stored_bytes': 0,
+                         'evictions': 0, 'errors': 0, 'prefetches': 0}
+
+    @staticmethod
+    def _name(url):
+        return hashlib.sha256(url.encode('utf-8')).hexdigest() + '.jpg'
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    # --- Index ---
+    def _scan(self):
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith('.jpg'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        entries.sort()
+        return OrderedDict((name, size) for _, name, size in entries)
+
+    async def load(self):
+        """Rebuild the LRU index from the files on disk (oldest access first)"""
+        self._entries = await asyncio.to_thread(self._scan)
+        self._total = sum(self._entries.values())
+        logger.info(f"Image cache has {len(self._entries)} files, {self._total // 1024} KiB")
+
+    def _get_client(self):
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(timeout=self.timeout, follow_redirects=True)
+        return self._client
+
+    # --- Reads ---
+    def has(self, url):
+        return self._name(url) in self._entries
+
+    async def get(self, url):
+        """Optimised bytes for ``url``, downloading on a miss; None if unavailable"""
+        name = self._name(url)
+        if name in self._entries:
+            try:
+                data = await asyncio.to_thread(self._read, name)
+            except OSError:
+                self._forget(name)
+            else:
+                self.counters['hits'] += 1
+                self._entries.move_to_end(name)
+                return data
+        self.counters['misses'] += 1
+        task = self._inflight.get(url)
+        if task is None:
+            task = asyncio.create_task(self._fetch(url, name))
+            self._inflight[url] = task
+            task.add_done_callback(lambda _: self._inflight.pop(url, None))
+        # Shielded so a cancelled caller doesn't abort a download others share
+        return await asyncio.shield(task)
+
+    def _read(self, name):
+        path = self._path(name)
+        with open(path, 'rb') as f:
+            data = f.read()
+        os.utime(path)  # keeps the LRU order across restarts
+        return data
+
+    async def _fetch(self, url, name):
+        try:
+            original = await self._download(url)
+            data = await asyncio.to_thread(self._optimise, original)
+            if data is None:
+                return None
+            await asyncio.to_thread(self._write, name, data)
+        except (httpx.HTTPError, OSError, ValueError) as e:
+            self.counters['errors'] += 1
+            logger.warning(f"Could not cache image {url}: {e}")
+            return None
+        self._forget(name)
+        self._entries[name] = len(data)
+        self._total += len(data)
+        self.counters['stored_bytes'] += len(data)
+        await self._evict()
+        return data
+
+    async def _download(self, url):
+        chunks = []
+        size = 0
+        async with self._get_client().stream('GET', url) as response:
+            response.raise_for_status()
+            async for chunk in response.aiter_bytes():
+                size += len(chunk)
+                if size > self.max_download:
+                    raise ValueError(f"image larger than {self.max_download} bytes")
+                chunks.append(chunk)
+        self.counters['downloaded_bytes'] += size
+        return b''.join(chunks)
+
+    def _optimise(self, original):
+        if Image is None:
+            return original if len(original) <= TELEGRAM_PHOTO_LIMIT else None
+        try:
+            with Image.open(io.BytesIO(original)) as image:
+                image = ImageOps.exif_transpose(image)
+                if image.mode != 'RGB':
+                    # Flatten transparency onto white, as Telegram would show it on a light theme
+                    background = Image.new('RGB', image.size, (255, 255, 255))
+                    rgba = image.convert('RGBA')
+                    background.paste(rgba, mask=rgba.getchannel('A'))
+                    image = background
+                image.thumbnail((self.max_side, self.max_side), Image.LANCZOS)
+                out = io.BytesIO()
+                image.save(out, 'JPEG', quality=self.quality, optimize=True, progressive=True)
+        except (OSError, Image.DecompressionBombError) as e:
+            raise ValueError(f"not a usable image: {e}") from e
+        data = out.getvalue()
+        # A small, already-compressed original can beat the re-encode
+        return original if len(original) < len(data) and original[:3] == b'\xff\xd8\xff' else data
+
+    def _write(self, name, data):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, self._path(name))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    # --- Eviction ---
+    def _forget(self, name):
+        size = self._entries.pop(name, None)
+        if size is not None:
+            self._total -= size
+
+    async def _evict(self):
+        victims = []
+        while self._total > self.max_bytes and len(self._entries) > 1:
+            name, size = self._entries.popitem(last=False)
+            self._total -= size
+            victims.append(name)
+        if victims:
+            self.counters['evictions'] += len(victims)
+            await asyncio.to_thread(self._unlink, victims)
+
+    def _unlink(self, names):
+        for name in names:
+            try:
+                os.unlink(self._path(name))
+            except FileNotFoundError:
+                pass
+
+    async def discard(self, urls):
+        """Drop cached files for URLs whose content may have changed"""
+        names = [self._name(url) for url in urls]
+        names = [name for name in names if name in self._entries]
+        for name in names:
+            self._forget(name)
+        if names:
+            await asyncio.to_thread(self._unlink, names)
+
+    # --- Prefetch ---
+    def prefetch(self, urls):
+        """Warm the cache for ``urls`` in the background"""
+        for url in urls:
+            if url and not self.has(url) and url not in self._prefetching:
+                self.counters['prefetches'] += 1
+                task = asyncio.create_task(self._prefetch_one(url))
+                self._prefetching[url] = task
+                task.add_done_callback(lambda _, url=url: self._prefetching.pop(url, None))
+
+    async def _prefetch_one(self, url):
+        async with self._prefetch_slots:
+            await self.get(url)
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self):
+        return {**self.counters, 'files': len(self._entries), 'bytes': self._total,
+                'max_bytes': self.max_bytes, 'optimising': Image is not None}
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent image URL -> Telegram file_id cache.
+
+Once an image has been uploaded, Telegram returns a file_id that can be sent
+again without Telegram downloading the image from the shop server. The
+mapping lives in memory and in a small SQLite file so it survives restarts.
+"""
+
+import asyncio
+import json
+import logging
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+
+class PhotoIdCache:
+    """Maps image URLs to Telegram file_ids, invalidated when a product's images change"""
+
+    def __init__(self, path='photo_ids.db'):
+        self.path = path
+        self.file_ids = {}  # url -> file_id
+        self.product_images = {}  # sku -> list of image URLs last seen
+        self.counters = {'hits': 0, 'misses': 0, 'stored': 0, 'invalidated': 0}
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS file_ids (url TEXT PRIMARY KEY, file_id TEXT NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS product_images (sku TEXT PRIMARY KEY, images TEXT NOT NULL)"
+        )
+        return conn
+
+    def _execute(self, statements):
+        with self._connect() as conn:
+            for sql, params in statements:
+                conn.executemany(sql, params)
+        conn.close()
+
+    def _read(self):
+        with self._connect() as conn:
+            file_ids = dict(conn.execute("SELECT url, file_id FROM file_ids").fetchall())
+            images = {sku: json.loads(urls) for sku, urls in
+                      conn.execute("SELECT sku, images FROM product_images").fetchall()}
+        conn.close()
+        return file_ids, images
+
+    async def load(self):
+        try:
+            self.file_ids, self.product_images = await asyncio.to_thread(self._read)
+        except sqlite3.Error as e:
+            logger.error(f"Could not read photo id cache {self.path}: {e}")
+            return
+        logger.info(f"Photo id cache loaded {len(self.file_ids)} file ids")
+
+    def get(self, url):
+        file_id = self.file_ids.get(url)
+        self.counters['hits' if file_id else 'misses'] += 1
+        return file_id
+
+    async def put(self, url, file_id):
+        if self.file_ids.get(url) == file_id:
+            return
+        self.file_ids[url] = file_id
+        self.counters['stored'] += 1
+        await asyncio.to_thread(self._execute, [
+            ("INSERT OR REPLACE INTO file_ids (url, file_id) VALUES (?, ?)", [(url, file_id)]),
+        ])
+
+    async def invalidate(self, urls):
+        urls = [url for url in urls if url in self.file_ids]
+        if not urls:
+            return
+        for url in urls:
+            del self.file_ids[url]
+        self.counters['invalidated'] += len(urls)
+        await asyncio.to_thread(self._execute, [
+            ("DELETE FROM file_ids WHERE url = ?", [(url,) for url in urls]),
+        ])
+
+    async def track_product_images(self, sku, images):
+        """Drop cached file_ids of a product whose image list changed since last seen.
+
+        Returns the URLs whose content may have changed.
+        """
+        sku = str(sku)
+        images = list(images or [])
+        previous = self.product_images.get(sku)
+        if previous == images:
+            return set()
+        self.product_images[sku] = images
+        changed = set()
+        if previous is not None:
+            # The same URL may now point at a replaced file, so forget old and new
+            changed = set(previous) | set(images)
+            await self.invalidate(changed)
+        await asyncio.to_thread(self._execute, [
+            ("INSERT OR REPLACE INTO product_images (sku, images) VALUES (?, ?)",
+             [(sku, json.dumps(images))]),
+        ])
+        return changed
+
+    def stats(self):
+        return {**self.counters, 'size': len(self.file_ids)}
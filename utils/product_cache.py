@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+In-process product cache keyed by SKU.
+
+Fresh entries are served directly, stale entries are served while one
+background refresh runs, and unknown SKUs are remembered for a short time
+so they don't hit WooCommerce on every tap. Concurrent misses for the same
+SKU share a single upstream request.
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class ProductCache:
+    """Bounded TTL cache with stale-while-revalidate and negative caching"""
+
+    def __init__(self, loader, ttl=60, stale_ttl=600, negative_ttl=30, maxsize=1000):
+        """
+        loader: async callable(sku) -> product dict or None (unknown SKU)
+        ttl: seconds an entry is served without refreshing
+        stale_ttl: extra seconds a stale entry is served while refreshing
+        negative_ttl: seconds an unknown SKU is remembered
+        """
+        self.loader = loader
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()  # sku -> (product or None, fetched_at)
+        self._refreshing = {}  # sku -> background refresh task
+        self._inflight = {}  # sku -> task loading it from upstream
+        self.counters = {'hits': 0, 'stale_hits': 0, 'negative_hits': 0, 'misses': 0,
+                         'coalesced': 0, 'upstream_calls': 0,
+                         'refreshes': 0, 'refresh_errors': 0}
+
+    async def get(self, sku):
+        entry = self._entries.get(sku)
+        if entry is not None:
+            product, fetched_at = entry
+            age = time.monotonic() - fetched_at
+            self._entries.move_to_end(sku)
+            if product is None:
+                if age < self.negative_ttl:
+                    self.counters['negative_hits'] += 1
+                    return None
+            elif age < self.ttl:
+                self.counters['hits'] += 1
+                return product
+            elif age < self.ttl + self.stale_ttl:
+                self.counters['stale_hits'] += 1
+                self._refresh_in_background(sku)
+                return product
+
+        self.counters['misses'] += 1
+        return await self._load(sku)
+
+    async def _load(self, sku):
+        """Load a SKU, sharing one upstream call between concurrent callers"""
+        task = self._inflight.get(sku)
+        if task is None:
+            task = asyncio.create_task(self._fetch(sku))
+            self._inflight[sku] = task
+            task.add_done_callback(lambda _: self._inflight.pop(sku, None))
+        else:
+            self.counters['coalesced'] += 1
+        # shield: one caller giving up must not cancel the others' request
+        return await asyncio.shield(task)
+
+    async def _fetch(self, sku):
+        self.counters['upstream_calls'] += 1
+        product = await self.loader(sku)
+        self.put(sku, product)
+        return product
+
+    def _refresh_in_background(self, sku):
+        if sku in self._refreshing:
+            return
+        task = asyncio.create_task(self._refresh(sku))
+        self._refreshing[sku] = task
+        task.add_done_callback(lambda _: self._refreshing.pop(sku, None))
+
+    async def _refresh(self, sku):
+        self.counters['refreshes'] += 1
+        try:
+            await self._load(sku)
+        except Exception as e:
+            # Keep serving the stale copy until it expires
+            self.counters['refresh_errors'] += 1
+            logger.warning(f"Background refresh of product {sku} failed: {e}")
+
+    def put(self, sku, product):
+        self._entries[sku] = (product, time.monotonic())
+        self._entries.move_to_end(sku)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def is_stale(self, sku):
+        """True if the cached entry for a SKU is older than the TTL (or missing)"""
+        entry = self._entries.get(sku)
+        return entry is None or time.monotonic() - entry[1] >= self.ttl
+
+    def peek(self, sku):
+        """Last known product for a SKU regardless of age (None if never seen)"""
+        entry = self._entries.get(sku)
+        return entry[0] if entry else None
+
+    def invalidate(self, sku):
+        self._entries.pop(sku, None)
+
+    def stats(self):
+        lookups = (self.counters['hits'] + self.counters['stale_hits']
+                   + self.counters['negative_hits'] + self.counters['misses'])
+        served = lookups - self.counters['misses']
+        return {
+            **self.counters,
+            'size': len(self._entries),
+            'hit_rate': round(served / lookups, 3) if lookups else 0.0,
+        }
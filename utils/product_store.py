@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Shared, compact product records.
+
+A product being browsed used to be copied into every browsing user's
+user_data (and, with persistence, serialised for each of them). Instead one
+immutable ProductRecord per SKU lives in a shared ProductStore and user state
+keeps only the SKU. Records use __slots__, keep images as a tuple of interned
+strings, and are reused as long as the product data is unchanged.
+
+ProductRecord reads like the product_info dict it replaces (``record['name']``,
+``record.get('price')``, ``{**record}``), so formatting code is unchanged.
+"""
+
+import logging
+import sys
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class ProductRecord:
+    """Immutable product_info with dict-style read access"""
+
+    __slots__ = ('product_id', 'wc_id', 'name', 'price', 'min_quantity', 'in_stock',
+                 'stock_quantity', 'manage_stock', 'images', 'possibly_stale')
+
+    def __init__(self, product_info):
+        set_field = object.__setattr__
+        for field in self.__slots__:
+            set_field(self, field, _intern(product_info.get(field)))
+        set_field(self, 'product_id', _intern(str(product_info['product_id'])))
+        set_field(self, 'images', tuple(_intern(url) for url in product_info.get('images') or ()))
+        set_field(self, 'possibly_stale', bool(product_info.get('possibly_stale')))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("ProductRecord is immutable")
+
+    def _values(self):
+        return tuple(getattr(self, field) for field in self.__slots__)
+
+    def __eq__(self, other):
+        return isinstance(other, ProductRecord) and self._values() == other._values()
+
+    def __hash__(self):
+        return hash(self._values())
+
+    def __repr__(self):
+        return f"ProductRecord({self.product_id!r}, {self.name!r})"
+
+    # --- Mapping-style reads, as for the product_info dict ---
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def get(self, key, default=None):
+        if key not in self.__slots__:
+            return default
+        return getattr(self, key)
+
+    def keys(self):
+        return self.__slots__
+
+    def to_dict(self):
+        info = {field: getattr(self, field) for field in self.__slots__}
+        info['images'] = list(self.images)
+        return info
+
+
+class ProductStore:
+    """One shared ProductRecord per SKU, least recently used dropped first"""
+
+    def __init__(self, maxsize=5000):
+        self.maxsize = maxsize
+        self._records = OrderedDict()  # sku -> ProductRecord
+        self.counters = {'hits': 0, 'misses': 0, 'reused': 0, 'replaced': 0}
+
+    def intern(self, product_info):
+        """Return the shared record for ``product_info``, creating or replacing it"""
+        record = product_info
+        if not isinstance(record, ProductRecord):
+            record = ProductRecord(product_info)
+        current = self._records.get(record.product_id)
+        if current is not None and current == record:
+            self.counters['reused'] += 1
+            self._records.move_to_end(record.product_id)
+            return current
+        if current is not None:
+            self.counters['replaced'] += 1
+        self._records[record.product_id] = record
+        self._records.move_to_end(record.product_id)
+        while len(self._records) > self.maxsize:
+            self._records.popitem(last=False)
+        return record
+
+    def get(self, sku):
+        record = self._records.get(str(sku))
+        if record is None:
+            self.counters['misses'] += 1
+            return None
+        self.counters['hits'] += 1
+        self._records.move_to_end(record.product_id)
+        return record
+
+    def stats(self):
+        return {**self.counters, 'size': len(self._records)}
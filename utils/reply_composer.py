@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+Composition of multi-message replies.
+
+Many flows answer with several short messages in a row (status text, a
+"back to channel" button, the main menu). A ReplyComposer collects them with
+add() and flush() sends as few messages as Telegram allows:
+
+- consecutive parts are merged into one message when they share a
+  parse_mode, fit in one message, and their markups can live on one message:
+  inline keyboards are stacked, but an inline keyboard and a reply keyboard
+  can't share a message;
+- a ReplyKeyboardRemove followed by a new reply keyboard is dropped, the new
+  keyboard replaces the old one anyway;
+- edits of existing messages (side()) run concurrently with the sends, and
+  with ``ordered=False`` the merged messages are sent concurrently too.
+"""
+
+import asyncio
+import logging
+
+from telegram import InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_LENGTH = 4096
+PART_SEPARATOR = "\n\n"
+
+
+def _is_reply_keyboard(markup):
+    return isinstance(markup, (ReplyKeyboardMarkup, ReplyKeyboardRemove))
+
+
+class _Part:
+    __slots__ = ('text', 'reply_markup', 'parse_mode')
+
+    def __init__(self, text, reply_markup, parse_mode):
+        self.text = text
+        self.reply_markup = reply_markup
+        self.parse_mode = parse_mode
+
+    def absorb(self, other, max_length):
+        """Append ``other`` to this message if Telegram can show both as one"""
+        if other.parse_mode != self.parse_mode:
+            return False
+        if len(self.text) + len(PART_SEPARATOR) + len(other.text) > max_length:
+            return False
+        mine, theirs = self.reply_markup, other.reply_markup
+        if mine is None or theirs is None:
+            markup = mine if theirs is None else theirs
+        elif isinstance(mine, InlineKeyboardMarkup) and isinstance(theirs, InlineKeyboardMarkup):
+            markup = InlineKeyboardMarkup(
+                tuple(mine.inline_keyboard) + tuple(theirs.inline_keyboard)
+            )
+        else:
+            return False
+        self.text = f"{self.text}{PART_SEPARATOR}{other.text}"
+        self.reply_markup = markup
+        return True
+
+
+class ReplyComposer:
+    """Collects the messages of one reply and sends them in as few calls as possible"""
+
+    # Shared by all composers, for /stats
+    counters = {'flushes': 0, 'parts': 0, 'messages': 0, 'side_calls': 0, 'errors': 0}
+
+    def __init__(self, send, max_length=MAX_MESSAGE_LENGTH):
+        """
+        send: async callable(text, reply_markup=..., parse_mode=...), e.g.
+            Message.reply_text or functools.partial(bot.send_message, chat_id)
+        """
+        self._send = send
+        self.max_length = max_length
+        self._parts = []
+        self._side = []
+
+    def add(self, text, reply_markup=None, parse_mode='Markdown'):
+        self._parts.append(_Part(text, reply_markup, parse_mode))
+        return self
+
+    def side(self, awaitable, ignore_errors=False):
+        """An independent call (e.g. editing the pressed message) run alongside the sends"""
+        self._side.append((awaitable, ignore_errors))
+        return self
+
+    def compose(self):
+        """The messages flush() would send, as (text, reply_markup, parse_mode)"""
+        parts = list(self._parts)
+        # A keyboard removal is pointless if a new reply keyboard follows
+        for i, part in enumerate(parts):
+            if isinstance(part.reply_markup, ReplyKeyboardRemove) and any(
+                    _is_reply_keyboard(later.reply_markup) for later in parts[i + 1:]):
+                parts[i] = _Part(part.text, None, part.parse_mode)
+
+        messages = []
+        for part in parts:
+            if not messages or not messages[-1].absorb(part, self.max_length):
+                messages.append(_Part(part.text, part.reply_markup, part.parse_mode))
+        return [(m.text, m.reply_markup, m.parse_mode) for m in messages]
+
+    async def _send_one(self, message):
+        text, reply_markup, parse_mode = message
+        return await self._send(text, reply_markup=reply_markup, parse_mode=parse_mode)
+
+    async def _send_in_order(self, messages):
+        results = []
+        for message in messages:
+            results.append(await self._send_one(message))
+        return results
+
+    async def _run_side(self, awaitable, ignore_errors):
+        try:
+            return await awaitable
+        except Exception as e:
+            if not ignore_errors:
+                raise
+            logger.debug(f"Ignored failed side call: {e}")
+            return None
+
+    async def flush(self, ordered=True):
+        """Send everything collected so far; returns the sent messages.
+
+        ordered: keep the messages in order in the chat (sent one after
+        another); otherwise they are sent concurrently. Side calls always run
+        concurrently. Every call is awaited before the first error is raised.
+        """
+        messages = self.compose()
+        side, self._side = self._side, []
+        self.counters['flushes'] += 1
+        self.counters['parts'] += len(self._parts)
+        self.counters['messages'] += len(messages)
+        self.counters['side_calls'] += len(side)
+        self._parts = []
+
+        calls = [self._run_side(awaitable, ignore_errors) for awaitable, ignore_errors in side]
+        if ordered:
+            calls.append(self._send_in_order(messages))
+        else:
+            calls.extend(self._send_one(message) for message in messages)
+        results = await asyncio.gather(*calls, return_exceptions=True)
+
+        errors = [r for r in results if isinstance(r, BaseException)]
+        if errors:
+            self.counters['errors'] += len(errors)
+            raise errors[0]
+        sent = results[len(side):]
+        if ordered:
+            sent = sent[0]
+        return sent
+
+    @classmethod
+    def stats(cls):
+        return dict(cls.counters)
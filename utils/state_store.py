@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite persistence for user_data and chat_data.
+
+Order flows keep their state (current product, quantity, awaiting_* flags,
+source post) in context.user_data; this keeps it across restarts. Compared
+to python-telegram-bot's PicklePersistence, which rewrites one file with
+every user on each run:
+
+- data is stored per (user, key), and only keys whose value changed since
+  the last write are upserted or deleted;
+- writes from one persistence run are batched into a single transaction on
+  a worker thread; a batch that fails is kept and retried with backoff;
+- nothing is read at startup: a user's data is loaded the first time one of
+  their updates is handled (refresh_user_data), so startup cost doesn't grow
+  with the number of users;
+- every row records when it was last written, and purge_idle() deletes the
+  data of owners that haven't been loaded or changed for a given time, so
+  users who never come back don't stay in the file forever.
+"""
+
+import asyncio
+import hashlib
+import logging
+import pickle
+import sqlite3
+import time
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+USER = 'user'
+CHAT = 'chat'
+
+
+class SQLitePersistence(BasePersistence):
+    """Lazily loaded, per-key, batched user/chat data persistence"""
+
+    def __init__(self, path='state.db', update_interval=5, max_pending=100000,
+                 max_retry_delay=60):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=True, user_data=True,
+                                        callback_data=False),
+            update_interval=update_interval,
+        )
+        self.path = path
+        self.max_pending = max_pending
+        self.max_retry_delay = max_retry_delay
+        # kind -> owner id -> key -> digest of the stored value; present = loaded
+        self._stored = {USER: {}, CHAT: {}}
+        self._pending = []  # (sql, params) not yet written
+        self._flush_task = None
+        self.counters = {'loads': 0, 'upserts': 0, 'deletes': 0, 'flushes': 0, 'errors': 0,
+                         'dropped': 0, 'purged': 0}
+        self._init_db()
+
+    # --- SQLite (worker thread) ---
+    def _connect(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _init_db(self):
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS state ("
+                "kind TEXT NOT NULL, owner_id INTEGER NOT NULL, key TEXT NOT NULL, "
+                "value BLOB NOT NULL, updated_at REAL, PRIMARY KEY (kind, owner_id, key))"
+            )
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(state)")]
+            if 'updated_at' not in columns:
+                # Files from before purge_idle(): existing rows age from now
+                conn.execute("ALTER TABLE state ADD COLUMN updated_at REAL")
+                conn.execute("UPDATE state SET updated_at = ?", (time.time(),))
+        conn.close()
+
+    def _read(self, kind, owner_id):
+        conn = self._connect()
+        try:
+            return conn.execute(
+                "SELECT key, value FROM state WHERE kind = ? AND owner_id = ?", (kind, owner_id)
+            ).fetchall()
+        finally:
+            conn.close()
+
+    def _idle_owners(self, kind, cutoff):
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT owner_id FROM state WHERE kind = ? GROUP BY owner_id "
+                "HAVING MAX(updated_at) < ?", (kind, cutoff)
+            ).fetchall()
+            return [row[0] for row in rows]
+        finally:
+            conn.close()
+
+    def _write(self, statements):
+        conn = self._connect()
+        try:
+            with conn:
+                for sql, params in statements:
+                    conn.execute(sql, params)
+        finally:
+            conn.close()
+
+    # --- Loading ---
+    @staticmethod
+    def _digest(blob):
+        return hashlib.blake2b(blob, digest_size=16).digest()
+
+    async def _load_into(self, kind, owner_id, data):
+        if owner_id in self._stored[kind]:
+            return
+        try:
+            rows = await asyncio.to_thread(self._read, kind, owner_id)
+        except sqlite3.Error as e:
+            self.counters['errors'] += 1
+            logger.error(f"Could not load {kind} data for {owner_id}: {e}")
+            return
+        if owner_id in self._stored[kind]:
+            return  # loaded by a concurrent update meanwhile
+        stored = {}
+        for key, blob in rows:
+            try:
+                value = pickle.loads(blob)
+            except Exception as e:
+                logger.warning(f"Dropping unreadable {kind} data {owner_id}/{key}: {e}")
+                continue
+            # State set before the load finished wins over the stored value
+            data.setdefault(key, value)
+            stored[key] = self._digest(blob)
+        self._stored[kind][owner_id] = stored
+        self.counters['loads'] += 1
+
+    async def refresh_user_data(self, user_id, user_data):
+        await self._load_into(USER, user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        await self._load_into(CHAT, chat_id, chat_data)
+
+    async def get_user_data(self):
+        return {}  # loaded lazily per user, see refresh_user_data
+
+    async def get_chat_data(self):
+        return {}
+
+    # --- Writing ---
+    def _stage(self, kind, owner_id, data):
+        stored = self._stored[kind].setdefault(owner_id, {})
+        for key, value in data.items():
+            try:
+                blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            except Exception as e:
+                logger.warning(f"Not persisting {kind} data {owner_id}/{key}: {e}")
+                continue
+            digest = self._digest(blob)
+            if stored.get(key) != digest:
+                stored[key] = digest
+                self.counters['upserts'] += 1
+                self._pending.append((
+                    "INSERT OR REPLACE INTO state (kind, owner_id, key, value, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (kind, owner_id, str(key), blob, time.time()),
+                ))
+        for key in [key for key in stored if key not in data]:
+            del stored[key]
+            self.counters['deletes'] += 1
+            self._pending.append((
+                "DELETE FROM state WHERE kind = ? AND owner_id = ? AND key = ?",
+                (kind, owner_id, str(key)),
+            ))
+        self._schedule_flush()
+
+    def _drop(self, kind, owner_id):
+        self._stored[kind].pop(owner_id, None)
+        self.counters['deletes'] += 1
+        self._pending.append((
+            "DELETE FROM state WHERE kind = ? AND owner_id = ?", (kind, owner_id),
+        ))
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        # One write per persistence run: the Application stages every touched
+        # user concurrently, the task runs once they have all been staged
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_pending())
+
+    def _requeue(self, statements):
+        """Put an unwritten batch back ahead of the changes staged since"""
+        self._pending = statements + self._pending
+        overflow = len(self._pending) - self.max_pending
+        if overflow > 0:
+            dropped, self._pending = self._pending[:overflow], self._pending[overflow:]
+            self.counters['dropped'] += overflow
+            # Forget what is stored for these owners: their next update rewrites every key
+            for _, params in dropped:
+                self._stored[params[0]].pop(params[1], None)
+            logger.error(f"State write backlog full, dropped the {overflow} oldest changes")
+
+    async def _flush_pending(self, retries=None):
+        await asyncio.sleep(0)
+        failures = 0
+        # Changes staged while a batch is being written go out in the next one
+        while self._pending:
+            statements, self._pending = self._pending, []
+            try:
+                await asyncio.to_thread(self._write, statements)
+            except asyncio.CancelledError:
+                self._requeue(statements)  # rewriting is harmless if it did land
+                raise
+            except sqlite3.Error as e:
+                failures += 1
+                self.counters['errors'] += 1
+                self._requeue(statements)
+                if retries is not None and failures > retries:
+                    logger.error(f"Could not persist {len(self._pending)} state changes: {e}")
+                    return
+                delay = min(self.max_retry_delay, 2 ** (failures - 1))
+                logger.error(f"Could not persist {len(statements)} state changes, "
+                             f"retrying in {delay}s: {e}")
+                await asyncio.sleep(delay)
+                continue
+            failures = 0
+            self.counters['flushes'] += 1
+
+    async def update_user_data(self, user_id, data):
+        self._stage(USER, user_id, data)
+
+    async def update_chat_data(self, chat_id, data):
+        self._stage(CHAT, chat_id, data)
+
+    async def drop_user_data(self, user_id):
+        self._drop(USER, user_id)
+
+    async def drop_chat_data(self, chat_id):
+        self._drop(CHAT, chat_id)
+
+    async def purge_idle(self, max_age, kind=USER):
+        """Delete stored data of owners unchanged for max_age seconds.
+
+        Owners loaded in this run are left alone; their expiry is up to the
+        application (e.g. drop_user_data). Returns the number of owners purged.
+        """
+        try:
+            owners = await asyncio.to_thread(self._idle_owners, kind, time.time() - max_age)
+        except sqlite3.Error as e:
+            self.counters['errors'] += 1
+            logger.error(f"Could not look up idle {kind} data: {e}")
+            return 0
+        owners = [owner_id for owner_id in owners if owner_id not in self._stored[kind]]
+        for owner_id in owners:
+            self._drop(kind, owner_id)
+        self.counters['purged'] += len(owners)
+        if owners:
+            logger.info(f"Purging stored {kind} data of {len(owners)} idle owners")
+        return len(owners)
+
+    async def flush(self):
+        task = self._flush_task
+        if task is not None and not task.done():
+            # May be waiting to retry; its batch goes back to _pending when cancelled
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await self._flush_pending(retries=2)
+
+    # --- Not stored ---
+    async def get_bot_data(self):
+        return {}
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    def stats(self):
+        return {
+            **self.counters,
+            'loaded_users': len(self._stored[USER]),
+            'loaded_chats': len(self._stored[CHAT]),
+            'pending': len(self._pending),
+        }
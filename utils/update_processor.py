@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Concurrent update processing that keeps each user's updates in order.
+
+With python-telegram-bot's default sequential processing one slow update
+(a WooCommerce fetch, a photo upload) delays every other user. This
+processor runs updates of different users concurrently on a bounded number
+of workers, while updates of the same user still run one at a time and in
+arrival order, so user_data state machines (awaiting_quantity,
+awaiting_phone, ...) never see interleaved updates.
+"""
+
+import asyncio
+import logging
+import time
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Bounded concurrency across users, strict ordering within one user"""
+
+    def __init__(self, max_workers=32, shards=256, max_pending=None):
+        """
+        max_workers: updates actually running handlers at the same time
+        shards: number of ordering locks; users are spread over them by id
+        max_pending: updates accepted before Telegram polling is back-pressured
+        """
+        # The base semaphore only bounds queued updates; workers are taken
+        # after the user's lock so a user with a backlog can't hog them
+        super().__init__(max_concurrent_updates=max_pending or max_workers * 8)
+        self.max_workers = max_workers
+        self._workers = asyncio.Semaphore(max_workers)
+        self._locks = [asyncio.Lock() for _ in range(shards)]
+        self.accepted = 0  # updates inside do_process_update, waiting or running
+        self.running = 0
+        self.counters = {'processed': 0, 'contended': 0, 'errors': 0}
+        self._max_wait_ms = 0.0
+
+    @staticmethod
+    def _ordering_key(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return update.effective_user.id
+            if update.effective_chat:
+                return update.effective_chat.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        self.accepted += 1
+        try:
+            key = self._ordering_key(update)
+            if key is None:
+                async with self._workers:
+                    await self._run(coroutine)
+                return
+
+            lock = self._locks[hash(key) % len(self._locks)]
+            if lock.locked():
+                self.counters['contended'] += 1
+            started = time.perf_counter()
+            async with lock:
+                async with self._workers:
+                    waited_ms = (time.perf_counter() - started) * 1000
+                    self._max_wait_ms = max(self._max_wait_ms, waited_ms)
+                    await self._run(coroutine)
+        finally:
+            self.accepted -= 1
+
+    async def _run(self, coroutine):
+        self.running += 1
+        try:
+            await coroutine
+        except Exception:
+            # The Application's error handlers have already seen it
+            self.counters['errors'] += 1
+            raise
+        finally:
+            self.running -= 1
+            self.counters['processed'] += 1
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def stats(self):
+        return {
+            **self.counters,
+            'running': self.running,
+            'max_workers': self.max_workers,
+            'queued': self.accepted - self.running,
+            'max_wait_ms': round(self._max_wait_ms, 1),
+        }
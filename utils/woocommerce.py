@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Async WooCommerce REST client.
+
+One pooled httpx.AsyncClient (already installed with python-telegram-bot) is
+shared by every handler, so product lookups reuse keep-alive connections and
+never block the bot's event loop.
+"""
+
+import asyncio
+import logging
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Only the fields the bot actually reads; WooCommerce drops everything else
+PRODUCT_FIELDS = "id,sku,name,regular_price,stock_status,stock_quantity,manage_stock,images"
+
+
+class WooCommerceClient:
+    """Pooled, compressed and timeout-bounded access to /wp-json/wc/v3"""
+
+    def __init__(self, base_url, consumer_key, consumer_secret, timeout=5.0,
+                 max_connections=20, keepalive_expiry=60.0):
+        self.base_url = f"{base_url.rstrip('/')}/wp-json/wc/v3"
+        self.auth = (consumer_key, consumer_secret)
+        self.timeout = timeout
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self._client = None
+
+    def _get_client(self):
+        # Created lazily so the pool belongs to the loop the bot runs on
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                auth=self.auth,
+                timeout=self.timeout,
+                limits=self.limits,
+                headers={"Accept-Encoding": "gzip, deflate"},
+            )
+        return self._client
+
+    async def get(self, path, params=None, timeout=None):
+        """GET a WooCommerce endpoint and return the decoded JSON body.
+
+        A body that isn't JSON (e.g. an HTML error or maintenance page served
+        with status 200) raises httpx.DecodingError, like other HTTP failures.
+        """
+        response = await self._get_client().get(
+            path,
+            params=params,
+            timeout=timeout if timeout is not None else httpx.USE_CLIENT_DEFAULT,
+        )
+        response.raise_for_status()
+        try:
+            return response.json()
+        except ValueError as e:
+            raise httpx.DecodingError(
+                f"Non-JSON response from {path}: {e}", request=response.request
+            ) from e
+
+    async def get_products(self, fields=PRODUCT_FIELDS, timeout=None, **params):
+        """List products, projected to ``fields`` (comma separated)"""
+        if fields:
+            params['_fields'] = fields
+        products = await self.get("/products", params=params, timeout=timeout)
+        if not isinstance(products, list):
+            raise httpx.DecodingError(
+                f"Expected a product list from /products, got {type(products).__name__}",
+                request=None,
+            )
+        return products
+
+    async def get_product_by_sku(self, sku, timeout=None):
+        """Return the raw published product for a SKU, or None if there is none"""
+        products = await self.get_products(sku=sku, status='publish', timeout=timeout)
+        return products[0] if products else None
+
+    async def get_products_batch(self, ids=(), skus=(), timeout=None):
+        """Fetch many published products in one request per key type: ids (include=) and SKUs"""
+        calls = []
+        if ids:
+            calls.append(self.get_products(
+                include=",".join(str(i) for i in ids), per_page=min(len(ids), 100),
+                status='publish', timeout=timeout,
+            ))
+        if skus:
+            calls.append(self.get_products(
+                sku=",".join(skus), per_page=min(len(skus), 100), status='publish',
+                timeout=timeout,
+            ))
+        batches = await asyncio.gather(*calls)
+        return [product for batch in batches for product in batch]
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
@@ -0,0 +1,224 @@
+"""Compare update-to-response latency of the sale bot's polling and webhook modes.
+
+Runs a small python-telegram-bot Application against an in-process fake Bot
+API with simulated network latency. Each synthetic "ping N" message is
+answered with "pong N", and the time from the update leaving "Telegram" to
+the reply reaching it is measured:
+
+    python3 webhook_bench.py --updates 500 --rate 50 --api-latency 0.08
+
+Webhook mode needs python-telegram-bot[webhooks] (tornado).
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+from telegram import Update
+from telegram.ext import Application, MessageHandler, filters
+from telegram.request import BaseRequest
+
+from utils.update_processor import PerUserUpdateProcessor
+
+WEBHOOK_SECRET = "bench-secret"
+WEBHOOK_PATH = "bench"
+
+
+class FakeTelegram:
+    """Bot API state shared by the bot's two request objects"""
+
+    def __init__(self, api_latency):
+        self.api_latency = api_latency
+        self.pending = []  # updates not yet fetched by getUpdates
+        self.arrived = asyncio.Event()
+        self.sent_at = {}  # update id -> time the update left "Telegram"
+        self.latencies = []
+        self.calls = {}
+        self.done = asyncio.Event()
+        self.expected = 0
+        self._message_id = 0
+
+    def result(self, value):
+        return 200, json.dumps({"ok": True, "result": value}).encode()
+
+    async def handle(self, method, params):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        # Half the round trip on the way in, half on the way out
+        await asyncio.sleep(self.api_latency / 2)
+        if method == "getUpdates":
+            value = await self.get_updates(
+                int(params.get("offset") or 0), float(params.get("timeout") or 0)
+            )
+        elif method == "sendMessage":
+            value = self.send_message(params)
+        elif method == "getMe":
+            value = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        else:  # setWebhook, deleteWebhook, ...
+            value = True
+        await asyncio.sleep(self.api_latency / 2)
+        return self.result(value)
+
+    async def get_updates(self, offset, timeout):
+        self.pending = [u for u in self.pending if u["update_id"] >= offset]
+        if not self.pending and timeout:
+            self.arrived.clear()
+            try:
+                await asyncio.wait_for(self.arrived.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return list(self.pending[:100])
+
+    def send_message(self, params):
+        update_id = int(str(params["text"]).split()[-1])
+        self.latencies.append((time.perf_counter() - self.sent_at[update_id]) * 1000)
+        if len(self.latencies) >= self.expected:
+            self.done.set()
+        self._message_id += 1
+        return {"message_id": self._message_id, "date": int(time.time()),
+                "chat": {"id": int(params["chat_id"]), "type": "private"}, "text": params["text"]}
+
+
+class FakeBotAPI(BaseRequest):
+    def __init__(self, telegram):
+        self.telegram = telegram
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        params = request_data.parameters if request_data else {}
+        return await self.telegram.handle(url.rsplit("/", 1)[-1], params)
+
+
+def make_update(update_id, user_id):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "user"},
+            "text": f"ping {update_id}",
+        },
+    }
+
+
+async def pong(update: Update, context):
+    await update.message.reply_text(f"pong {update.update_id}")
+
+
+def build_application(telegram, args):
+    application = (
+        Application.builder()
+        .token("1:BENCH")
+        .request(FakeBotAPI(telegram))
+        .get_updates_request(FakeBotAPI(telegram))
+        .concurrent_updates(PerUserUpdateProcessor(max_workers=args.workers))
+        .build()
+    )
+    application.add_handler(MessageHandler(filters.TEXT, pong))
+    return application
+
+
+async def deliver_webhook(client, url, telegram, update):
+    # Telegram -> bot leg of the network
+    await asyncio.sleep(telegram.api_latency / 2)
+    response = await client.post(
+        url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET}
+    )
+    response.raise_for_status()
+
+
+async def run_mode(mode, args):
+    telegram = FakeTelegram(args.api_latency)
+    telegram.expected = args.updates
+    application = build_application(telegram, args)
+    url = f"http://127.0.0.1:{args.port}/{WEBHOOK_PATH}"
+    deliveries = []
+    async with application, httpx.AsyncClient() as client:
+        await application.start()
+        if mode == "polling":
+            await application.updater.start_polling(poll_interval=0, timeout=args.poll_timeout)
+        else:
+            await application.updater.start_webhook(
+                listen="127.0.0.1", port=args.port, url_path=WEBHOOK_PATH,
+                webhook_url=url, secret_token=WEBHOOK_SECRET,
+            )
+        telegram.calls.clear()
+
+        started = time.perf_counter()
+        for update_id in range(1, args.updates + 1):
+            update = make_update(update_id, 1000 + update_id % args.users)
+            telegram.sent_at[update_id] = time.perf_counter()
+            if mode == "polling":
+                telegram.pending.append(update)
+                telegram.arrived.set()
+            else:
+                deliveries.append(
+                    asyncio.create_task(deliver_webhook(client, url, telegram, update))
+                )
+            if args.rate:
+                await asyncio.sleep(1 / args.rate)
+        await asyncio.gather(*deliveries)
+        try:
+            await asyncio.wait_for(telegram.done.wait(), args.timeout)
+        except asyncio.TimeoutError:
+            print(f"[{mode}] timed out with {len(telegram.latencies)}/{args.updates} replies")
+        elapsed = time.perf_counter() - started
+
+        await application.updater.stop()
+        await application.stop()
+    return telegram, elapsed
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def print_report(mode, telegram, elapsed):
+    latencies = telegram.latencies
+    print(f"\n--- {mode.capitalize()} ---")
+    print(f"Replies:      {len(latencies)} in {elapsed:.2f}s")
+    for pct in (50, 95, 99):
+        print(f"Latency p{pct}:  {percentile(latencies, pct):.2f} ms")
+    print(f"Latency max:  {max(latencies, default=0.0):.2f} ms")
+    print(f"API calls:    {dict(sorted(telegram.calls.items()))}")
+
+
+async def bench(args):
+    for mode in args.modes:
+        telegram, elapsed = await run_mode(mode, args)
+        print_report(mode, telegram, elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modes", nargs="+", choices=("polling", "webhook"),
+                        default=["polling", "webhook"])
+    parser.add_argument("--updates", type=int, default=300)
+    parser.add_argument("--users", type=int, default=50, help="distinct users sending updates")
+    parser.add_argument("--rate", type=float, default=50.0,
+                        help="updates per second; 0 sends them all at once")
+    parser.add_argument("--api-latency", type=float, default=0.08,
+                        help="simulated Bot API round trip in seconds")
+    parser.add_argument("--poll-timeout", type=int, default=10, help="getUpdates long-poll timeout")
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--port", type=int, default=8787)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    asyncio.run(bench(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()